@@ -37,6 +37,9 @@ with open(spam_networks_list_path) as f:
     read_data = f.read()
 spam_networks_list = re.findall(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.0/\d{1,2}).*', read_data, re.MULTILINE)
 SPAM_NETWORKS = [[addr, False] for addr in filter(check_ip_range, spam_networks_list)]
+# The list above is only served until a compacted one is loaded into DB, see `device_registry.blocklist`.
+SPAM_NETWORKS_PATH = spam_networks_list_path
+SPAM_NETWORKS_CHECK_INTERVAL = 60  # Check for a new blocklist version at most once a minute.
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
@@ -276,9 +279,25 @@ CELERY_BEAT_SCHEDULE = {
     'sample_history': {
         'task': 'device_registry.tasks.sample_history',
         'schedule': crontab(hour=SAMPLE_HISTORY_AT, minute=0)  # Execute once a day at 5PM.
+    },
+    'delete_orphan_package_sets': {
+        'task': 'device_registry.tasks.delete_orphan_package_sets',
+        'schedule': crontab(hour=4, minute=0)  # Execute once a day at 4AM.
     }
 }
 
+# Package matching snapshots vulnerability indexes (see device_registry/vulnerability_index.py) to files in this
+# directory, so worker processes load them instead of querying the database. Empty disables snapshots.
+VULNERABILITY_INDEX_PATH = os.getenv('VULNERABILITY_INDEX_PATH', '')
+# Debian Security Tracker debsecan feeds are at DEBIAN_SECURITY_TRACKER_URL + <suite>.
+DEBIAN_SECURITY_TRACKER_URL = os.getenv('DEBIAN_SECURITY_TRACKER_URL',
+                                        'https://security-tracker.debian.org/tracker/debsecan/release/1/')
+# ubuntu-cve-tracker import settings.
+# The tracker is updated in place and parsed CVE files are cached by blob SHA, so only changed files are parsed.
+UBUNTU_CVE_TRACKER_PATH = os.getenv('UBUNTU_CVE_TRACKER_PATH', '/tmp/ubuntu-cve-tracker')
+UBUNTU_CVE_CACHE_PATH = os.getenv('UBUNTU_CVE_CACHE_PATH', '/tmp/ubuntu-cve-cache')
+UBUNTU_CVE_PARSE_WORKERS = int(os.getenv('UBUNTU_CVE_PARSE_WORKERS', '4'))  # 1 parses in the worker process.
+
 # Mixpanel token
 MIXPANEL_TOKEN = os.getenv('MIXPANEL_TOKEN', '')
 
@@ -296,4 +315,52 @@ GITHUB_APP_CLIENT_SECRET = os.getenv('GITHUB_APP_CLIENT_SECRET')    # Github App
 GITHUB_APP_REDIRECT_URL = os.getenv('GITHUB_APP_REDIRECT_URL')    # Github App Redirect URL
 GITHUB_IMMEDIATE_SYNC = False
 
+# Ping ingestion settings.
+# With PING_WRITE_BEHIND enabled the mTLS ping endpoint only validates a payload and appends it to a Redis stream.
+# The stream is drained by the `ingest_pings` celery task with one consumer group shared by all workers.
+PING_WRITE_BEHIND = bool(int(os.getenv('PING_WRITE_BEHIND', '0')))
+PING_STREAM = 'pings'
+PING_STREAM_GROUP = 'ping-ingest'
+PING_STREAM_MAXLEN = int(os.getenv('PING_STREAM_MAXLEN', '100000'))  # Approximate stream length cap.
+PING_STREAM_CLAIM_IDLE_MS = 60 * 1000  # Reclaim pings left unacknowledged by a dead consumer after 1m.
+PING_INGEST_BATCH_SIZE = int(os.getenv('PING_INGEST_BATCH_SIZE', '200'))
+PING_INGEST_MAX_BATCHES = 50  # Max batches processed by one `ingest_pings` task run.
+if PING_WRITE_BEHIND:
+    CELERY_BEAT_SCHEDULE['ingest_pings'] = {
+        'task': 'device_registry.tasks.ingest_pings',
+        'schedule': 10.0  # Execute every 10 seconds.
+    }
+BULK_PING_MAX_SIZE = int(os.getenv('BULK_PING_MAX_SIZE', '1000'))  # Max pings sent by a gateway in one request.
+# Adaptive heartbeat settings (see device_registry/heartbeat.py).
+# Ping responses hint agents to ping again in PING_INTERVAL seconds, more under load. 0 disables the hint.
+PING_INTERVAL = int(os.getenv('PING_INTERVAL', '0'))
+PING_INTERVAL_MIN = int(os.getenv('PING_INTERVAL_MIN', '60'))  # For devices with pending changes.
+PING_INTERVAL_MAX = int(os.getenv('PING_INTERVAL_MAX', '3600'))
+PING_INTERVAL_JITTER = 0.1  # Randomize intervals by +-10%.
+PING_TARGET_QUEUE_DEPTH = int(os.getenv('PING_TARGET_QUEUE_DEPTH', '10000'))  # Normal ingestion stream length.
+PING_TARGET_P95_LATENCY = float(os.getenv('PING_TARGET_P95_LATENCY', '0.5'))  # Normal ping processing time.
+PING_LOAD_CHECK_INTERVAL = 10
+# Ping archive settings (see device_registry/ping_archive.py).
+# Raw pings are buffered in a Redis list and exported to PING_ARCHIVE_SINK by the `export_ping_archive` celery task.
+# An empty PING_ARCHIVE_SINK disables archiving.
+PING_ARCHIVE_SINK = os.getenv('PING_ARCHIVE_SINK', 'device_registry.ping_archive.DatastoreSink')
+PING_ARCHIVE_PATH = os.getenv('PING_ARCHIVE_PATH', 'pings.jsonl')  # Used by FileSink.
+PING_ARCHIVE_QUEUE = 'ping-archive'
+PING_ARCHIVE_MAXLEN = int(os.getenv('PING_ARCHIVE_MAXLEN', '100000'))  # Pings over this are dropped.
+PING_ARCHIVE_BATCH_SIZE = int(os.getenv('PING_ARCHIVE_BATCH_SIZE', '500'))
+PING_ARCHIVE_MAX_BATCHES = 50  # Max batches exported by one `export_ping_archive` task run.
+if PING_ARCHIVE_SINK:
+    CELERY_BEAT_SCHEDULE['export_ping_archive'] = {
+        'task': 'device_registry.tasks.export_ping_archive',
+        'schedule': 10.0  # Execute every 10 seconds.
+    }
+# The ping GET endpoint caches firewall policies with the default cache backend. They are invalidated on change, but
+# with a per-process backend (like the default LocMemCache) other processes only see the change when it expires.
+PING_POLICY_CACHE_TIMEOUT = int(os.getenv('PING_POLICY_CACHE_TIMEOUT', '60'))
+# MTLSAuthentication remembers known device ids in every process.
+MTLS_AUTH_CACHE_SIZE = 100000
+MTLS_AUTH_CACHE_TTL = 60
+# Max size of a compressed (Content-Encoding: gzip/zstd) agent request body after decompression.
+MTLS_MAX_DECOMPRESSED_SIZE = int(os.getenv('MTLS_MAX_DECOMPRESSED_SIZE', str(32 * 1024 * 1024)))
+
 MAX_WEEKLY_RA = 5  # The number of RAs for the user to resolve in a week (starting this Monday)
@@ -2,7 +2,8 @@ from django.contrib import admin
 from django_json_widget.widgets import JSONEditorWidget
 from django.contrib.postgres.fields import JSONField
 
-from .models import Device, DeviceInfo, PortScan, FirewallState, Credential, GlobalPolicy, Distro, Vulnerability
+from .models import Device, DeviceInfo, PortScan, FirewallState, Credential, GlobalPolicy, Distro, Vulnerability, \
+    GatewayKey
 
 
 @admin.register(Device)
@@ -80,6 +81,13 @@ class GlobalPolicyAdmin(admin.ModelAdmin):
     readonly_fields = ['created']
 
 
+@admin.register(GatewayKey)
+class GatewayKeyAdmin(admin.ModelAdmin):
+    list_display = ['key', 'owner', 'comment', 'created']
+    list_filter = ['owner']
+    readonly_fields = ['key', 'created']
+
+
 @admin.register(Distro)
 class DistroAdmin(admin.ModelAdmin):
     list_display = ['os_release_codename', 'end_of_life']
@@ -1,5 +1,6 @@
 import json
 import logging
+import time
 import uuid
 import datetime
 from urllib.parse import unquote
@@ -8,6 +9,7 @@ import dateutil
 import dateutil.parser
 from django.http import HttpResponse
 from django.utils import timezone
+from django.utils.http import parse_etags
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import login_required
@@ -18,38 +20,31 @@ from django.db.models import Q, F
 from django.db.models.query import QuerySet
 from django.db.models.functions import Round, Coalesce
 
-from google.cloud import datastore
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView, DestroyAPIView, CreateAPIView, UpdateAPIView, RetrieveAPIView
 from rest_framework.generics import get_object_or_404
 from rest_framework.authentication import SessionAuthentication, TokenAuthentication
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.exceptions import ValidationError
-from netaddr import IPAddress
 
 from device_registry import ca_helper
-from device_registry import google_cloud_helper
+from device_registry import blocklist, heartbeat, ping_ingest, ping_policy
 from device_registry.serializers import DeviceInfoSerializer, CredentialsListSerializer, CredentialSerializer
 from device_registry.serializers import CreateDeviceSerializer, RenewExpiredCertSerializer, DeviceIDSerializer
 from device_registry.serializers import IsDeviceClaimedSerializer, RenewCertSerializer, BatchArgsTagsSerializer
 from device_registry.serializers import DeviceListSerializer
-from device_registry.authentication import MTLSAuthentication
+from device_registry.authentication import GatewayKeyAuthentication, MTLSAuthentication
+from device_registry.parsers import AgentJSONParser, AgentJSONRenderer
 from device_registry.serializers import EnrollDeviceSerializer, PairingKeyListSerializer, UpdatePairingKeySerializer
 from device_registry.serializers import SnoozeActionSerializer
 from .tasks import file_github_issues
-from .models import Device, DeviceInfo, FirewallState, PortScan, Credential, Tag, PairingKey, GlobalPolicy, DebPackage,\
+from .models import Device, DeviceInfo, Credential, Tag, PairingKey, GlobalPolicy, DebPackage,\
     RecommendedAction
 
 logger = logging.getLogger(__name__)
 
-if google_cloud_helper.credentials and google_cloud_helper.project:
-    datastore_client = datastore.Client(project=google_cloud_helper.project,
-                                        credentials=google_cloud_helper.credentials)
-else:
-    datastore_client = None
-
 
 class PolicyDeviceNumberView(APIView):
     """
@@ -65,126 +60,118 @@ class MtlsPingView(APIView):
     """Endpoint for sending a heartbeat."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
 
     def get(self, request, *args, **kwargs):
-        device = Device.objects.get(device_id=request.device_id)
+        device = request.device
         device.last_ping = timezone.now()
         device.save(update_fields=['last_ping'])
-        portscan_object, _ = PortScan.objects.get_or_create(device=device)
-        firewallstate_object, _ = FirewallState.objects.get_or_create(device=device)
-        if firewallstate_object.global_policy:  # Use security settings from the global policy.
-            block_networks = firewallstate_object.global_policy.networks.copy()
-            block_ports = firewallstate_object.global_policy.ports
-            policy_string = firewallstate_object.global_policy.policy_string
-            ports_field_name = firewallstate_object.global_policy.ports_field_name
-        else:  # User's per-device security settings.
-            block_networks = portscan_object.block_networks.copy()
-            block_ports = portscan_object.block_ports
-            policy_string = firewallstate_object.policy_string
-            ports_field_name = firewallstate_object.ports_field_name
-        block_networks.extend(settings.SPAM_NETWORKS)
-        return Response({
-            'policy': policy_string, ports_field_name: block_ports, 'block_networks': block_networks,
-            'deb_packages_hash': device.deb_packages_hash
-        })
+        # Agents which fetch the spam networks from MtlsSpamNetworksView ask to only reference their version.
+        spam_networks_ref = request.query_params.get('spam_networks') == 'version'
+        etag, policy = ping_policy.get_policy(device, spam_networks_ref)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(policy, headers={'ETag': etag})
 
     def post(self, request, *args, **kwargs):
-        data = request.data
-        device = Device.objects.get(device_id=request.device_id)
-        device.last_ping = timezone.now()
-        device.agent_version = data.get('agent_version')
-        device.audit_files = data.get('audit_files', [])
-        os_release = data.get('os_release', {})
-        device.auto_upgrades = data.get('auto_upgrades')
-        if 'deb_packages' in data:
-            deb_packages = data['deb_packages']
-            device.deb_packages_hash = deb_packages['hash']
-            device.set_deb_packages(deb_packages['packages'], os_release)
-        kernel_deb_package = data.get('kernel_package')
-        if kernel_deb_package:
-            device.kernel_deb_package = device.deb_packages.get(name=kernel_deb_package['name'],
-                                                                version=kernel_deb_package['version'],
-                                                                arch=kernel_deb_package['arch'],
-                                                                os_release_codename=os_release['codename'])
+        start = time.monotonic()
+        data = ping_ingest.normalize_ping_data(request.data)
+        response = {'message': 'pong'}
+        pending_changes = False
+        if settings.PING_WRITE_BEHIND:
+            ping_ingest.enqueue_ping(request.device_id, data)
         else:
-            device.kernel_deb_package = None
-        device.reboot_required = data.get('reboot_required')
-        device.cpu = data.get('cpu', {})
-        device.os_release = os_release
-        device.mysql_root_access = data.get('mysql_root_access')
-        device.default_password_users = data.get('default_password_users')
-        device_info_object, _ = DeviceInfo.objects.get_or_create(device=device)
-        device_info_object.device__last_ping = timezone.now()
-        device_info_object.device_operating_system_version = data.get('device_operating_system_version')
-        device_info_object.fqdn = data.get('fqdn')
-        device_info_object.ipv4_address = data.get('ipv4_address')
-        device_info_object.device_manufacturer = data.get('device_manufacturer')
-        device_info_object.device_model = data.get('device_model')
-        device_info_object.selinux_state = data.get('selinux_status', {})
-        device_info_object.app_armor_enabled = data.get('app_armor_enabled')
-        device_info_object.logins = data.get('logins', {})
-        processes = data.get('processes')
-        if processes:
-            # Convert from list to dict.
-            device_info_object.processes = {e['pid']: (e['name'], e['username'], e['cmdline'], e.get('container'))
-                                            for e in processes}
+            device = request.device
+            package_set_id = device.package_set_id
+            response.update(ping_ingest.apply_pings([(device, data, timezone.now())])[0])
+            # Ask to come back soon with the full package list, or for the new packages' vulnerabilities.
+            pending_changes = response.get('deb_packages_resync', False) or device.package_set_id != package_set_id
+        if heartbeat.is_enabled():
+            heartbeat.record_latency(time.monotonic() - start)
+            response['next_ping_in'] = heartbeat.get_next_ping_in(pending_changes)
+        return Response(response)
+
+
+class BulkPingView(APIView):
+    """
+    Endpoint for gateways sending heartbeats on behalf of a number of their owner's devices:
+    {"pings": [{"device_id": ..., "data": <the MtlsPingView payload>}, ...]}
+    The pings are applied in one batch. The response has a result for every ping, in the same order:
+    the MtlsPingView response or {"error": ...}.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [GatewayKeyAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
+
+    def post(self, request, *args, **kwargs):
+        pings = request.data.get('pings') if isinstance(request.data, dict) else None
+        if not isinstance(pings, list):
+            raise ValidationError({'pings': 'A list of pings expected.'})
+        if len(pings) > settings.BULK_PING_MAX_SIZE:
+            raise ValidationError({'pings': f'At most {settings.BULK_PING_MAX_SIZE} pings allowed.'})
+
+        device_ids = [ping.get('device_id') if isinstance(ping, dict) and isinstance(ping.get('device_id'), str)
+                      else None for ping in pings]
+        devices = {device.device_id: device for device in
+                   Device.objects.filter(owner=request.user, device_id__in=filter(None, device_ids))}
+        results = [None] * len(pings)
+        valid = []  # (index, (device, data, ping time))
+        seen = set()
+        now = timezone.now()
+        for i, (device_id, ping) in enumerate(zip(device_ids, pings)):
+            if device_id not in devices:
+                results[i] = {'device_id': device_id, 'error': 'Device not found.'}
+            elif device_id in seen:
+                results[i] = {'device_id': device_id, 'error': 'Duplicate device_id.'}
+            else:
+                seen.add(device_id)
+                try:
+                    valid.append((i, (devices[device_id], ping_ingest.normalize_ping_data(ping.get('data')), now)))
+                except ValidationError as e:
+                    results[i] = {'device_id': device_id, 'error': e.detail}
+
+        if settings.PING_WRITE_BEHIND:
+            for i, (device, data, _) in valid:
+                ping_ingest.enqueue_ping(device.device_id, data)
+            applied = [{}] * len(valid)
         else:
-            device_info_object.processes = {}
-        device_info_object.default_password = data.get('default_password')
-        device_info_object.save()
-
-        portscan_object, _ = PortScan.objects.get_or_create(device=device)
-        scan_info = data.get('scan_info', [])
-        if isinstance(scan_info, str):
-            scan_info = json.loads(scan_info)
-        # Add missing IP protocol version info.
-        for record in scan_info:
-            if 'ip_version' not in record:
-                ipaddr = IPAddress(record['host'])
-                record['ip_version'] = ipaddr.version
-        portscan_object.scan_info = scan_info
-        portscan_object.netstat = data.get('netstat', [])
-        portscan_object.save()
-        firewall_state, _ = FirewallState.objects.get_or_create(device=device)
-        firewall_rules = data.get('firewall_rules', {})
-        if isinstance(firewall_rules, str):
-            firewall_rules = json.loads(firewall_rules)
-        firewall_state.rules = firewall_rules
-        firewall_state.save()
-
-        device.update_trust_score = True
-        device.save(update_fields=['last_ping', 'agent_version', 'audit_files', 'deb_packages_hash',
-                                   'update_trust_score', 'os_release', 'auto_upgrades',
-                                   'mysql_root_access', 'cpu', 'kernel_deb_package', 'reboot_required',
-                                   'default_password_users'])
-        # Un-snooze recommended actions which were "Fixed" (i.e. snoozed until next ping)
-        device.recommendedactionstatus_set.filter(status=RecommendedAction.Status.SNOOZED_UNTIL_PING) \
-            .update(status=RecommendedAction.Status.AFFECTED)
-        device.generate_recommended_actions()
-
-        if datastore_client:
-            # logins may have empty string as a key. DataStore doesn't accept that.
-            logins = data.get('logins', [])
-            if type(logins) is dict:
-                logins = [{'username': k, 'failed': v['failed'], 'success': v['success']} for k, v in logins.items()]
-            data['logins'] = logins
-            task_key = datastore_client.key('Ping')
-            entity = google_cloud_helper.dicts_to_ds_entities(data, task_key)
-            entity['device_id'] = device.device_id  # Will be indexed.
-            entity['last_ping'] = timezone.now()  # Will be indexed.
-            datastore_client.put(entity)
-
-        return Response({'message': 'pong'})
+            applied = ping_ingest.apply_pings_safely([ping for _, ping in valid])
+        for (i, (device, _, _)), result in zip(valid, applied):
+            if result is None:
+                results[i] = {'device_id': device.device_id, 'error': 'Ping failed.'}
+            else:
+                results[i] = {'device_id': device.device_id, 'message': 'pong', **result}
+        return Response({'results': results})
+
+
+class MtlsSpamNetworksView(APIView):
+    """Endpoint for getting the current spam networks blocklist."""
+    permission_classes = [AllowAny]
+    authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
+
+    def get(self, request, *args, **kwargs):
+        spam_networks = blocklist.get_current()
+        etag = f'"{spam_networks.digest}"'
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response({'version': spam_networks.version, 'networks': spam_networks.networks},
+                        headers={'ETag': etag})
 
 
 class MtlsRenewCertView(APIView):
     """Renewal of certificate."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
 
     def post(self, request, *args, **kwargs):
         device_id = request.device_id
-        device = Device.objects.get(device_id=device_id)
+        device = request.device
 
         serializer = RenewCertSerializer(device, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
@@ -227,9 +214,11 @@ class MtlsDeviceMetadataView(APIView):
     """Return device specific metadata."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
 
     def get(self, request, *args, **kwargs):
-        device = Device.objects.get(device_id=request.device_id)
+        device = request.device
         if device.claimed:
             metadata = device.deviceinfo.device_metadata
             metadata['device-name'] = device.name
@@ -245,9 +234,11 @@ class MtlsCredsView(APIView):
     """Return all user's credentials."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
 
     def get(self, request, *args, **kwargs):
-        device = Device.objects.get(device_id=request.device_id)
+        device = request.device
         if device.owner:
             qs = device.owner.credentials.filter(tags__in=device.tags.tags).distinct()
         else:
@@ -268,6 +259,8 @@ class MtlsTesterView(APIView):
     """Return the Device ID of the sender."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
 
     def get(self, request, *args, **kwargs):
         return Response({'message': 'Hello {}'.format(request.device_id)})
@@ -277,17 +270,17 @@ class IsDeviceClaimedView(RetrieveAPIView):
     """Return claimed status of a node."""
     permission_classes = [AllowAny]
     authentication_classes = [MTLSAuthentication]
+    parser_classes = [AgentJSONParser]
+    renderer_classes = [AgentJSONRenderer]
     queryset = Device.objects.all()
     serializer_class = IsDeviceClaimedSerializer
 
     def get_object(self):
         """
-        Standard `get_object` method overwritten in order to get device_id
+        Standard `get_object` method overwritten in order to get the device
          from the request instance which received it from MTLSAuthentication.
         """
-        queryset = self.filter_queryset(self.get_queryset())
-        obj = get_object_or_404(queryset, **{'device_id': self.request.device_id})
-        return obj
+        return self.request.device
 
 
 class RenewExpiredCertView(UpdateAPIView):
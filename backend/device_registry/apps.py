@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DeviceRegistryConfig(AppConfig):
     name = 'device_registry'
+
+    def ready(self):
+        # Connect the cache invalidation receivers.
+        from . import authentication, ping_policy  # noqa: F401
@@ -1,18 +1,57 @@
 import re
+import threading
+import uuid
 
 from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
 
+from cachetools import TTLCache
 from rest_framework.authentication import BaseAuthentication
 from rest_framework import exceptions
 
-from device_registry.models import Device
+from device_registry.models import Device, GatewayKey
+
+CN_DOMAIN = re.match(r'.{1}\.(?P<domain>.*)', settings.COMMON_NAME_PREFIX).groupdict()['domain']
+SUBJECT_DN_RE = re.compile(r'.*CN=(.*.{cn_domain})'.format(cn_domain=re.escape(CN_DOMAIN)), re.M | re.I)
+
+# Known device ids mapped to Device pks. Deleted devices are removed from it only in the process which deleted them,
+# other processes forget them when the TTL expires.
+_known_devices = TTLCache(maxsize=settings.MTLS_AUTH_CACHE_SIZE, ttl=settings.MTLS_AUTH_CACHE_TTL)
+_known_devices_lock = threading.Lock()
+
+
+def _load_device(device_id, pk=None):
+    """
+    Load the device and remember its id. If `pk` is given try it first, it may be stale though.
+    """
+    device = Device.objects.filter(pk=pk).first() if pk is not None else None
+    if device is None or device.device_id != device_id:
+        device = Device.objects.filter(device_id=device_id).first()
+    with _known_devices_lock:
+        if device is None:
+            _known_devices.pop(device_id, None)
+        else:
+            _known_devices[device_id] = device.pk
+    if device is None:
+        raise exceptions.PermissionDenied()
+    return device
+
+
+@receiver(post_delete, sender=Device, dispatch_uid='mtls_authentication_device_deleted')
+def forget_device(sender, instance, **kwargs):
+    with _known_devices_lock:
+        _known_devices.pop(instance.device_id, None)
 
 
 class MTLSAuthentication(BaseAuthentication):
     """
     Custom authentication backend for mutual TLS (mTLS) auth
      based on http headers data.
-    Passes further device_id in a newly added request property.
+    Passes further device_id and device in newly added request properties.
+    For recently seen devices the device is loaded lazily, so views which
+     only need device_id don't query DB at all.
     It's not a real authentication (in terms of DRF),
      just few checks done before a view call.
     """
@@ -21,20 +60,45 @@ class MTLSAuthentication(BaseAuthentication):
         if not request.META.get('HTTP_SSL_CLIENT_VERIFY') == 'SUCCESS':
             raise exceptions.PermissionDenied()
 
-        cn_domain = re.match(r'.{1}\.(?P<domain>.*)', settings.COMMON_NAME_PREFIX).groupdict()['domain']
-
-        matchObj = re.match(
-            r'.*CN=(.*.{cn_domain})'.format(cn_domain=cn_domain),
-            request.META.get('HTTP_SSL_CLIENT_SUBJECT_DN'),
-            re.M | re.I)
+        matchObj = SUBJECT_DN_RE.match(request.META.get('HTTP_SSL_CLIENT_SUBJECT_DN', ''))
         if not matchObj:
             raise exceptions.PermissionDenied()
 
         cn = matchObj.group(1)
         if not cn.endswith(settings.COMMON_NAME_PREFIX):
             raise exceptions.PermissionDenied()
-        if not Device.objects.filter(device_id=cn).exists():
-            raise exceptions.PermissionDenied()
 
+        with _known_devices_lock:
+            pk = _known_devices.get(cn)
+        if pk is None:
+            request.device = _load_device(cn)
+        else:
+            request.device = SimpleLazyObject(lambda: _load_device(cn, pk))
         request.device_id = cn
         return None
+
+
+class GatewayKeyAuthentication(BaseAuthentication):
+    """
+    Authentication of gateways by a GatewayKey passed in the header:
+     Authorization: Gateway <key>
+    The request is authenticated as the key owner.
+    """
+    keyword = 'Gateway'
+
+    def authenticate(self, request):
+        auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+        if not auth or auth[0] != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid gateway key header.')
+        try:
+            key = GatewayKey.objects.select_related('owner').get(key=uuid.UUID(auth[1]))
+        except (ValueError, GatewayKey.DoesNotExist):
+            raise exceptions.AuthenticationFailed('Invalid gateway key.')
+        if not key.owner.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return key.owner, key
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,104 @@
+"""
+Spam networks blocklist.
+
+The list is compacted (nested and adjacent CIDRs are merged) and stored in DB with an incrementing version, so it can
+be reloaded without a redeploy (see the `reload_spam_networks` management command) and agents which support it can
+download it only when its version changes. Until a list is loaded into DB the one bundled with the code
+(settings.SPAM_NETWORKS) is served as version 0.
+"""
+import hashlib
+import re
+import time
+from typing import List, NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from netaddr import AddrFormatError, IPNetwork, cidr_merge
+
+from .models import SpamNetworks
+
+# IPv4 networks only, the same ones settings.SPAM_NETWORKS accepts: agents don't support others.
+NETWORK_RE = re.compile(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.0/\d{1,2})')
+
+
+class Blocklist(NamedTuple):
+    version: int
+    digest: str
+    networks: List[str]  # CIDR strings.
+    block_networks: list  # The same networks in the PortScan.block_networks format.
+
+
+def compact(networks):
+    """
+    Merge nested and adjacent networks, invalid and IPv6 ones are skipped.
+    :param networks: an iterable of CIDR strings.
+    :return: a sorted list of CIDR strings.
+    """
+    parsed = []
+    for network in networks:
+        try:
+            network = IPNetwork(network)
+        except (AddrFormatError, ValueError):
+            continue
+        if network.version == 4:
+            parsed.append(network)
+    return [str(network) for network in cidr_merge(parsed)]
+
+
+def parse(text):
+    """
+    Parse a blocklist in the Spamhaus DROP format: one CIDR per line followed by an optional comment, and comment lines
+    starting with ';'.
+    :return: a list of CIDR strings.
+    """
+    return [match.group(1) for match in map(NETWORK_RE.match, text.splitlines()) if match]
+
+
+def get_digest(networks):
+    return hashlib.sha1(','.join(networks).encode()).hexdigest()
+
+
+def load(networks):
+    """
+    Compact the networks and store them as a new blocklist version unless the latest version is the same.
+    :param networks: an iterable of CIDR strings.
+    :return: (SpamNetworks, created)
+    """
+    networks = compact(networks)
+    digest = get_digest(networks)
+    with transaction.atomic():
+        latest = SpamNetworks.objects.select_for_update().order_by('-version').first()
+        if latest is not None and latest.digest == digest:
+            return latest, False
+        spam_networks = SpamNetworks.objects.create(version=latest.version + 1 if latest else 1,
+                                                    networks=networks, digest=digest)
+    clear_cache()
+    return spam_networks, True
+
+
+_cache = {'blocklist': None, 'checked_at': 0.0}
+
+
+def clear_cache():
+    _cache.update(blocklist=None, checked_at=0.0)
+
+
+def get_current():
+    """
+    Get the current blocklist. The list is kept in memory, its version is checked against DB at most once per
+    SPAM_NETWORKS_CHECK_INTERVAL seconds.
+    :return: Blocklist
+    """
+    blocklist = _cache['blocklist']
+    now = time.monotonic()
+    if blocklist is None or now - _cache['checked_at'] >= settings.SPAM_NETWORKS_CHECK_INTERVAL:
+        version = SpamNetworks.objects.aggregate(Max('version'))['version__max'] or 0
+        if blocklist is None or blocklist.version != version:
+            if version:
+                networks = SpamNetworks.objects.get(version=version).networks
+            else:
+                networks = compact(network for network, _ in settings.SPAM_NETWORKS)
+            blocklist = Blocklist(version, get_digest(networks), networks, [[network, False] for network in networks])
+        _cache.update(blocklist=blocklist, checked_at=now)
+    return blocklist
@@ -1,53 +1,42 @@
 import logging
 import gzip
-import time
-import xml.dom.minidom
 from urllib.request import urlopen, Request
+from xml.etree import ElementTree
 
-from django.conf import settings
+from device_registry.models import Vulnerability
+from device_registry.celery_tasks.common import sync_vulnerabilities
 
-import redis
+logger = logging.getLogger('django')
 
-from device_registry.models import DebPackage, Vulnerability
 
-logger = logging.getLogger('django')
+SEVERITIES = {
+    'low': Vulnerability.Urgency.LOW,
+    'medium': Vulnerability.Urgency.MEDIUM,
+    'important': Vulnerability.Urgency.HIGH,
+    'critical': Vulnerability.Urgency.HIGH
+}
 
 
-def fetch_vulnerabilities():
+def parse_updateinfo(stream):
     """
-    Downloads and parses a list of Amazon Linux vulnerabilities from Amazon repo.
-    :return: the number of Vulnerability objects stored in the database.
+    Parse updateinfo.xml in a single streaming pass. Every <update> element is discarded once processed, so the
+    memory use doesn't depend on the file size.
+    :param stream: a binary file object with uncompressed updateinfo.xml.
+    :return: {(cve, package name): Vulnerability}
     """
-    logger.info('started.')
     vulnerabilities = {}
-    mirror_url = 'https://cdn.amazonlinux.com/2/core/latest/x86_64/mirror.list'
-    response = urlopen(Request(mirror_url))
-    mirror_list = response.read()
-    # At the moment there's only one mirror in this list, so no use looping over it.
-    mirror = mirror_list.decode().splitlines()[0]
-    url = mirror + '/repodata/updateinfo.xml.gz'
-    logger.info('fetching data...')
-    response = urlopen(Request(url))
-    compressed_data = response.read()
-    data = gzip.decompress(compressed_data).decode()
-    xmldoc = xml.dom.minidom.parseString(data)
-    logger.info('parsing data...')
-    for update in xmldoc.getElementsByTagName('update'):
-        severity = update.getElementsByTagName('severity')[0].firstChild.data
-        alas = update.getElementsByTagName('id')[0].firstChild.data
-        for ref in update.getElementsByTagName('reference'):
-            for pkg in update.getElementsByTagName('package'):
-                cve = ref.getAttribute('id')
-                pkg_name = pkg.getAttribute('name')
-                pkg_epoch = pkg.getAttribute('epoch')
-                pkg_version = pkg.getAttribute('version')
-                pkg_release = pkg.getAttribute('release')
-                pkg_severity = {'low': Vulnerability.Urgency.LOW,
-                                'medium': Vulnerability.Urgency.MEDIUM,
-                                'important': Vulnerability.Urgency.HIGH,
-                                'critical': Vulnerability.Urgency.HIGH}[severity]
-                full_version = f'{pkg_epoch}:{pkg_version}-{pkg_release}'
-                print((cve, severity, pkg_name, pkg_epoch, pkg_version, pkg_release))
+    context = ElementTree.iterparse(stream, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event != 'end' or element.tag != 'update':
+            continue
+        pkg_severity = SEVERITIES[element.findtext('severity')]
+        alas = element.findtext('id')
+        packages = [(pkg.get('name'), f'{pkg.get("epoch")}:{pkg.get("version")}-{pkg.get("release")}')
+                    for pkg in element.iter('package')]
+        for ref in element.iter('reference'):
+            cve = ref.get('id')
+            for pkg_name, full_version in packages:
                 key = (cve, pkg_name)
                 if key in vulnerabilities:
                     v = vulnerabilities[key]
@@ -58,7 +47,7 @@ def fetch_vulnerabilities():
                     if v.urgency < pkg_severity:
                         v.urgency = pkg_severity
                     if Vulnerability.RpmVersion(v.unstable_version) < Vulnerability.RpmVersion(full_version):
-                        logger.info(f'{alas} {pkg_name}: {v.unstable_version} < {full_version}')
+                        logger.debug(f'{alas} {pkg_name}: {v.unstable_version} < {full_version}')
                         v.unstable_version = full_version
                 else:
                     vulnerabilities[key] = Vulnerability(
@@ -71,14 +60,27 @@ def fetch_vulnerabilities():
                         fix_available=True,
                         os_release_codename='amzn2'
                     )
+        # Drop the processed <update> (and its siblings parsed so far).
+        root.clear()
+    return vulnerabilities
+
+
+def fetch_vulnerabilities():
+    """
+    Downloads and parses a list of Amazon Linux vulnerabilities from Amazon repo.
+    :return: the number of Vulnerability objects stored in the database.
+    """
+    logger.info('started.')
+    mirror_url = 'https://cdn.amazonlinux.com/2/core/latest/x86_64/mirror.list'
+    response = urlopen(Request(mirror_url))
+    mirror_list = response.read()
+    # At the moment there's only one mirror in this list, so no use looping over it.
+    mirror = mirror_list.decode().splitlines()[0]
+    url = mirror + '/repodata/updateinfo.xml.gz'
+    logger.info('fetching and parsing data...')
+    with urlopen(Request(url)) as response, gzip.GzipFile(fileobj=response) as stream:
+        vulnerabilities = parse_updateinfo(stream)
     logger.info('saving data...')
-    redis_conn = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
-    with redis_conn.lock('vulns_lock', timeout=60 * 15, blocking_timeout=60 * 5):
-        logger.info('lock acquired.')
-        time.sleep(60 * 3)  # Sleep 3m to allow all running `update_packages_vulnerabilities` tasks finish.
-        logger.info('sleep ended.')
-        Vulnerability.objects.filter(os_release_codename='amzn2').delete()
-        Vulnerability.objects.bulk_create(vulnerabilities.values())
-        DebPackage.objects.filter(os_release_codename='amzn2').update(processed=False)
+    sync_vulnerabilities(vulnerabilities.values(), ['amzn2'])
     logger.info('finished.')
-    return len(vulnerabilities)
\ No newline at end of file
+    return len(vulnerabilities)
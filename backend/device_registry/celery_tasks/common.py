@@ -1,14 +1,22 @@
+import datetime
 import logging
+import time
+import uuid
 from collections import defaultdict
+from itertools import chain
 
 from django.conf import settings
+from django.db import connection, transaction
 from django.db.models import Q
+from django.utils import timezone
 
+from celery import group
 import redis
 
-from device_registry.models import DebPackage, Device, RecommendedAction, RecommendedActionStatus, Vulnerability, \
-    DEBIAN_SUITES, UBUNTU_SUITES
-from device_registry.recommended_actions import CVEAction
+from device_registry import vulnerability_index
+from device_registry.models import CveSummary, DebPackage, Device, PackageSet, RecommendedAction, RecommendedActionStatus, \
+    Vulnerability, VulnerabilityGeneration, DEBIAN_SUITES, UBUNTU_SUITES
+from device_registry.recommended_actions import CVEAction, CpuVulnerableAction
 from device_registry.models import UBUNTU_KERNEL_PACKAGES_RE_PATTERN
 from profile_page.models import Profile
 
@@ -43,97 +51,340 @@ def send_devices_to_trust_score_update(task):
     return len(device_ids)
 
 
-def update_packages_vulnerabilities(batch):
+def update_packages_vulnerabilities(batch, run_id=None):
+    """
+    Match a batch of packages against the vulnerabilities.
+    :param run_id: the packages vulnerabilities update run the batch was sent by (see
+     send_packages_to_vulns_update()). The run's progress is updated.
+    :return: (the number of packages matched, the number of their vulnerability relations). Both are 0 if the batch
+     was already processed or will be processed again because the vulnerabilities changed.
+    """
+    try:
+        result = _update_packages_vulnerabilities(batch)
+    except Exception:
+        # The batch's packages are left unprocessed for the next run.
+        _record_vulns_update_progress(run_id, 'failed', len(batch))
+        raise
+    _record_vulns_update_progress(run_id, 'done', len(batch))
+    return result
+
+
+def _update_packages_vulnerabilities(batch):
     logger.info('started. batch size: %d' % len(batch))
+    # Pin the vulnerabilities generation before reading them.
+    generation = VulnerabilityGeneration.get_current().number
     # We store packages as a list in order to prevent its content update during the function run.
     packages = list(DebPackage.objects.filter(id__in=batch, processed=False))
     logger.info('%d packages really need to be processed' % len(packages))
     if not packages:
-        return 0
-
-    # Get only vulns we really need and put them to the dict.
-    package_info_pairs = {(package.source_name, package.os_release_codename) for package in packages}
-    q_objects = Q()
-    for package_info in package_info_pairs:
-        q_objects.add(Q(package=package_info[0], os_release_codename=package_info[1]), Q.OR)
-    vulns_list = list(Vulnerability.objects.filter(q_objects))
-    vulns_dict = defaultdict(list)
-    for vuln in vulns_list:
-        vulns_dict[(vuln.package, vuln.os_release_codename)].append(vuln)
-
-    # Marking the package as processed BEFORE the actual processing allows us correctly handle
-    # the situation when the vulns DB was updated during the package processing.
-    package_ids = [package.id for package in packages]
-    DebPackage.objects.filter(id__in=package_ids).update(processed=True)
+        return 0, 0
 
-    Relation = DebPackage.vulnerabilities.through
-    relations = []
+    package_ids = [package.id for package in packages]
+    relations = set()
     counter = 0
-    for package in packages:
-        vulns = vulns_dict[(package.source_name, package.os_release_codename)]
-        for vuln in vulns:
-            if vuln.is_vulnerable(package.source_version) and vuln.fix_available:
-                relations.append(Relation(debpackage_id=package.id, vulnerability_id=vuln.id))
-        counter += 1
-    # TODO: Execute ORM requests below in one transaction.
-    Relation.objects.filter(debpackage_id__in=package_ids).delete()
-    Relation.objects.bulk_create(relations, batch_size=10000, ignore_conflicts=True)
-    logger.info('finished')
+    try:
+        for package, vuln_ids in vulnerability_index.match_packages(packages, generation):
+            relations.update((package.id, vuln_id) for vuln_id in vuln_ids)
+            counter += 1
+    except vulnerability_index.GenerationChanged:
+        # Matching will be stopped below.
+        pass
+    with transaction.atomic():
+        # Blocks imports until the end of the transaction.
+        if VulnerabilityGeneration.get_current(for_update=True).number != generation:
+            # The vulnerabilities were changed by an import: the results may be stale or refer to deleted ones.
+            logger.info('vulnerabilities changed, the batch will be processed again.')
+            return 0, 0
+        inserted, deleted = _replace_relations(package_ids, relations)
+        # Packages are marked processed together with saving their relations, so the packages of a batch which
+        # never finished (e.g. its worker was killed) are left to the next run.
+        DebPackage.objects.filter(id__in=package_ids).update(processed=True)
+    logger.info('finished. relations: %d inserted, %d deleted, %d unchanged' %
+                (inserted, deleted, len(relations) - inserted))
     return counter, len(relations)
 
 
+def _replace_relations(package_ids, relations):
+    """
+    Replace the package-vulnerability relations of the given packages, writing only the difference.
+    Should be called in a transaction.
+    :param relations: a set of (debpackage_id, vulnerability_id) pairs.
+    :return: (inserted, deleted) numbers of relations.
+    """
+    Relation = DebPackage.vulnerabilities.through
+    existing = set(Relation.objects.filter(debpackage_id__in=package_ids)
+                   .values_list('debpackage_id', 'vulnerability_id'))
+    to_delete = existing - relations
+    to_insert = relations - existing
+    inserted = deleted = 0
+    with connection.cursor() as cursor:
+        if to_delete:
+            cursor.execute(f"""
+                DELETE FROM {Relation._meta.db_table} AS r
+                USING unnest(%s::integer[], %s::integer[]) AS t(debpackage_id, vulnerability_id)
+                WHERE r.debpackage_id = t.debpackage_id AND r.vulnerability_id = t.vulnerability_id
+            """, [list(pair) for pair in zip(*to_delete)])
+            deleted = cursor.rowcount
+        if to_insert:
+            cursor.execute(f"""
+                INSERT INTO {Relation._meta.db_table} (debpackage_id, vulnerability_id)
+                SELECT * FROM unnest(%s::integer[], %s::integer[])
+                ON CONFLICT DO NOTHING
+            """, [list(pair) for pair in zip(*to_insert)])
+            inserted = cursor.rowcount
+    return inserted, deleted
+
+
+VULNERABILITY_FIELDS = ['unstable_version', 'other_versions', 'is_binary', 'urgency', 'remote', 'fix_available',
+                        'pub_date']
+
+
+def _vulnerability_values(vuln):
+    pub_date = vuln.pub_date.date() if isinstance(vuln.pub_date, datetime.datetime) else vuln.pub_date
+    return [getattr(vuln, field) for field in VULNERABILITY_FIELDS[:-1]] + [pub_date]
+
+
+def sync_vulnerabilities(vulnerabilities, codenames):
+    """
+    Replace the stored vulnerabilities of the given distro codenames with the new ones, writing only the difference.
+    Vulnerabilities are matched by (os_release_codename, name, package). Only the packages whose source names appear
+    in the changed vulnerabilities are marked for reprocessing.
+    :param vulnerabilities: an iterable of unsaved Vulnerability objects.
+    :param codenames: the distro codenames the vulnerabilities belong to.
+    :return: (created, updated, deleted) numbers of vulnerabilities.
+    """
+    new = {(v.os_release_codename, v.name, v.package): v for v in vulnerabilities}
+    with transaction.atomic():
+        # Imports are serialized by the generation row lock.
+        generation = VulnerabilityGeneration.get_current(for_update=True)
+        existing = {(v.os_release_codename, v.name, v.package): v
+                    for v in Vulnerability.objects.filter(os_release_codename__in=codenames)}
+        to_create = [v for key, v in new.items() if key not in existing]
+        to_update = []
+        for key, v in new.items():
+            old = existing.get(key)
+            if old is not None and _vulnerability_values(old) != _vulnerability_values(v):
+                v.pk = old.pk
+                to_update.append(v)
+        to_delete = [key for key in existing if key not in new]
+
+        changed_sources = defaultdict(set)
+        for v in chain(to_create, to_update):
+            changed_sources[v.os_release_codename].add(v.package)
+        for codename, _, package in to_delete:
+            changed_sources[codename].add(package)
+
+        if changed_sources:
+            Vulnerability.objects.filter(pk__in=[existing[key].pk for key in to_delete]).delete()
+            Vulnerability.objects.bulk_update(to_update, VULNERABILITY_FIELDS, batch_size=10000)
+            Vulnerability.objects.bulk_create(to_create, batch_size=10000)
+            for codename, sources in changed_sources.items():
+                DebPackage.objects.filter(os_release_codename=codename, source_name__in=sources) \
+                    .update(processed=False)
+            CveSummary.refresh({v.name for v in chain(to_create, to_update)} | {name for _, name, _ in to_delete})
+            # Publish the new generation.
+            generation.number += 1
+            generation.save(update_fields=['number'])
+    logger.info('%d vulnerabilities created, %d updated, %d deleted.' % (len(to_create), len(to_update),
+                                                                         len(to_delete)))
+    return len(to_create), len(to_update), len(to_delete)
+
+
+CVE_RA_BATCH_SIZE = 1000  # The number of CVEAction's whose contexts are computed with one query.
+
+
 def update_cve_ra():
     """
     Some packages may have new vulnerabilties, or new packages may have been added.
     Create new CVEAction's if needed.
-    Update contexts of all existing CVEAction's to contain the correct list of affected packages and severity.
+    Update contexts of existing CVEAction's to contain the correct list of affected packages and severity. Only the
+    CVEAction's whose context or severity has changed are saved.
     :return: None
     """
     logger.info('updating CVEAction')
-    RecommendedActionStatus.update_all_devices([CVEAction])
-    ras = RecommendedAction.objects.filter(action_class='CVEAction')
-    for ra in ras:
-        ra.action_context = CVEAction.get_context(ra.action_param)
-        ra.action_severity = CVEAction.severity(ra.action_param)
-    RecommendedAction.objects.bulk_update(ras, ['action_context', 'action_severity'])
-    logger.info('done.')
+    started = time.monotonic()
+    # CpuVulnerableAction also depends on vulnerabilities, so it's not updated on ping when they change.
+    RecommendedActionStatus.update_all_devices([CVEAction, CpuVulnerableAction])
+    logger.info('statuses updated in %.1fs.', time.monotonic() - started)
+
+    ras = list(RecommendedAction.objects.filter(action_class='CVEAction')
+               .only('id', 'action_param', 'action_context', 'action_severity'))
+    contexts_time = severities_time = 0
+    changed = []
+    for i in range(0, len(ras), CVE_RA_BATCH_SIZE):
+        batch = ras[i:i + CVE_RA_BATCH_SIZE]
+        params = [ra.action_param for ra in batch]
+        started = time.monotonic()
+        contexts = CVEAction.get_contexts(params)
+        contexts_time += time.monotonic() - started
+        started = time.monotonic()
+        severities = CVEAction.severities(params)
+        severities_time += time.monotonic() - started
+        for ra in batch:
+            # A CVE may not affect any packages anymore, its context is kept then.
+            context = contexts.get(ra.action_param, ra.action_context)
+            severity = severities[ra.action_param].value
+            if context != ra.action_context or severity != ra.action_severity:
+                ra.action_context = context
+                ra.action_severity = severity
+                changed.append(ra)
+    logger.info('contexts computed in %.1fs, severities in %.1fs.', contexts_time, severities_time)
+
+    started = time.monotonic()
+    RecommendedAction.objects.bulk_update(changed, ['action_context', 'action_severity'], batch_size=CVE_RA_BATCH_SIZE)
+    logger.info('done. %d of %d updated in %.1fs.', len(changed), len(ras), time.monotonic() - started)
 
 
-def send_packages_to_vulns_update(task):
+VULNS_UPDATE_KEY = 'vulns_update'  # The current packages vulnerabilities update run id.
+VULNS_UPDATE_BATCH_SIZE = 500
+VULNS_UPDATE_GROUP_SIZE = 20  # The number of batches sent in one celery group.
+VULNS_UPDATE_DISPATCH_TIME = 60 * 2  # The dispatcher saves its position and stops after this time.
+VULNS_UPDATE_RUN_TTL = 60 * 60 * 6  # Runs not finished within this time are abandoned.
+VULNS_UPDATE_STALL_TIME = 60 * 30  # Runs without any progress for this time are abandoned.
+
+
+def _redis_connection():
+    return redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
+
+
+def _packages_to_process():
+    return DebPackage.objects.filter(
+        Q(os_release_codename__in=DEBIAN_SUITES + ('amzn2',)) |
+        Q(os_release_codename__in=UBUNTU_SUITES) & ~Q(name__regex=UBUNTU_KERNEL_PACKAGES_RE_PATTERN),
+        processed=False)
+
+
+def _record_vulns_update_progress(run_id, field, n):
+    if run_id is None:
+        return
+    redis_conn = _redis_connection()
+    key = f'{VULNS_UPDATE_KEY}:{run_id}'
+    redis_conn.hincrby(key, field, n)
+    redis_conn.hset(key, 'updated', int(time.time()))
+    redis_conn.expire(key, VULNS_UPDATE_RUN_TTL)
+
+
+def get_vulns_update_progress(redis_conn=None):
+    """
+    Get the progress of the current packages vulnerabilities update run.
+    :return: a dict with run_id, total, done and failed numbers of packages, `dispatched` (True if all the packages of
+     the run were sent to the workers), `updated` (the timestamp of the last progress) and the dispatcher's position
+     (codename, source_name, id), or None if no run is in progress.
+    """
+    redis_conn = redis_conn or _redis_connection()
+    run_id = redis_conn.get(VULNS_UPDATE_KEY)
+    if run_id is None:
+        return None
+    run_id = run_id.decode()
+    progress = {key.decode(): value.decode() for key, value in
+                redis_conn.hgetall(f'{VULNS_UPDATE_KEY}:{run_id}').items()}
+    if not progress:
+        return None
+    return {
+        'run_id': run_id,
+        'total': int(progress.get('total', 0)),
+        'done': int(progress.get('done', 0)),
+        'failed': int(progress.get('failed', 0)),
+        'dispatched': progress.get('dispatched') == '1',
+        'updated': int(progress.get('updated', 0)),
+        'position': (progress['codename'], progress['source_name'], int(progress['id'])) if 'id' in progress else None
+    }
+
+
+def _dispatch_packages(redis_conn, task, ra_task):
+    """
+    Send unprocessed packages to `task` in batches, starting a new run or continuing the current one from the saved
+    position. Packages are walked with keyset pagination by (os_release_codename, source_name, id).
+    :return: the number of packages sent.
+    """
+    progress = get_vulns_update_progress(redis_conn)
+    if progress is not None and progress['dispatched']:
+        if progress['done'] + progress['failed'] < progress['total']:
+            if time.time() - progress['updated'] < VULNS_UPDATE_STALL_TIME:
+                logger.info('run %s: %d of %d packages processed, %d failed.' %
+                            (progress['run_id'], progress['done'], progress['total'], progress['failed']))
+                return 0
+            # Some batches were lost, their packages are still unprocessed and will be sent by the next run.
+            logger.warning('run %s stalled: %d of %d packages processed, %d failed.' %
+                           (progress['run_id'], progress['done'], progress['total'], progress['failed']))
+        else:
+            logger.info('run %s finished: %d packages processed, %d failed.' %
+                        (progress['run_id'], progress['done'], progress['failed']))
+        redis_conn.delete(VULNS_UPDATE_KEY, f'{VULNS_UPDATE_KEY}:{progress["run_id"]}')
+        ra_task.delay()
+        progress = None
+
+    packages = _packages_to_process().order_by('os_release_codename', 'source_name', 'id')
+    if progress is None:
+        if not packages.exists():
+            return 0
+        run_id = uuid.uuid4().hex
+        position = None
+        redis_conn.set(VULNS_UPDATE_KEY, run_id, ex=VULNS_UPDATE_RUN_TTL)
+        logger.info('run %s started.' % run_id)
+    else:
+        run_id, position = progress['run_id'], progress['position']
+        logger.info('run %s continued.' % run_id)
+    key = f'{VULNS_UPDATE_KEY}:{run_id}'
+
+    started = time.monotonic()
+    sent = 0
+    while True:
+        page = packages
+        if position is not None:
+            codename, source_name, package_id = position
+            page = page.filter(Q(os_release_codename__gt=codename) |
+                               Q(os_release_codename=codename, source_name__gt=source_name) |
+                               Q(os_release_codename=codename, source_name=source_name, id__gt=package_id))
+        page = list(page.values_list('id', 'os_release_codename', 'source_name')[
+                    :VULNS_UPDATE_BATCH_SIZE * VULNS_UPDATE_GROUP_SIZE])
+        if page:
+            ids = [package_id for package_id, _, _ in page]
+            group([task.s(ids[i:i + VULNS_UPDATE_BATCH_SIZE], run_id)
+                   for i in range(0, len(ids), VULNS_UPDATE_BATCH_SIZE)]).apply_async()
+            package_id, codename, source_name = page[-1]
+            position = codename, source_name, package_id
+            redis_conn.hincrby(key, 'total', len(page))
+            redis_conn.hmset(key, {'codename': codename, 'source_name': source_name, 'id': package_id,
+                                   'updated': int(time.time())})
+            sent += len(page)
+            logger.info('%d packages sent to the queue.' % len(page))
+        if len(page) < VULNS_UPDATE_BATCH_SIZE * VULNS_UPDATE_GROUP_SIZE:
+            redis_conn.hset(key, 'dispatched', 1)
+            break
+        if time.monotonic() - started >= VULNS_UPDATE_DISPATCH_TIME:
+            logger.info('out of time, the run will be continued.')
+            break
+    redis_conn.expire(key, VULNS_UPDATE_RUN_TTL)
+    return sent
+
+
+def send_packages_to_vulns_update(task, ra_task):
+    """
+    Send unprocessed packages to the matching `task`. A run of the task processes all the packages unprocessed at its
+    start. Big runs are sent in parts by several dispatcher invocations, the run's progress is kept in Redis. When
+    all the packages of the run are processed the recommended actions update (see update_cve_ra()) is queued to
+    `ra_task` and the next run is started. A run which makes no progress for VULNS_UPDATE_STALL_TIME (e.g. a batch
+    was lost) is finished the same way, its unprocessed packages are sent again by the next run.
+    :return: the number of packages sent, -1 if another dispatcher is running.
+    """
     logger.info('started.')
-    redis_conn = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
+    redis_conn = _redis_connection()
     try:
         # Try to acquire the lock.
         # Spend trying 3s.
         # In case of success set the lock's timeout to 2.5m.
-        with redis_conn.lock('vulns_lock', timeout=60 * 2.5, blocking_timeout=3):
+        # Vulnerability imports don't take this lock: the matching tasks detect the changes they make
+        # (see VulnerabilityGeneration).
+        with redis_conn.lock('send_packages_lock', timeout=60 * 2.5, blocking_timeout=3):
             logger.info('lock acquired.')
-            package_ids = list((DebPackage.objects.filter(
-                processed=False, os_release_codename__in=DEBIAN_SUITES + ('amzn2',)) |
-                                DebPackage.objects.filter(processed=False, os_release_codename__in=UBUNTU_SUITES
-                                                          ).exclude(name__regex=UBUNTU_KERNEL_PACKAGES_RE_PATTERN)
-                                ).order_by('os_release_codename', 'source_name').values_list('id', flat=True))
-            logger.info('%d packages to process found.' % len(package_ids))
-            batch_size = 500
-            position = 0
-            # Create batch jobs for multiple workers.
-            while True:
-                batch = package_ids[position: position + batch_size]
-                if not batch:
-                    break
-                task.delay(batch)
-                logger.info('%d packages batch sent to the queue.' % len(batch))
-                position += batch_size
+            sent = _dispatch_packages(redis_conn, task, ra_task)
             logger.info('finished.')
-            n_ids = len(package_ids)
-            if n_ids:
-                update_cve_ra()
-            return n_ids
+            return sent
     except redis.exceptions.LockError:
         logger.info('lock NOT acquired.')
         # Did not managed to acquire the lock within 3s - that means it's acquired by
-        # another instance of the same job or by the `fetch_vulnerabilities` job.
-        # In both cases this job instance shouldn't do anything.
+        # another instance of the same job. This job instance shouldn't do anything.
         return -1
 
 
@@ -144,3 +395,21 @@ def sample_history():
         profile.sample_history()
     logger.info('finished.')
     return profiles.count()
+
+
+PACKAGE_SET_GRACE_PERIOD = datetime.timedelta(hours=1)  # Orphan package sets are kept for this time after use.
+
+
+def delete_orphan_package_sets():
+    """
+    Delete package sets which no device points to anymore and which weren't used for PACKAGE_SET_GRACE_PERIOD.
+    A set fetched by a ping is marked used (see PackageSet.get_or_create_for()), so it isn't deleted before the device
+    is pointed to it. The sets are locked until deleted, a ping reusing one meanwhile waits and creates it again.
+    """
+    with transaction.atomic():
+        orphans = list(PackageSet.objects.select_for_update(of=('self',)).filter(
+            devices__isnull=True, last_used__lt=timezone.now() - PACKAGE_SET_GRACE_PERIOD).values_list('pk', flat=True))
+        _, deleted = PackageSet.objects.filter(pk__in=orphans).delete()
+    deleted = deleted.get(PackageSet._meta.label, 0)
+    logger.info('deleted %d package sets.', deleted)
+    return deleted
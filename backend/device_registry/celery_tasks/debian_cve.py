@@ -1,76 +1,135 @@
+import hashlib
 import logging
 import zlib
+from collections import deque
 from itertools import groupby
+from urllib.error import HTTPError
 from urllib.request import urlopen, Request
-import time
 
 from django.conf import settings
 
-import redis
-
-from device_registry.models import Vulnerability, DebPackage, DEBIAN_SUITES
+from device_registry.models import Vulnerability, VulnerabilityFeed, DEBIAN_SUITES
+from device_registry.celery_tasks.common import sync_vulnerabilities
 
 logger = logging.getLogger('django')
 
+CHUNK_SIZE = 64 * 1024
+
 
-def fetch_vulnerabilities():
+def iter_feed_lines(stream, digest):
     """
-    Download vulnerability index from Debian Security Tracker, parse it and store in db.
+    Decompress a debsecan feed and split it into lines on the fly.
+    :param stream: a binary file object with the zlib-compressed feed.
+    :param digest: a hashlib object updated with the decompressed data.
     """
-    logger.info('started.')
-    # Try to acquire the lock.
-    # Spend trying 5m max.
-    # In case of success set the lock's timeout to 10m.
-    redis_conn = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
-    with redis_conn.lock('vulns_lock', timeout=60 * 10, blocking_timeout=60 * 5):
-        logger.info('lock acquired.')
-        time.sleep(60 * 3)  # Sleep 3m to allow all running `update_packages_vulnerabilities` tasks finish.
-        logger.info('sleep ended.')
-        vulnerabilities = []
-        for suite in DEBIAN_SUITES:  # Only Debian actual suites currently supported.
-            logger.info('fetching data for "%s".' % suite)
-            url = "https://security-tracker.debian.org/tracker/debsecan/release/1/" + suite
-            response = urlopen(Request(url))
-            compressed_data = response.read()
-            data = zlib.decompress(compressed_data).decode()
+    decompressor = zlib.decompressobj()
+    tail = b''
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        data = decompressor.decompress(chunk)
+        digest.update(data)
+        lines = (tail + data).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode()
+    data = decompressor.flush()
+    digest.update(data)
+    for line in (tail + data).split(b'\n'):
+        yield line.decode()
 
-            lines = data.split('\n')
-            lines_split = groupby(lines, lambda e: e.strip() == '')
-            lists = [list(group) for k, group in lines_split if not k]
 
-            vuln_name_list, packages_list = lists[:2]
-            if vuln_name_list.pop(0) != 'VERSION 1':
-                logger.error('ERROR')
-            vuln_names = [(name, desc) for (name, flags, desc) in map(lambda x: x.split(',', 2), vuln_name_list)]
+def parse_feed(lines, suite):
+    """
+    Parse a debsecan feed: a version line and vulnerability names, then a blank line and package records.
+    :param lines: an iterable of lines without line terminators.
+    :return: a generator of Vulnerability objects.
+    """
+    sections = (group for is_blank, group in groupby(lines, lambda e: e.strip() == '') if not is_blank)
+    vuln_name_list = next(sections, iter(()))
+    if next(vuln_name_list, None) != 'VERSION 1':
+        logger.error('unsupported feed version for "%s".' % suite)
+    vuln_names = [name for (name, flags, desc) in map(lambda x: x.split(',', 2), vuln_name_list)]
+
+    for package_desc in next(sections, ()):
+        package, vnum, flags, unstable_version, other_versions = package_desc.split(',', 4)
+
+        other_versions = other_versions.split(' ')
+        if other_versions == ['']:
+            other_versions = []
+        yield Vulnerability(name=vuln_names[int(vnum)],
+                            package=package,
+                            unstable_version=unstable_version,
+                            other_versions=other_versions,
+                            is_binary=flags[0] == 'B',
+                            urgency={' ': Vulnerability.Urgency.NONE,
+                                     'L': Vulnerability.Urgency.LOW,
+                                     'M': Vulnerability.Urgency.MEDIUM,
+                                     'H': Vulnerability.Urgency.HIGH
+                                     }[flags[1]],
+                            remote={'?': None,
+                                    'R': True,
+                                    ' ': False
+                                    }[flags[2]],
+                            fix_available=flags[3] == 'F',
+                            os_release_codename=suite)
 
-            logger.info('parsing data..')
-            for package_desc in packages_list:
-                package, vnum, flags, unstable_version, other_versions = package_desc.split(',', 4)
 
-                other_versions = other_versions.split(' ')
-                if other_versions == ['']:
-                    other_versions = []
-                v = Vulnerability(name=vuln_names[int(vnum)][0],
-                                  package=package,
-                                  unstable_version=unstable_version,
-                                  other_versions=other_versions,
-                                  is_binary=flags[0] == 'B',
-                                  urgency={' ': Vulnerability.Urgency.NONE,
-                                           'L': Vulnerability.Urgency.LOW,
-                                           'M': Vulnerability.Urgency.MEDIUM,
-                                           'H': Vulnerability.Urgency.HIGH
-                                           }[flags[1]],
-                                  remote={'?': None,
-                                          'R': True,
-                                          ' ': False
-                                          }[flags[2]],
-                                  fix_available=flags[3] == 'F',
-                                  os_release_codename=suite)
-                vulnerabilities.append(v)
+def open_feed(feed, opener):
+    """
+    Request a feed, conditionally if it was fetched before.
+    :return: the response or None if the feed wasn't modified.
+    """
+    request = Request(feed.url)
+    if feed.etag:
+        request.add_header('If-None-Match', feed.etag)
+    if feed.last_modified:
+        request.add_header('If-Modified-Since', feed.last_modified)
+    try:
+        return opener(request)
+    except HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def fetch_vulnerabilities(opener=urlopen):
+    """
+    Download vulnerability index from Debian Security Tracker, parse it and store in db.
+    Suites not modified since the last import are skipped.
+    :param opener: a callable which takes a urllib Request and returns a response (urlopen() by default).
+    :return: the number of vulnerabilities in the modified suites.
+    """
+    logger.info('started.')
+    vulnerabilities = []
+    changed_suites = []
+    changed_feeds = []
+    for suite in DEBIAN_SUITES:  # Only Debian actual suites currently supported.
+        logger.info('fetching data for "%s".' % suite)
+        feed, _ = VulnerabilityFeed.objects.get_or_create(url=settings.DEBIAN_SECURITY_TRACKER_URL + suite)
+        response = open_feed(feed, opener)
+        if response is None:
+            logger.info('"%s" not modified.' % suite)
+            continue
+        digest = hashlib.sha256()
+        with response:
+            feed.etag = response.headers.get('ETag', '')
+            feed.last_modified = response.headers.get('Last-Modified', '')
+            logger.info('parsing data..')
+            lines = iter_feed_lines(response, digest)
+            suite_vulnerabilities = list(parse_feed(lines, suite))
+            deque(lines, maxlen=0)  # Read the rest of the feed for the digest.
+        if digest.hexdigest() == feed.digest:
+            logger.info('"%s" not changed.' % suite)
+            feed.save(update_fields=['etag', 'last_modified'])
+            continue
+        feed.digest = digest.hexdigest()
+        vulnerabilities.extend(suite_vulnerabilities)
+        changed_suites.append(suite)
+        changed_feeds.append(feed)
 
+    if changed_suites:
         logger.info('saving data...')
-        Vulnerability.objects.filter(os_release_codename__in=DEBIAN_SUITES).delete()
-        Vulnerability.objects.bulk_create(vulnerabilities, batch_size=10000)
-        DebPackage.objects.filter(os_release_codename__in=DEBIAN_SUITES).update(processed=False)
-        logger.info('finished.')
-        return len(vulnerabilities)
+        sync_vulnerabilities(vulnerabilities, changed_suites)
+        for feed in changed_feeds:
+            feed.save(update_fields=['etag', 'last_modified', 'digest'])
+    logger.info('finished.')
+    return len(vulnerabilities)
@@ -1,17 +1,18 @@
+import json
 import logging
 import os
+import shutil
 import sys
 from pathlib import Path
 from itertools import chain
-import time
-
-from django.conf import settings
 
 import dateutil.parser
-import redis
+from billiard import Pool
+from django.conf import settings
 from git import Repo
 
-from device_registry.models import Vulnerability, DebPackage, UBUNTU_SUITES
+from device_registry.models import Vulnerability, UBUNTU_SUITES
+from device_registry.celery_tasks.common import sync_vulnerabilities
 
 logger = logging.getLogger('django')
 
@@ -242,67 +243,169 @@ def duplicate_package_status(original_status, override_version=None):
     return copied_status
 
 
-def parse_cve_directory(repo_path: Path):
-    return [parse_cve_file(f) for f in chain(repo_path.glob('active/CVE-*'), repo_path.glob('retired/CVE-*'))]
+class ParsedCveCache:
+    """
+    On-disk cache of parse_cve_file() results keyed by git blob SHA, so only new and changed CVE files are parsed.
+    Entries are grouped by `version`: the SHA of the tracker's scripts/ tree, which parse_cve_file() depends on.
+    """
+
+    def __init__(self, path: Path, version):
+        self.root = path
+        self.path = path / version
+
+    def get(self, sha, filepath):
+        try:
+            with (self.path / sha).open() as f:
+                parsed = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The same blob may be moved, e.g. from active/ to retired/.
+        parsed['header']['Source-note'] = filepath
+        return parsed
+
+    def put(self, sha, parsed):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / (sha + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(parsed, f)
+        tmp_path.replace(self.path / sha)
+
+    def prune(self, keep):
+        """
+        Remove the entries of other versions and the ones not in `keep`.
+        """
+        if self.root.exists():
+            for path in self.root.iterdir():
+                if path.is_dir() and path != self.path:
+                    shutil.rmtree(path, ignore_errors=True)
+        if self.path.exists():
+            for path in self.path.iterdir():
+                if path.name not in keep:
+                    path.unlink()
+
+    def get_last_commit(self):
+        try:
+            return (self.root / 'last_commit').read_text().strip()
+        except OSError:
+            return None
+
+    def set_last_commit(self, sha):
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / 'last_commit').write_text(sha)
+
+
+def get_cve_blobs(commit):
+    """
+    :return: {path: blob SHA} for all active and retired CVE files in the commit.
+    """
+    return {blob.path: blob.hexsha for tree in (commit.tree / 'active', commit.tree / 'retired')
+            for blob in tree.blobs if blob.name.startswith('CVE-')}
+
+
+def _parse_cve_files(filepaths, workers):
+    if workers <= 1 or len(filepaths) < 2:
+        return map(parse_cve_file, filepaths)
+    # billiard (unlike multiprocessing) can start processes from daemonic celery pool workers.
+    with Pool(workers) as pool:
+        return pool.map(parse_cve_file, filepaths, chunksize=64)
+
+
+def parse_cve_directory(repo_path: Path, blobs=None, cache=None, workers=1):
+    """
+    Parse CVE files of the ubuntu-cve-tracker checkout.
+    :param blobs: {path: blob SHA} of the files to parse (see get_cve_blobs()). All CVE files if not given.
+    :param cache: ParsedCveCache. Only the files not found in it are parsed.
+    :param workers: the number of processes parsing the files.
+    """
+    if blobs is None:
+        filepaths = [str(f) for f in chain(repo_path.glob('active/CVE-*'), repo_path.glob('retired/CVE-*'))]
+        return list(_parse_cve_files(filepaths, workers))
+
+    parsed = {}
+    missing = []
+    for path, sha in blobs.items():
+        parsed[path] = cache.get(sha, str(repo_path / path)) if cache is not None else None
+        if parsed[path] is None:
+            missing.append(path)
+    logger.info('%d of %d CVE files to parse.', len(missing), len(blobs))
+    for path, result in zip(missing, _parse_cve_files([str(repo_path / path) for path in missing], workers)):
+        if cache is not None:
+            cache.put(blobs[path], result)
+        parsed[path] = result
+    return list(parsed.values())
 
 
 def clone_cve_repo(repo_path: Path):
+    """
+    Clone ubuntu-cve-tracker or update the existing clone to the latest master.
+    """
     if repo_path.exists():
         repo = Repo(repo_path)
         if repo.head.ref.name != 'master':
             raise RuntimeError('ubuntu-cve-tracker repo is not on master branch')
+        repo.remotes.origin.fetch('master', depth=1)
+        repo.head.reset('FETCH_HEAD', index=True, working_tree=True)
     else:
-        Repo.clone_from('https://git.launchpad.net/ubuntu-cve-tracker', repo_path,
-                        branch='master', multi_options=['--depth=1'])
+        repo = Repo.clone_from('https://git.launchpad.net/ubuntu-cve-tracker', repo_path,
+                               branch='master', multi_options=['--depth=1'])
+    return repo
 
 
-def fetch_vulnerabilities():
+def fetch_vulnerabilities(full=False):
+    """
+    Import ubuntu-cve-tracker data.
+    :param full: parse all CVE files, even if the tracker didn't change since the last import.
+    """
     logger.info('started.')
-    # Try to acquire the lock.
-    # Spend trying 5m max.
-    # In case of success set the lock's timeout to 15m.
-    redis_conn = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
-    with redis_conn.lock('vulns_lock', timeout=60 * 15, blocking_timeout=60 * 5):
-        logger.info('lock acquired.')
-        time.sleep(60 * 3)  # Sleep 3m to allow all running `update_packages_vulnerabilities` tasks finish.
-        logger.info('sleep ended.')
-        ubuntu_cve_tracker_path = Path('/tmp/ubuntu-cve-tracker')
-        # Needed by parse_cve_directory for importing cve_lib.
-        sys.path.append(str(ubuntu_cve_tracker_path / 'scripts'))
-
-        logger.info('cloning ubuntu-cve-tracker...')
-        clone_cve_repo(ubuntu_cve_tracker_path)
-        logger.info('parsing ubuntu-cve-tracker...')
-        vulnerabilities = []
-        parsed = parse_cve_directory(ubuntu_cve_tracker_path)
-        for vuln in parsed:
-            header, details = vuln['header'], vuln['packages']
-            name = header['Candidate']
-            for package, releases in details.items():
-                for codename, info in releases.items():
-                    status, fix_version = info['status'], info.get('fix-version', '')
-                    v = Vulnerability(
-                        name=name,
-                        package=package,
-                        unstable_version=fix_version,
-                        other_versions=[],
-                        is_binary=False,
-                        urgency={
-                            'low': Vulnerability.Urgency.LOW,
-                            'medium': Vulnerability.Urgency.MEDIUM,
-                            'high': Vulnerability.Urgency.HIGH,
-                            'critical': Vulnerability.Urgency.HIGH
-                        }.get(header['Priority'], Vulnerability.Urgency.NONE),
-                        pub_date=dateutil.parser.parse(header['PublicDate']),
-                        remote=None,
-                        fix_available=(status == 'fixed'),
-                        os_release_codename=codename
-                    )
-                    vulnerabilities.append(v)
-
-        logger.info('saving data...')
-        Vulnerability.objects.filter(os_release_codename__in=UBUNTU_SUITES).delete()
-        Vulnerability.objects.bulk_create(vulnerabilities, batch_size=10000)
-        DebPackage.objects.filter(os_release_codename__in=UBUNTU_SUITES).update(processed=False)
-        logger.info('finished.')
-        return len(vulnerabilities)
+    ubuntu_cve_tracker_path = Path(settings.UBUNTU_CVE_TRACKER_PATH)
+    # Needed by parse_cve_directory for importing cve_lib.
+    scripts_path = str(ubuntu_cve_tracker_path / 'scripts')
+    if scripts_path not in sys.path:
+        sys.path.append(scripts_path)
+
+    logger.info('updating ubuntu-cve-tracker...')
+    repo = clone_cve_repo(ubuntu_cve_tracker_path)
+    head = repo.head.commit
+    cache = ParsedCveCache(Path(settings.UBUNTU_CVE_CACHE_PATH), (head.tree / 'scripts').hexsha)
+    last_commit = cache.get_last_commit()
+    if not full and last_commit == head.hexsha:
+        logger.info('no changes since the last import.')
+        return 0
+    if full:
+        cache.prune(keep=())
+
+    logger.info('parsing ubuntu-cve-tracker...')
+    blobs = get_cve_blobs(head)
+    vulnerabilities = []
+    parsed = parse_cve_directory(ubuntu_cve_tracker_path, blobs, cache, settings.UBUNTU_CVE_PARSE_WORKERS)
+    cache.prune(keep=set(blobs.values()))
+    for vuln in parsed:
+        header, details = vuln['header'], vuln['packages']
+        name = header['Candidate']
+        for package, releases in details.items():
+            for codename, info in releases.items():
+                status, fix_version = info['status'], info.get('fix-version', '')
+                v = Vulnerability(
+                    name=name,
+                    package=package,
+                    unstable_version=fix_version,
+                    other_versions=[],
+                    is_binary=False,
+                    urgency={
+                        'low': Vulnerability.Urgency.LOW,
+                        'medium': Vulnerability.Urgency.MEDIUM,
+                        'high': Vulnerability.Urgency.HIGH,
+                        'critical': Vulnerability.Urgency.HIGH
+                    }.get(header['Priority'], Vulnerability.Urgency.NONE),
+                    pub_date=dateutil.parser.parse(header['PublicDate']),
+                    remote=None,
+                    fix_available=(status == 'fixed'),
+                    os_release_codename=codename
+                )
+                vulnerabilities.append(v)
+
+    logger.info('saving data...')
+    sync_vulnerabilities(vulnerabilities, UBUNTU_SUITES)
+    cache.set_last_commit(head.hexsha)
+    logger.info('finished.')
+    return len(vulnerabilities)
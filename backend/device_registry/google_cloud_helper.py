@@ -15,6 +15,11 @@ if 'GOOGLE_CLOUD_KEY_JSON' in os.environ:
 else:
     credentials = project = None
 
+if credentials and project:
+    datastore_client = datastore.Client(project=project, credentials=credentials)
+else:
+    datastore_client = None
+
 
 def dicts_to_ds_entities(element, task_key=None):
     """
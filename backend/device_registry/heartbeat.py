@@ -0,0 +1,79 @@
+"""
+Adaptive heartbeat interval.
+
+Ping responses carry a `next_ping_in` hint: the number of seconds the agent should wait before the next ping.
+It starts at settings.PING_INTERVAL and grows with the server load up to PING_INTERVAL_MAX. The load is measured
+by the ingestion stream length with PING_WRITE_BEHIND enabled, otherwise by the 95th percentile of the recent ping
+processing times in this process. Devices with pending changes are asked to ping again after PING_INTERVAL_MIN.
+Random jitter spreads the pings of agents which started at the same time (e.g. after a deploy).
+"""
+import math
+import random
+import time
+from collections import deque
+
+from django.conf import settings
+
+from device_registry import ping_ingest
+
+LATENCY_WINDOW = 1000  # The number of recent ping processing times used to compute p95.
+
+_latencies = deque(maxlen=LATENCY_WINDOW)
+_load = {'factor': 1.0, 'checked_at': 0.0}
+
+
+def is_enabled():
+    return settings.PING_INTERVAL > 0
+
+
+def record_latency(seconds):
+    _latencies.append(seconds)
+
+
+def get_p95_latency():
+    """
+    :return: the 95th percentile of the recent ping processing times or None if there are none.
+    """
+    if not _latencies:
+        return None
+    latencies = sorted(_latencies)
+    return latencies[math.ceil(len(latencies) * 0.95) - 1]
+
+
+def _get_queue_depth():
+    return ping_ingest._redis_connection().xlen(settings.PING_STREAM)
+
+
+def get_load_factor():
+    """
+    Get the ratio of the current load to the normal one (at least 1). The value is recomputed at most once per
+    PING_LOAD_CHECK_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    if now - _load['checked_at'] >= settings.PING_LOAD_CHECK_INTERVAL:
+        if settings.PING_WRITE_BEHIND:
+            factor = _get_queue_depth() / settings.PING_TARGET_QUEUE_DEPTH
+        else:
+            p95 = get_p95_latency()
+            factor = p95 / settings.PING_TARGET_P95_LATENCY if p95 is not None else 1.0
+        _load.update(factor=max(1.0, factor), checked_at=now)
+    return _load['factor']
+
+
+def clear():
+    _latencies.clear()
+    _load.update(factor=1.0, checked_at=0.0)
+
+
+def get_next_ping_in(pending_changes=False):
+    """
+    Compute the `next_ping_in` hint.
+    :param pending_changes: True if the device has changes to be synchronized soon.
+    :return: the number of seconds.
+    """
+    if pending_changes:
+        interval = settings.PING_INTERVAL_MIN
+    else:
+        interval = min(settings.PING_INTERVAL * get_load_factor(), settings.PING_INTERVAL_MAX)
+    jitter = settings.PING_INTERVAL_JITTER
+    return int(round(interval * random.uniform(1 - jitter, 1 + jitter)))
@@ -0,0 +1,101 @@
+import gzip
+import io
+import time
+import tracemalloc
+import xml.dom.minidom
+
+from django.core.management.base import BaseCommand, CommandError
+
+from device_registry.celery_tasks import amazon_cve
+from device_registry.models import Vulnerability
+
+
+def legacy_parse_updateinfo(compressed_data):
+    """
+    amazon_cve.fetch_vulnerabilities() parsing as it used to be: the whole file decompressed into a string and
+    parsed into a DOM tree.
+    """
+    vulnerabilities = {}
+    xmldoc = xml.dom.minidom.parseString(gzip.decompress(compressed_data).decode())
+    for update in xmldoc.getElementsByTagName('update'):
+        severity = amazon_cve.SEVERITIES[update.getElementsByTagName('severity')[0].firstChild.data]
+        for ref in update.getElementsByTagName('reference'):
+            for pkg in update.getElementsByTagName('package'):
+                key = (ref.getAttribute('id'), pkg.getAttribute('name'))
+                full_version = f'{pkg.getAttribute("epoch")}:{pkg.getAttribute("version")}-' \
+                               f'{pkg.getAttribute("release")}'
+                v = vulnerabilities.get(key)
+                if v is None:
+                    vulnerabilities[key] = Vulnerability(name=key[0], package=key[1], unstable_version=full_version,
+                                                         urgency=severity)
+                else:
+                    v.urgency = max(v.urgency, severity)
+                    if Vulnerability.RpmVersion(v.unstable_version) < Vulnerability.RpmVersion(full_version):
+                        v.unstable_version = full_version
+    return vulnerabilities
+
+
+def make_updateinfo(size):
+    """
+    Make a synthetic gzipped updateinfo.xml with `size` updates.
+    """
+    updates = []
+    for i in range(size):
+        references = ''.join(f'<reference href="https://cve.example/{i}-{j}" id="CVE-2020-{i % 3000 + j}" '
+                             f'title="" type="cve"/>' for j in range(3))
+        packages = ''.join(f'<package arch="x86_64" epoch="0" name="package{(i + j) % 500}" release="{i}.amzn2" '
+                           f'version="1.{j}"><filename>package{j}.rpm</filename></package>' for j in range(4))
+        updates.append(f'<update author="" from="" status="final" type="security" version="2.0">'
+                       f'<id>ALAS2-{i}</id><title>update {i}</title><issued date="2020-01-01 00:00"/>'
+                       f'<severity>{("low", "medium", "important", "critical")[i % 4]}</severity>'
+                       f'<description>Package updates are available.</description>'
+                       f'<references>{references}</references>'
+                       f'<pkglist><collection short="amazon-linux-2"><name>Amazon Linux 2</name>{packages}'
+                       f'</collection></pkglist></update>')
+    return gzip.compress(f'<?xml version="1.0" ?><updates>{"".join(updates)}</updates>'.encode())
+
+
+class Command(BaseCommand):
+    """
+    Compare the time and peak memory (as traced by tracemalloc) of the streaming updateinfo.xml parser with the
+    legacy DOM-based one.
+    """
+    help = 'Benchmark Amazon Linux updateinfo.xml parsing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='A recorded updateinfo.xml.gz. A synthetic one is used if '
+                                                    'not given.')
+        parser.add_argument('--updates', type=int, default=3000, help='The number of synthetic updates.')
+
+    def measure(self, func):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak, result
+
+    def handle(self, *args, **options):
+        if options['path']:
+            try:
+                with open(options['path'], 'rb') as f:
+                    compressed_data = f.read()
+            except OSError as e:
+                raise CommandError(e)
+        else:
+            compressed_data = make_updateinfo(options['updates'])
+
+        def streaming():
+            with gzip.GzipFile(fileobj=io.BytesIO(compressed_data)) as stream:
+                return amazon_cve.parse_updateinfo(stream)
+
+        self.stdout.write(f'{len(compressed_data)} bytes compressed')
+        self.stdout.write(f'{"parser":>10} {"vulns":>8} {"time s":>8} {"peak MB":>8}')
+        results = []
+        for name, func in (('minidom', lambda: legacy_parse_updateinfo(compressed_data)),
+                           ('iterparse', streaming)):
+            elapsed, peak, result = self.measure(func)
+            results.append({key: (v.urgency, v.unstable_version) for key, v in result.items()})
+            self.stdout.write(f'{name:>10} {len(result):>8} {elapsed:>8.2f} {peak / 2 ** 20:>8.1f}')
+        assert results[0] == results[1]
@@ -0,0 +1,102 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from device_registry.models import DebPackage, Device
+
+CODENAME = 'bench'
+
+
+def legacy_find_deb_packages(packages, os_release_codename):
+    """
+    Package ids resolution as it used to be done by Device.set_deb_packages(): one big OR'ed Q.
+    """
+    q_objects = models.Q()
+    for package in packages:
+        q_objects.add(models.Q(name=package['name'], version=package['version'], arch=package['arch'],
+                               os_release_codename=os_release_codename), models.Q.OR)
+    return list(DebPackage.objects.filter(q_objects).values_list('pk', flat=True))
+
+
+def legacy_fill_source(packages, os_release_codename):
+    """
+    Source name backfill as it used to be done by Device.set_deb_packages(): one query per package.
+    """
+    affected_packages_qs = DebPackage.objects.filter(source_name='')
+    affected_packages = []
+    for package in packages:
+        try:
+            package_obj = affected_packages_qs.get(name=package['name'], version=package['version'],
+                                                   arch=package['arch'], os_release_codename=os_release_codename)
+        except DebPackage.DoesNotExist:
+            continue
+        package_obj.source_name = package['source_name']
+        package_obj.source_version = package['source_version']
+        package_obj.processed = False
+        affected_packages.append(package_obj)
+    DebPackage.objects.bulk_update(affected_packages, ['source_name', 'source_version', 'processed'],
+                                   batch_size=10000)
+
+
+def legacy_save_deb_packages(packages, os_release_codename):
+    """
+    Packages saving as it used to be done by Device.set_deb_packages(): source name backfill, bulk_create and
+    ids resolution, i.e. the same steps as Device._save_deb_packages().
+    """
+    if DebPackage.objects.filter(source_name='').exists():
+        legacy_fill_source(packages, os_release_codename)
+    DebPackage.objects.bulk_create([DebPackage(name=package['name'], version=package['version'],
+                                               source_name=package.get('source_name', ''),
+                                               source_version=package.get('source_version', ''),
+                                               arch=package['arch'],
+                                               os_release_codename=os_release_codename) for package in packages],
+                                   batch_size=10000,
+                                   ignore_conflicts=True)
+    return legacy_find_deb_packages(packages, os_release_codename)
+
+
+class Command(BaseCommand):
+    """
+    Compare the deb packages ids resolution and the whole packages saving (source name backfill, bulk_create and ids
+    resolution) used by Device.set_deb_packages() with the legacy approach. All the data is created in a transaction which is rolled back afterwards.
+    """
+    help = 'Benchmark deb packages resolution.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[500, 3000, 10000])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        self.stdout.write(f'{"packages":>10} {"legacy find":>12} {"find":>10} {"legacy save":>12} {"save":>10}')
+        for size in options['sizes']:
+            packages = [{'name': f'package{i}', 'version': f'1.{i}', 'arch': 'amd64',
+                         'source_name': f'source{i}', 'source_version': f'1.{i}'} for i in range(size)]
+            with transaction.atomic():
+                DebPackage.objects.bulk_create([DebPackage(name=p['name'], version=p['version'], arch=p['arch'],
+                                                           os_release_codename=CODENAME) for p in packages],
+                                               batch_size=10000)
+                legacy_find = self.measure(lambda: legacy_find_deb_packages(packages, CODENAME), repeat)
+                find = self.measure(lambda: Device._find_deb_packages(packages, CODENAME), repeat)
+
+                def reset_source():
+                    DebPackage.objects.filter(os_release_codename=CODENAME).update(source_name='')
+
+                def run_save(save):
+                    reset_source()
+                    start = time.perf_counter()
+                    save(packages, CODENAME)
+                    return time.perf_counter() - start
+                legacy_save = min(run_save(legacy_save_deb_packages) for _ in range(repeat))
+                save = min(run_save(Device._save_deb_packages) for _ in range(repeat))
+                transaction.set_rollback(True)
+            self.stdout.write(f'{size:>10} {legacy_find:>12.3f} {find:>10.3f} {legacy_save:>12.3f} {save:>10.3f}')
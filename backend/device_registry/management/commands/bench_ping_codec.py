@@ -0,0 +1,82 @@
+import gzip
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from device_registry import parsers
+
+
+def make_payload(size):
+    """
+    Make a synthetic ping payload with `size` records in every big array.
+    """
+    return {
+        'device_operating_system_version': '4.19.0-6-amd64',
+        'fqdn': 'bench-device',
+        'ipv4_address': '192.168.1.10',
+        'uptime': '1234567',
+        'scan_info': [{'host': '0.0.0.0', 'port': 1024 + i, 'proto': 'tcp', 'state': 'open', 'ip_version': 4}
+                      for i in range(size)],
+        'netstat': [{'ip_version': 4, 'type': 'tcp', 'local_address': ['192.168.1.10', 1024 + i],
+                     'remote_address': ['10.0.0.1', 443], 'status': 'ESTABLISHED', 'pid': 1000 + i}
+                    for i in range(size)],
+        'processes': {str(1000 + i): ['process%d' % i, 'user', ['/usr/bin/process%d' % i, '--option']]
+                      for i in range(size)},
+        'firewall_rules': {'INPUT': [], 'OUTPUT': [], 'FORWARD': []},
+        'deb_packages': {'hash': 'abcdef', 'packages': [
+            {'name': 'package%d' % i, 'version': '1.%d-1' % i, 'arch': 'amd64', 'source_name': 'source%d' % i,
+             'source_version': '1.%d-1' % i} for i in range(size * 5)]},
+        'os_release': {'codename': 'buster', 'distro': 'debian', 'distro_root': 'debian', 'full_version': '10'}
+    }
+
+
+class Command(BaseCommand):
+    """
+    Compare request body sizes and parse times of ping payloads: plain JSON parsed with the standard json module,
+    and gzip/zstd compressed JSON parsed by AgentJSONParser (with orjson if it's installed).
+    """
+    help = 'Benchmark ping payload compression and parsing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Recorded ping payload JSON files. '
+                                                     'Synthetic payloads are used if none given.')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 2000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        if options['paths']:
+            try:
+                payloads = []
+                for path in options['paths']:
+                    with open(path, 'rb') as f:
+                        payloads.append((path, f.read()))
+            except OSError as e:
+                raise CommandError(e)
+        else:
+            payloads = [(f'synthetic-{size}', json.dumps(make_payload(size)).encode())
+                        for size in options['sizes']]
+
+        repeat = options['repeat']
+        codec = 'orjson' if parsers.orjson is not None else 'json'
+        self.stdout.write(f'{"payload":>20} {"bytes":>10} {"gzip":>10} {"zstd":>10} '
+                          f'{"json ms":>10} {codec + " ms":>10} {"gzip+" + codec + " ms":>16}')
+        for name, body in payloads:
+            gzipped = gzip.compress(body)
+            if parsers.zstandard is not None:
+                zstd_size = str(len(parsers.zstandard.ZstdCompressor().compress(body)))
+            else:
+                zstd_size = '-'
+            plain = self.measure(lambda: json.loads(body.decode()), repeat) * 1000
+            fast = self.measure(lambda: parsers.loads(body), repeat) * 1000
+            compressed = self.measure(lambda: parsers.loads(parsers.decompress(gzipped, 'gzip')), repeat) * 1000
+            self.stdout.write(f'{name[-20:]:>20} {len(body):>10} {len(gzipped):>10} {zstd_size:>10} '
+                              f'{plain:>10.2f} {fast:>10.2f} {compressed:>16.2f}')
@@ -0,0 +1,63 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+import apt_pkg
+import rpm
+
+from device_registry import versions
+from device_registry.models import Vulnerability
+
+parse_rpm_version = versions.parse_rpm_version.__wrapped__  # Not memoized.
+
+
+def legacy_is_vulnerable(vuln, src_ver):
+    """
+    Vulnerability.is_vulnerable() as it used to be: version objects built and parsed on every call, other_versions
+    membership checked with a linear scan.
+    """
+    if vuln.version_kind == versions.DEB:
+        def compare(a, b):
+            return apt_pkg.version_compare(a, b)
+    else:
+        def compare(a, b):
+            return rpm.labelCompare(parse_rpm_version(a), parse_rpm_version(b))
+    if vuln.unstable_version and compare(src_ver, vuln.unstable_version) >= 0:
+        return False
+    return not any(compare(src_ver, v) == 0 for v in vuln.other_versions)
+
+
+class Command(BaseCommand):
+    """
+    Compare the memoized Vulnerability.is_vulnerable() with the legacy uncached version comparison on synthetic
+    (package version, vulnerability) pairs with recurring versions, like in update_packages_vulnerabilities.
+    """
+    help = 'Benchmark vulnerable version matching.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=100000)
+        parser.add_argument('--versions', type=int, default=500, help='The number of distinct package versions.')
+        parser.add_argument('--other-versions', type=int, default=10)
+
+    def measure(self, func, pairs):
+        start = time.perf_counter()
+        result = [func(vuln, version) for vuln, version in pairs]
+        return time.perf_counter() - start, result
+
+    def handle(self, *args, **options):
+        rnd = random.Random(0)
+        distinct_versions = [f'{rnd.randint(0, 2)}:{rnd.randint(1, 9)}.{rnd.randint(0, 20)}-{rnd.randint(1, 5)}'
+                             for _ in range(options['versions'])]
+        self.stdout.write(f'{"kind":>5} {"pairs":>10} {"legacy s":>10} {"memoized s":>12} {"speedup":>8}')
+        for codename, kind in (('buster', versions.DEB), ('amzn2', versions.RPM)):
+            vulns = [Vulnerability(os_release_codename=codename, unstable_version=rnd.choice(distinct_versions),
+                                   other_versions=rnd.sample(distinct_versions, options['other_versions']))
+                     for _ in range(100)]
+            pairs = [(rnd.choice(vulns), rnd.choice(distinct_versions)) for _ in range(options['pairs'])]
+            versions.clear_cache()
+            legacy, legacy_result = self.measure(legacy_is_vulnerable, pairs)
+            memoized, result = self.measure(lambda vuln, version: vuln.is_vulnerable(version), pairs)
+            assert result == legacy_result
+            self.stdout.write(f'{kind:>5} {len(pairs):>10} {legacy:>10.3f} {memoized:>12.3f} '
+                              f'{legacy / memoized:>8.1f}')
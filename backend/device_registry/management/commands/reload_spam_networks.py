@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from device_registry import blocklist
+
+
+class Command(BaseCommand):
+    """
+    Load the spam networks blocklist from a local file in the Spamhaus DROP format, compact it and store it as a new
+    version if it differs from the current one.
+    """
+    help = 'Reload the spam networks blocklist from a file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=settings.SPAM_NETWORKS_PATH)
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path']) as f:
+                networks = blocklist.parse(f.read())
+        except OSError as e:
+            raise CommandError(e)
+        if not networks:
+            raise CommandError('No networks found.')
+        spam_networks, created = blocklist.load(networks)
+        if created:
+            self.stdout.write(f'Loaded {len(networks)} networks compacted to {len(spam_networks.networks)} '
+                              f'as version {spam_networks.version}.')
+        else:
+            self.stdout.write(f'Version {spam_networks.version} is up to date.')
@@ -0,0 +1,60 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Every distinct device package list becomes a PackageSet, its hash is calculated the same way as in
+# PackageSet.get_hash(): MD5 of the sorted comma-separated DebPackage ids.
+FORWARD_SQL = """
+CREATE TEMPORARY TABLE device_package_set_hash ON COMMIT DROP AS
+    SELECT device_id, md5(string_agg(debpackage_id::text, ',' ORDER BY debpackage_id)) AS hash
+    FROM device_registry_device_deb_packages
+    GROUP BY device_id;
+
+INSERT INTO device_registry_packageset (hash)
+    SELECT DISTINCT hash FROM device_package_set_hash;
+
+UPDATE device_registry_device AS d SET package_set_id = s.id
+    FROM device_package_set_hash AS h JOIN device_registry_packageset AS s ON s.hash = h.hash
+    WHERE d.id = h.device_id;
+
+INSERT INTO device_registry_packageset_packages (packageset_id, debpackage_id)
+    SELECT d.package_set_id, r.debpackage_id
+    FROM (SELECT DISTINCT ON (package_set_id) package_set_id, id FROM device_registry_device
+          WHERE package_set_id IS NOT NULL) AS d
+    JOIN device_registry_device_deb_packages AS r ON r.device_id = d.id;
+"""
+
+REVERSE_SQL = """
+INSERT INTO device_registry_device_deb_packages (device_id, debpackage_id)
+    SELECT d.id, r.debpackage_id
+    FROM device_registry_device AS d
+    JOIN device_registry_packageset_packages AS r ON r.packageset_id = d.package_set_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0092_auto_20200403_1153'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackageSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=32, unique=True)),
+                ('packages', models.ManyToManyField(related_name='package_sets', to='device_registry.DebPackage')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='package_set',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                                    related_name='devices', to='device_registry.PackageSet'),
+        ),
+        migrations.RunSQL(FORWARD_SQL, REVERSE_SQL),
+        migrations.RemoveField(
+            model_name='device',
+            name='deb_packages',
+        ),
+    ]
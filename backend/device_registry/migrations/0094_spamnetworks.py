@@ -0,0 +1,23 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0093_packageset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpamNetworks',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(unique=True)),
+                ('networks', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=43),
+                                                                       size=None)),
+                ('digest', models.CharField(max_length=40)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
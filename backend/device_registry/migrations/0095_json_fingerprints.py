@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0094_spamnetworks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceinfo',
+            name='logins_hash',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='deviceinfo',
+            name='processes_hash',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='portscan',
+            name='scan_info_hash',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='portscan',
+            name='netstat_hash',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='firewallstate',
+            name='rules_hash',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
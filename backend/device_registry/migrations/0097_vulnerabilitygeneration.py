@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def create_generation(apps, schema_editor):
+    VulnerabilityGeneration = apps.get_model('device_registry', 'VulnerabilityGeneration')
+    VulnerabilityGeneration.objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0096_gatewaykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VulnerabilityGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_generation, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0097_vulnerabilitygeneration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VulnerabilityFeed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=512, unique=True)),
+                ('etag', models.CharField(blank=True, max_length=256)),
+                ('last_modified', models.CharField(blank=True, max_length=64)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+            ],
+        ),
+    ]
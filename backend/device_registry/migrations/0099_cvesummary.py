@@ -0,0 +1,36 @@
+from django.contrib.postgres.aggregates import BoolOr
+from django.db import migrations, models
+from django.db.models import Max
+import device_registry.models
+
+
+def fill_summaries(apps, schema_editor):
+    Vulnerability = apps.get_model('device_registry', 'Vulnerability')
+    CveSummary = apps.get_model('device_registry', 'CveSummary')
+    aggregated = Vulnerability.objects.values('name').annotate(
+        max_urgency=Max('urgency'), max_pub_date=Max('pub_date'), any_fix_available=BoolOr('fix_available')
+    ).order_by()
+    CveSummary.objects.bulk_create([CveSummary(name=v['name'], max_urgency=v['max_urgency'], pub_date=v['max_pub_date'],
+                                               fix_available=v['any_fix_available']) for v in aggregated.iterator()],
+                                   batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0098_vulnerabilityfeed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CveSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('max_urgency', models.PositiveSmallIntegerField(choices=[(device_registry.models.Vulnerability.Urgency(0), 0), (device_registry.models.Vulnerability.Urgency(1), 1), (device_registry.models.Vulnerability.Urgency(2), 2), (device_registry.models.Vulnerability.Urgency(3), 3)])),
+                ('pub_date', models.DateField(null=True)),
+                ('fix_available', models.BooleanField()),
+            ],
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
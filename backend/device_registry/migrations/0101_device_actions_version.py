@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_registry', '0100_packageset_last_used'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='actions_version',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
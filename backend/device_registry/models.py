@@ -1,22 +1,26 @@
 from enum import Enum, IntEnum
 import datetime
+import hashlib
 import json
 import uuid
-from typing import NamedTuple, Tuple, Optional
+from typing import NamedTuple
 
 from dateutil.relativedelta import relativedelta, SU, MO
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Q, Max, Window, Count
+from django.db import connection, models, transaction
+from django.db.models import Q, Max, Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.functional import cached_property
+from django.contrib.postgres.aggregates import BoolOr
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.core.exceptions import ObjectDoesNotExist
 
 import apt_pkg
-import rpm
 import yaml
 import tagulous.models
 
+from . import versions
 from .validators import UnicodeNameValidator, LinuxUserNameValidator
 from .recommended_actions import ActionMeta, INSECURE_SERVICES, SSHD_CONFIG_PARAMS_INFO, PUBLIC_SERVICE_PORTS, \
     ParamStatus, Severity
@@ -79,6 +83,79 @@ class DebPackage(models.Model):
         return f'{self.name}:{self.version}:{self.arch}:{self.os_release_codename}'
 
 
+class PackageSet(models.Model):
+    """
+    A set of installed deb packages shared by all the devices which have exactly this set.
+    Sets are content-addressed by `hash` (see get_hash()) and never change once created: when a device's package list
+    changes the device is pointed to another set.
+    """
+    hash = models.CharField(max_length=32, unique=True)
+    packages = models.ManyToManyField(DebPackage, related_name='package_sets')
+    # Updated whenever the set is reused, so an orphan set is not deleted while a device is being pointed to it (see
+    # delete_orphan_package_sets()).
+    last_used = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def get_hash(package_ids):
+        """
+        Calculate the set hash: MD5 of its sorted comma-separated DebPackage ids.
+        """
+        return hashlib.md5(','.join(str(pk) for pk in sorted(package_ids)).encode()).hexdigest()
+
+    @classmethod
+    def get_or_create_for(cls, package_ids):
+        """
+        Get the set consisting of the given DebPackage ids, create it if it doesn't exist yet.
+        :param package_ids: an iterable of DebPackage ids.
+        :return: PackageSet
+        """
+        package_ids = set(package_ids)
+        package_hash = cls.get_hash(package_ids)
+        while True:
+            with transaction.atomic():
+                package_set, created = cls.objects.get_or_create(hash=package_hash)
+                if created:
+                    Relation = cls.packages.through
+                    Relation.objects.bulk_create([Relation(packageset=package_set, debpackage_id=pk)
+                                                  for pk in package_ids], batch_size=10000)
+                    return package_set
+                if cls.objects.filter(pk=package_set.pk).update(last_used=timezone.now()):
+                    return package_set
+            # The set was deleted as an orphan right after it was fetched, create it again.
+
+
+class DeviceDebPackages:
+    """
+    `Device.deb_packages` accessor which mimics the many-to-many related manager it replaces. Reads are delegated to
+    the queryset of the device's PackageSet packages, modifications point the device to another PackageSet.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def __getattr__(self, name):
+        return getattr(self.all(), name)
+
+    def all(self):
+        # Like the related manager it doesn't rely on the (possibly stale) device instance fields.
+        return DebPackage.objects.filter(package_sets__devices=self.device)
+
+    @staticmethod
+    def _get_ids(packages):
+        return {package.pk if isinstance(package, DebPackage) else package for package in packages}
+
+    def set(self, packages):
+        self.device.set_package_ids(self._get_ids(packages))
+
+    def add(self, *packages):
+        self.device.set_package_ids(set(self.all().values_list('pk', flat=True)) | self._get_ids(packages))
+
+    def remove(self, *packages):
+        self.device.set_package_ids(set(self.all().values_list('pk', flat=True)) - self._get_ids(packages))
+
+    def clear(self):
+        self.device.set_package_ids([])
+
+
 class Device(models.Model):
     class SshdIssueItem(NamedTuple):
         safe_value: str
@@ -112,8 +189,11 @@ class Device(models.Model):
     tags = tagulous.models.TagField(to=Tag, blank=True)
     trust_score = models.FloatField(null=True)
     update_trust_score = models.BooleanField(default=False, db_index=True)
-    deb_packages = models.ManyToManyField(DebPackage)
+    package_set = models.ForeignKey(PackageSet, null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='devices')
     deb_packages_hash = models.CharField(max_length=32, blank=True)
+    # ActionMeta.classes_version() of the action classes all evaluated for this device on ping.
+    actions_version = models.CharField(max_length=32, blank=True)
     cpu = JSONField(blank=True, default=dict)
     kernel_deb_package = models.ForeignKey(DebPackage, null=True, on_delete=models.SET_NULL, related_name='+')
     reboot_required = models.BooleanField(null=True, blank=True, db_index=True)
@@ -126,6 +206,10 @@ class Device(models.Model):
     class Meta:
         ordering = ('created',)
 
+    @property
+    def deb_packages(self):
+        return DeviceDebPackages(self)
+
     @property
     def default_password(self):
         if self.default_password_users is not None:
@@ -248,33 +332,31 @@ class Device(models.Model):
             return None
         return self.deb_packages.filter(name__in=[service.name for service in INSECURE_SERVICES])
 
-    def set_deb_packages(self, packages, os_info):
+    @staticmethod
+    def _save_deb_packages(packages, os_release_codename):
         """
-        Assign the list of installed deb packages to this device.
+        Make sure all the given packages exist in DB.
         :param packages: list of dicts with the following values: 'name': str, 'version': str, 'arch': DebPackage.Arch.
-        :param os_info: a dict with the `os_release` data from agent.
+        :param os_release_codename: OS release codename the packages belong to.
+        :return: list of the given packages' ids.
         """
-        os_release_codename = os_info.get('codename', '')
-
         # Update packages with empty source_name and source_version.
-        if DebPackage.objects.filter(source_name='').exists():
-            affected_packages_qs = DebPackage.objects.filter(source_name='')
-            affected_packages = []
-            for package in packages:
-                if 'source_name' not in package:
-                    continue  # Old agent version, nothing to do.
-                try:
-                    package_obj = affected_packages_qs.get(name=package['name'], version=package['version'],
-                                                           arch=package['arch'],
-                                                           os_release_codename=os_release_codename)
-                except ObjectDoesNotExist:
-                    continue
-                package_obj.source_name = package['source_name']
-                package_obj.source_version = package['source_version']
-                package_obj.processed = False
-                affected_packages.append(package_obj)
-            DebPackage.objects.bulk_update(affected_packages, ['source_name', 'source_version', 'processed'],
-                                           batch_size=10000)
+        with_source = [package for package in packages if 'source_name' in package]  # Skip old agent versions.
+        if with_source and DebPackage.objects.filter(source_name='').exists():
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    UPDATE {DebPackage._meta.db_table} AS p
+                    SET source_name = t.source_name, source_version = t.source_version, processed = false
+                    FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+                        AS t(name, version, arch, source_name, source_version)
+                    WHERE p.source_name = '' AND p.os_release_codename = %s
+                        AND p.name = t.name AND p.version = t.version AND p.arch = t.arch
+                """, [[package['name'] for package in with_source],
+                      [package['version'] for package in with_source],
+                      [package['arch'] for package in with_source],
+                      [package['source_name'] for package in with_source],
+                      [package['source_version'] for package in with_source],
+                      os_release_codename])
 
         # Save new packages to DB.
         DebPackage.objects.bulk_create([DebPackage(name=package['name'], version=package['version'],
@@ -284,14 +366,67 @@ class Device(models.Model):
                                                    os_release_codename=os_release_codename) for package in packages],
                                        batch_size=10000,
                                        ignore_conflicts=True)
-        # Get packages qs.
-        q_objects = models.Q()
-        for package in packages:
-            q_objects.add(models.Q(name=package['name'], version=package['version'], arch=package['arch'],
-                                   os_release_codename=os_release_codename), models.Q.OR)
+        return Device._find_deb_packages(packages, os_release_codename)
 
+    @staticmethod
+    def _find_deb_packages(packages, os_release_codename):
+        """
+        Get ids of DebPackage objects matching the given packages' natural keys.
+        The packages are sent as a set of arrays joined against the DebPackage unique key in a single query.
+        :param packages: list of dicts with the following values: 'name': str, 'version': str, 'arch': DebPackage.Arch.
+        :param os_release_codename: OS release codename the packages belong to.
+        :return: list of DebPackage ids.
+        """
+        if not packages:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT p.id FROM {DebPackage._meta.db_table} AS p
+                JOIN unnest(%s::text[], %s::text[], %s::text[]) AS t(name, version, arch)
+                    ON p.name = t.name AND p.version = t.version AND p.arch = t.arch
+                WHERE p.os_release_codename = %s
+            """, [[package['name'] for package in packages],
+                  [package['version'] for package in packages],
+                  [package['arch'] for package in packages],
+                  os_release_codename])
+            return [row[0] for row in cursor.fetchall()]
+
+    def set_package_ids(self, package_ids):
+        """
+        Point this device to the PackageSet consisting of the given DebPackage ids.
+        :param package_ids: an iterable of DebPackage ids.
+        """
+        package_set = PackageSet.get_or_create_for(package_ids)
+        if package_set.pk != self.package_set_id:
+            self.package_set = package_set
+            Device.objects.filter(pk=self.pk).update(package_set=package_set)
+
+    def set_deb_packages(self, packages, os_info):
+        """
+        Assign the list of installed deb packages to this device.
+        :param packages: list of dicts with the following values: 'name': str, 'version': str, 'arch': DebPackage.Arch.
+        :param os_info: a dict with the `os_release` data from agent.
+        """
+        os_release_codename = os_info.get('codename', '')
         # Set deb_packages.
-        self.deb_packages.set(DebPackage.objects.filter(q_objects).only('pk'))
+        self.set_package_ids(self._save_deb_packages(packages, os_release_codename))
+
+    def update_deb_packages(self, added, removed, os_info):
+        """
+        Incrementally update the list of installed deb packages of this device.
+        Only newly created DebPackage objects get (by default) processed=False and thus will be matched against
+        vulnerabilities; the ones which already exist keep their state.
+        :param added: list of installed package dicts (same format as in set_deb_packages()).
+        :param removed: list of removed package dicts, only 'name', 'version' and 'arch' values are required.
+        :param os_info: a dict with the `os_release` data from agent.
+        """
+        os_release_codename = os_info.get('codename', '')
+        package_ids = set(self.deb_packages.values_list('pk', flat=True))
+        if removed:
+            package_ids -= set(self._find_deb_packages(removed, os_release_codename))
+        if added:
+            package_ids |= set(self._save_deb_packages(added, os_release_codename))
+        self.set_package_ids(package_ids)
 
     def get_name(self):
         if self.name:
@@ -416,7 +551,7 @@ class Device(models.Model):
             failed_logins = 1.0 - ((failed_logins - self.MIN_FAILED_LOGINS) /
                                    (self.MAX_FAILED_LOGINS - self.MIN_FAILED_LOGINS + 1))
 
-        vulns = Vulnerability.objects.filter(debpackage__device=self).distinct()
+        vulns = Vulnerability.objects.filter(debpackage__package_sets__devices=self).distinct()
         vulns_low = vulns.filter(urgency__in=[Vulnerability.Urgency.NONE, Vulnerability.Urgency.LOW])
         vulns_medium = vulns.filter(urgency=Vulnerability.Urgency.MEDIUM)
         vulns_high = vulns.filter(urgency=Vulnerability.Urgency.HIGH)
@@ -496,13 +631,10 @@ class Device(models.Model):
         # For every CVE name detected for this device, find its maximal urgency among the whole CVE database.
         # This will include CVEs with the same name from different sources (Denian and Ubuntu trackers currently).
         # Then count the number of distinct CVE names grouped by urgency.
-        vuln_names = Vulnerability.objects.filter(debpackage__device=self, fix_available=True) \
-            .values('name').distinct()
-        urgency_counts = Vulnerability.objects.filter(name__in=vuln_names) \
-            .values('name').distinct() \
-            .annotate(max_urgency=Max('urgency')) \
-            .annotate(urg_cnt=Window(expression=Count('name'), partition_by='max_urgency')).order_by()\
-            .values('max_urgency', 'urg_cnt')
+        vuln_names = Vulnerability.objects.filter(debpackage__package_sets__devices=self, fix_available=True) \
+            .values('name')
+        urgency_counts = CveSummary.objects.filter(name__in=vuln_names) \
+            .values('max_urgency').annotate(urg_cnt=Count('id')).order_by()
 
         severities = {
             Vulnerability.Urgency.HIGH: 'high',
@@ -636,6 +768,9 @@ class DeviceInfo(models.Model):
     app_armor_enabled = models.BooleanField(null=True, blank=True)
     logins = JSONField(blank=True, default=dict)
     processes = JSONField(blank=True, default=dict)
+    # Fingerprints of the JSON fields above, used to skip writing them when they haven't changed.
+    logins_hash = models.CharField(max_length=32, blank=True)
+    processes_hash = models.CharField(max_length=32, blank=True)
     default_password = models.BooleanField(null=True, blank=True)
 
     # We need this for the YC demo.
@@ -672,6 +807,9 @@ class PortScan(models.Model):
     scan_date = models.DateTimeField(auto_now=True)
     scan_info = JSONField(blank=True, default=list)  # Ports open for incoming connection to.
     netstat = JSONField(blank=True, default=list)  # Currently open network connections.
+    # Fingerprints of the JSON fields above, used to skip writing them when they haven't changed.
+    scan_info_hash = models.CharField(max_length=32, blank=True)
+    netstat_hash = models.CharField(max_length=32, blank=True)
     block_ports = JSONField(blank=True, default=list)
     block_networks = JSONField(blank=True, default=list)
 
@@ -794,6 +932,7 @@ class FirewallState(models.Model):
     device = models.OneToOneField(Device, on_delete=models.CASCADE)
     scan_date = models.DateTimeField(null=True, auto_now_add=True)
     rules = JSONField(blank=True, default=dict)
+    rules_hash = models.CharField(max_length=32, blank=True)  # Used to skip writing the rules when unchanged.
     policy = models.PositiveSmallIntegerField(choices=POLICY_CHOICES, default=POLICY_ENABLED_ALLOW)
     global_policy = models.ForeignKey('GlobalPolicy', on_delete=models.SET_NULL, blank=True, null=True)
 
@@ -863,6 +1002,23 @@ class PairingKey(models.Model):
         ordering = ('created',)
 
 
+class GatewayKey(models.Model):
+    """
+    A credential of a gateway which sends pings on behalf of its owner's devices (see BulkPingView).
+    """
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='gateway_keys',
+        on_delete=models.CASCADE,
+    )
+    key = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    comment = models.CharField(blank=True, max_length=512)
+
+    class Meta:
+        ordering = ('created',)
+
+
 class GlobalPolicy(models.Model):
     POLICY_ALLOW = 1
     POLICY_BLOCK = 2
@@ -908,6 +1064,16 @@ class GlobalPolicy(models.Model):
         constraints = [models.UniqueConstraint(fields=['name', 'owner'], name='unique_name')]
 
 
+class SpamNetworks(models.Model):
+    """
+    A version of the compacted spam networks blocklist, see `device_registry.blocklist`.
+    """
+    version = models.PositiveIntegerField(unique=True)
+    networks = ArrayField(models.CharField(max_length=43))  # CIDR strings.
+    digest = models.CharField(max_length=40)  # SHA1 of the comma-separated networks.
+    created = models.DateTimeField(auto_now_add=True)
+
+
 class Vulnerability(models.Model):
     class Meta:
         unique_together = ['os_release_codename', 'name', 'package']
@@ -932,58 +1098,26 @@ class Vulnerability(models.Model):
         Version comparator for deb packages. Uses python-apt which in turn uses native code to compare versions.
         """
         def __lt__(self, other):
-            return apt_pkg.version_compare(str(self), str(other)) < 0
+            return versions.compare(versions.DEB, str(self), str(other)) < 0
 
         def __eq__(self, other):
-            return apt_pkg.version_compare(str(self), str(other)) == 0
+            return versions.compare(versions.DEB, str(self), str(other)) == 0
 
     class RpmVersion(Version):
         """
         Version comparator for rpm packages. Uses python-rpm which in turn uses native code to compare version.
         """
-        @staticmethod
-        def stringToVersion(verstring) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-            """
-            Adapted from python2 version. Produces a tuple which can be used in rpm.labelCompare().
-            https://github.com/rpm-software-management/yum/blob/master/rpmUtils/miscutils.py#L391
-            :param verstring: A full version string [epoch:]<version>[.release]
-            :return: (epoch, version, release), any of those may be None
-            """
-            if verstring in [None, '']:
-                return (None, None, None)
-            i = verstring.find(':')
-            if i != -1:
-                try:
-                    epoch = str(int(verstring[:i]))
-                except ValueError:
-                    # look, garbage in the epoch field, how fun, kill it
-                    epoch = '0'  # this is our fallback, deal
-            else:
-                epoch = '0'
-            j = verstring.find('-')
-            if j != -1:
-                if verstring[i + 1:j] == '':
-                    version = None
-                else:
-                    version = verstring[i + 1:j]
-                release = verstring[j + 1:]
-            else:
-                if verstring[i + 1:] == '':
-                    version = None
-                else:
-                    version = verstring[i + 1:]
-                release = None
-            return epoch, version, release
+        stringToVersion = staticmethod(versions.parse_rpm_version)
 
         def __init__(self, version):
             super().__init__(version)
             self._version_tuple = self.stringToVersion(version)
 
         def __lt__(self, other):
-            return rpm.labelCompare(self._version_tuple, other._version_tuple) < 0
+            return versions.compare(versions.RPM, str(self), str(other)) < 0
 
         def __eq__(self, other):
-            return rpm.labelCompare(self._version_tuple, other._version_tuple) == 0
+            return versions.compare(versions.RPM, str(self), str(other)) == 0
 
     class Urgency(IntEnum):
         NONE = 0
@@ -1002,23 +1136,103 @@ class Vulnerability(models.Model):
     fix_available = models.BooleanField(db_index=True)
     pub_date = models.DateField(null=True)
 
-    def is_vulnerable(self, src_ver):
-        if self.os_release_codename in DEBIAN_SUITES + UBUNTU_SUITES + ('amzn2',):
-            VersionClass = self.DebVersion if self.os_release_codename in DEBIAN_SUITES + UBUNTU_SUITES \
-                else self.RpmVersion
-            if self.unstable_version:
-                unstable_version = VersionClass(self.unstable_version)
-            else:
-                unstable_version = None
-            other_versions = map(VersionClass, self.other_versions)
-            src_ver = VersionClass(src_ver)
+    @staticmethod
+    def get_version_kind(os_release_codename):
+        """
+        :return: versions.DEB, versions.RPM or None if the distro is not supported.
+        """
+        if os_release_codename in DEBIAN_SUITES + UBUNTU_SUITES:
+            return versions.DEB
+        elif os_release_codename == 'amzn2':
+            return versions.RPM
+        return None
 
-            if self.unstable_version:
-                return src_ver < unstable_version and src_ver not in other_versions
-            else:
-                return src_ver not in other_versions
-        else:
+    @property
+    def version_kind(self):
+        return self.get_version_kind(self.os_release_codename)
+
+    @cached_property
+    def other_versions_set(self):
+        return versions.VersionSet(self.version_kind, self.other_versions)
+
+    def is_vulnerable(self, src_ver):
+        kind = self.version_kind
+        if kind is None:
+            return False
+        assert src_ver != ""
+        # unstable_version is the version the vulnerability is fixed in.
+        if self.unstable_version and versions.compare(kind, src_ver, self.unstable_version) >= 0:
             return False
+        return src_ver not in self.other_versions_set
+
+
+class CveSummary(models.Model):
+    """
+    Vulnerability data aggregated by CVE name over all the sources (Debian, Ubuntu and Amazon trackers): the maximal
+    urgency and publication date, and whether a fix is available anywhere. Kept up to date by the vulnerability
+    importers (see refresh()).
+    """
+    name = models.CharField(max_length=64, unique=True)
+    max_urgency = models.PositiveSmallIntegerField(choices=[(tag, tag.value) for tag in Vulnerability.Urgency])
+    pub_date = models.DateField(null=True)
+    fix_available = models.BooleanField()
+
+    @classmethod
+    def refresh(cls, names=None):
+        """
+        Recompute the summaries of the given CVE names.
+        :param names: an iterable of CVE names, all CVEs if None.
+        """
+        vulns = Vulnerability.objects.all()
+        summaries = cls.objects.all()
+        if names is not None:
+            names = list(names)
+            vulns = vulns.filter(name__in=names)
+            summaries = summaries.filter(name__in=names)
+        aggregated = vulns.values('name').annotate(max_urgency=Max('urgency'), max_pub_date=Max('pub_date'),
+                                                   any_fix_available=BoolOr('fix_available')).order_by()
+        with transaction.atomic():
+            summaries.delete()
+            cls.objects.bulk_create([cls(name=v['name'], max_urgency=v['max_urgency'], pub_date=v['max_pub_date'],
+                                         fix_available=v['any_fix_available']) for v in aggregated.iterator()],
+                                    batch_size=10000)
+
+
+@receiver(post_save, sender=Vulnerability, dispatch_uid='cve_summary_vulnerability_saved')
+def refresh_cve_summary(sender, instance, **kwargs):
+    # Single object saves (admin, tests) only. The importers write with bulk_create() and bulk_update(), which don't
+    # send signals, and call CveSummary.refresh() themselves. There's deliberately no post_delete receiver: it would
+    # make QuerySet.delete() fetch and signal every deleted row instead of deleting them with a single query.
+    CveSummary.refresh([instance.name])
+
+
+class VulnerabilityGeneration(models.Model):
+    """
+    The generation number of the vulnerabilities data (a single row). Every import which changes the data increments
+    it in the same transaction, so package matching tasks can pin the generation they started with and detect that
+    the data has changed under them instead of waiting for imports to finish.
+    """
+    number = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get_current(cls, for_update=False):
+        """
+        :param for_update: lock the row until the end of the transaction.
+        """
+        queryset = cls.objects.select_for_update() if for_update else cls.objects.all()
+        generation, _ = queryset.get_or_create(pk=1)
+        return generation
+
+
+class VulnerabilityFeed(models.Model):
+    """
+    The state of a vulnerabilities feed as of its last import: HTTP validators for conditional requests and the
+    digest of its content.
+    """
+    url = models.URLField(max_length=512, unique=True)
+    etag = models.CharField(max_length=256, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    digest = models.CharField(max_length=64, blank=True)
 
 
 class Distro(models.Model):
@@ -0,0 +1,114 @@
+"""
+Parser and renderer for the agent (mTLS) endpoints.
+
+Agents may compress request bodies: `Content-Encoding: gzip` is always supported, `zstd` only if the `zstandard`
+package is installed. JSON is (de)serialized with `orjson` if it's installed, otherwise with the standard library.
+"""
+import io
+import json
+import zlib
+
+from django.conf import settings
+
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+from rest_framework.parsers import JSONParser
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def loads(data):
+    """
+    Deserialize JSON from str or bytes.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _gunzip(data, max_size):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    result = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ParseError('Decompressed request body is too large.')
+    if not decompressor.eof:
+        raise ParseError('Malformed gzip request body.')
+    return result
+
+
+def _unzstd(data, max_size):
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+    result = bytearray()
+    while True:
+        chunk = reader.read(max_size + 1 - len(result))
+        if not chunk:
+            return bytes(result)
+        result += chunk
+        if len(result) > max_size:
+            raise ParseError('Decompressed request body is too large.')
+
+
+DECOMPRESSORS = {'gzip': _gunzip}
+if zstandard is not None:
+    DECOMPRESSORS['zstd'] = _unzstd
+
+
+def decompress(data, content_encoding):
+    """
+    Decode a request body compressed with `content_encoding`.
+    :param content_encoding: Content-Encoding header value, may be empty.
+    :raise UnsupportedMediaType: if the encoding is not supported.
+    :raise ParseError: if the body is corrupted or too large when decompressed.
+    """
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in ('', 'identity'):
+        return data
+    if content_encoding not in DECOMPRESSORS:
+        raise UnsupportedMediaType(content_encoding, detail=f'Unsupported content encoding "{content_encoding}".')
+    try:
+        return DECOMPRESSORS[content_encoding](data, settings.MTLS_MAX_DECOMPRESSED_SIZE)
+    except ParseError:
+        raise
+    except Exception:
+        raise ParseError(f'Malformed {content_encoding} request body.')
+
+
+class AgentJSONParser(JSONParser):
+    """
+    JSONParser which accepts compressed request bodies and uses orjson if available.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context.get('request')
+        content_encoding = request.META.get('HTTP_CONTENT_ENCODING', '') if request is not None else ''
+        data = decompress(stream.read(), content_encoding)
+        if orjson is None:
+            return super().parse(io.BytesIO(data), media_type, parser_context)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class AgentJSONRenderer(renderers.JSONRenderer):
+    """
+    JSONRenderer which uses orjson if available. Values orjson doesn't support natively (and datetimes, to keep
+    their format) are serialized by the DRF JSON encoder.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        return orjson.dumps(data, default=encoders.JSONEncoder().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
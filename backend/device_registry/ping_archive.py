@@ -0,0 +1,187 @@
+"""
+Ping archive: raw ping payloads exported to long-term storage (Google Datastore by default).
+
+Archiving is kept off the ping request path: `archive_pings` only appends records to a bounded Redis list which is
+flushed to the sink in batches by the `export_ping_archive` celery task. The task is started when a full batch has
+been buffered and also every 10 seconds by celery beat (unless archiving is disabled), so partial batches don't wait
+for long.
+A batch is removed from the buffer only after the sink has stored it, so pings are exported at least once: if the sink
+fails or the worker is killed the batch stays in the buffer for the next run. Only one export runs at a time. When the
+sink can't keep up and the buffer is full new records are dropped and counted by the `ping_archive_dropped` metric.
+
+The sink is configured with `settings.PING_ARCHIVE_SINK`, see `ArchiveSink`.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import dateutil.parser
+import redis
+from prometheus_client import Counter
+
+from device_registry import google_cloud_helper
+
+logger = logging.getLogger('django')
+
+EXPORT_LOCK = 'ping-archive-export-lock'
+EXPORT_LOCK_TIMEOUT = 60 + 5  # The `export_ping_archive` task time limit.
+
+dropped_counter = Counter('ping_archive_dropped', 'Ping archive records dropped because the buffer was full.')
+
+
+class ArchiveSink:
+    """
+    Storage for archived pings. Subclasses implement `put_multi`.
+    """
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def put_multi(self, records):
+        """
+        Store a batch of records.
+        :param records: a list of dicts made by `make_record`.
+        """
+        raise NotImplementedError
+
+
+class DatastoreSink(ArchiveSink):
+    """
+    Store pings as 'Ping' entities in Google Datastore. Only `device_id` and `last_ping` are indexed.
+    """
+    MAX_BATCH_SIZE = 500  # Datastore limit of entities written in one commit.
+
+    def __init__(self, client=None):
+        self.client = client or google_cloud_helper.datastore_client
+
+    @classmethod
+    def is_available(cls):
+        return google_cloud_helper.datastore_client is not None
+
+    def put_multi(self, records):
+        entities = []
+        for record in records:
+            record = dict(record)
+            device_id = record.pop('device_id')
+            last_ping = dateutil.parser.parse(record.pop('last_ping'))
+            entity = google_cloud_helper.dicts_to_ds_entities(record, self.client.key('Ping'))
+            entity['device_id'] = device_id  # Will be indexed.
+            entity['last_ping'] = last_ping  # Will be indexed.
+            entities.append(entity)
+        for i in range(0, len(entities), self.MAX_BATCH_SIZE):
+            self.client.put_multi(entities[i:i + self.MAX_BATCH_SIZE])
+
+
+class FileSink(ArchiveSink):
+    """
+    Append pings to a local file, one JSON record per line. Meant for development, tests and benchmarks.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.PING_ARCHIVE_PATH
+
+    def put_multi(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+
+def _get_sink_class():
+    if not settings.PING_ARCHIVE_SINK:
+        return None
+    sink_class = import_string(settings.PING_ARCHIVE_SINK)
+    return sink_class if sink_class.is_available() else None
+
+
+def is_enabled():
+    return _get_sink_class() is not None
+
+
+def get_sink():
+    """
+    :return: the configured ArchiveSink instance or None if archiving is disabled.
+    """
+    sink_class = _get_sink_class()
+    return sink_class() if sink_class else None
+
+
+def make_record(device_id, data, last_ping):
+    """
+    Make a JSON serializable archive record from a normalized ping payload.
+    """
+    record = dict(data)
+    # logins may have empty string as a key. DataStore doesn't accept that.
+    logins = record.get('logins', [])
+    if type(logins) is dict:
+        logins = [{'username': k, 'failed': v['failed'], 'success': v['success']} for k, v in logins.items()]
+    record['logins'] = logins
+    record['device_id'] = device_id
+    record['last_ping'] = last_ping.isoformat()
+    return record
+
+
+def _redis_connection():
+    return redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
+
+
+def archive_pings(pings):
+    """
+    Buffer pings for archiving, dropping the ones which don't fit into the buffer.
+    :param pings: a list of (Device, normalized ping data, ping timestamp) tuples.
+    :return: the number of dropped pings.
+    """
+    from .tasks import export_ping_archive
+
+    if not pings:
+        return 0
+    records = [json.dumps(make_record(device.device_id, data, ping_time)) for device, data, ping_time in pings]
+    pipe = _redis_connection().pipeline()
+    pipe.rpush(settings.PING_ARCHIVE_QUEUE, *records)
+    pipe.ltrim(settings.PING_ARCHIVE_QUEUE, 0, settings.PING_ARCHIVE_MAXLEN - 1)
+    length, _ = pipe.execute()
+
+    dropped = min(len(records), max(0, length - settings.PING_ARCHIVE_MAXLEN))
+    if dropped:
+        dropped_counter.inc(dropped)
+        logger.warning('ping archive buffer is full, dropped %d pings.', dropped)
+    # Don't wait for the scheduled flush if a full batch has been buffered by this call.
+    if length - len(records) < settings.PING_ARCHIVE_BATCH_SIZE <= length:
+        export_ping_archive.delay()
+    return dropped
+
+
+def export(sink=None, max_batches=None):
+    """
+    Flush the buffered pings to the sink in batches of PING_ARCHIVE_BATCH_SIZE.
+    :param sink: ArchiveSink instance, the configured one by default.
+    :param max_batches: stop after this number of batches (flush the buffer completely if None).
+    :return: the number of exported pings.
+    """
+    sink = sink or get_sink()
+    if sink is None:
+        return 0
+    redis_conn = _redis_connection()
+    counter = batches = 0
+    try:
+        # Batches are removed from the buffer head after they've been exported, which is only safe with one exporter.
+        # Don't wait if another export is running. The lock times out with the `export_ping_archive` task.
+        with redis_conn.lock(EXPORT_LOCK, timeout=EXPORT_LOCK_TIMEOUT, blocking=False):
+            while max_batches is None or batches < max_batches:
+                batch = redis_conn.lrange(settings.PING_ARCHIVE_QUEUE, 0, settings.PING_ARCHIVE_BATCH_SIZE - 1)
+                if not batch:
+                    break
+                batches += 1
+                try:
+                    sink.put_multi([json.loads(record) for record in batch])
+                except Exception:
+                    logger.exception('ping archive export failed, %d pings left in the buffer.', len(batch))
+                    break
+                # New records are appended to the buffer tail, the exported ones are still at its head.
+                redis_conn.ltrim(settings.PING_ARCHIVE_QUEUE, len(batch), -1)
+                counter += len(batch)
+    except redis.exceptions.LockError:
+        logger.info('ping archive export is already running.')
+    return counter
@@ -0,0 +1,431 @@
+"""
+Ping ingestion: applying agent heartbeat payloads to the database.
+
+By default pings are applied synchronously by `MtlsPingView`. With `settings.PING_WRITE_BEHIND` enabled the view
+only validates a payload and appends it to a Redis stream; the stream is then drained in batches by the
+`ingest_pings` celery task which applies the writes in bulk.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import dateutil.parser
+import redis
+from netaddr import IPAddress, AddrFormatError
+from prometheus_client import Counter
+from rest_framework.exceptions import ValidationError
+
+from device_registry import parsers, ping_archive
+from device_registry.models import Device, DeviceInfo, PortScan, FirewallState, RecommendedAction, \
+    RecommendedActionStatus
+from device_registry.recommended_actions import ActionMeta
+
+logger = logging.getLogger('django')
+
+DEVICE_FIELDS = ['last_ping', 'agent_version', 'audit_files', 'deb_packages_hash', 'update_trust_score', 'os_release',
+                 'auto_upgrades', 'mysql_root_access', 'cpu', 'kernel_deb_package', 'reboot_required',
+                 'default_password_users', 'actions_version']
+DEVICE_INFO_FIELDS = ['device_operating_system_version', 'fqdn', 'ipv4_address', 'device_manufacturer',
+                      'device_model', 'selinux_state', 'app_armor_enabled', 'default_password']
+PORTSCAN_FIELDS = ['scan_date']
+FIREWALL_STATE_FIELDS = []
+# Big JSON fields (logins, processes, scan_info, netstat and firewall rules) are not listed above: they are saved only
+# when changed, see `set_json_field`.
+
+json_bytes_skipped_counter = Counter('ping_json_bytes_skipped',
+                                     'Bytes of unchanged ping JSON fields which were not written to DB.')
+
+
+def normalize_ping_data(data):
+    """
+    Validate a ping payload and convert it to the form stored in the database.
+    Some agent versions send `scan_info` and `firewall_rules` as JSON strings, they get decoded here. Missing
+    IP protocol version info is added to `scan_info` records.
+    :param data: a dict received from the agent.
+    :return: the same dict, updated in place.
+    :raise ValidationError: if the payload is malformed.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError('Ping data should be a dict.')
+    for field_name in ('scan_info', 'firewall_rules'):
+        if isinstance(data.get(field_name), str):
+            try:
+                data[field_name] = parsers.loads(data[field_name])
+            except ValueError:
+                raise ValidationError({field_name: 'Invalid JSON.'})
+    for record in data.get('scan_info') or []:
+        if 'ip_version' not in record:
+            try:
+                record['ip_version'] = IPAddress(record['host']).version
+            except (KeyError, ValueError, AddrFormatError):
+                raise ValidationError({'scan_info': 'Invalid host address.'})
+    deb_packages = data.get('deb_packages')
+    if deb_packages is not None and not (isinstance(deb_packages, dict) and 'hash' in deb_packages and
+                                         all(isinstance(deb_packages.get(key, []), list)
+                                             for key in ('packages', 'added', 'removed'))):
+        raise ValidationError({'deb_packages': 'Should contain "hash" and optionally "packages" or '
+                                               '"base_hash", "added" and "removed".'})
+    return data
+
+
+def apply_deb_packages(device, deb_packages, os_release):
+    """
+    Update the device's deb packages list unless it's known to be unchanged.
+    `deb_packages` may come in one of 3 forms:
+     - {'hash': ..., 'packages': [...]} - the full package list;
+     - {'hash': ...} - the agent omits the package list when its hash is the one returned by the ping GET endpoint;
+     - {'hash': ..., 'base_hash': ..., 'added': [...], 'removed': [...]} - the changes made since `base_hash`.
+    If the device's current hash doesn't match the one the agent relies on (e.g. it has changed in between) the package
+    list is not touched and the full resync is requested.
+    :return: a dict with the ping response fields, i.e. {'deb_packages_resync': True} if the resync is needed.
+    """
+    packages_hash = deb_packages['hash']
+    if packages_hash == device.deb_packages_hash:
+        return {}
+    if 'packages' in deb_packages:
+        device.set_deb_packages(deb_packages['packages'], os_release)
+    elif 'base_hash' in deb_packages and deb_packages['base_hash'] == device.deb_packages_hash \
+            and device.deb_packages_hash:
+        device.update_deb_packages(deb_packages.get('added', []), deb_packages.get('removed', []), os_release)
+    else:
+        # `deb_packages_hash` keeps its old value, so the agent will also see the mismatch on its next GET.
+        return {'deb_packages_resync': True}
+    device.deb_packages_hash = packages_hash
+    return {}
+
+
+def _package_key(package):
+    return package['name'], package['version'], package['arch']
+
+
+def merge_deb_packages(earlier, later):
+    """
+    Fold the `deb_packages` of two consecutive pings of a device into one with the same effect as applying them in
+    order (see apply_deb_packages()).
+    :param earlier: `deb_packages` of the earlier ping.
+    :param later: `deb_packages` of the later ping or None if it has none.
+    :return: `deb_packages` for the later ping.
+    """
+    if later is None:
+        return earlier
+    if 'packages' in later:
+        return later
+    if 'base_hash' not in later:
+        # The agent relies on the hash of the earlier ping's packages.
+        return earlier if later['hash'] == earlier['hash'] else later
+    if later['base_hash'] != earlier['hash'] or not ('packages' in earlier or 'base_hash' in earlier):
+        return later
+    removed = {_package_key(package) for package in later.get('removed', [])}
+    if 'packages' in earlier:
+        return {'hash': later['hash'],
+                'packages': [package for package in earlier['packages'] if _package_key(package) not in removed] +
+                later.get('added', [])}
+    earlier_added = {_package_key(package) for package in earlier.get('added', [])}
+    return {'hash': later['hash'],
+            'base_hash': earlier['base_hash'],
+            'added': [package for package in earlier.get('added', []) if _package_key(package) not in removed] +
+            later.get('added', []),
+            'removed': earlier.get('removed', []) +
+            [package for package in later.get('removed', []) if _package_key(package) not in earlier_added]}
+
+
+def _as_stored(value):
+    """
+    Convert a value to the form it takes after being stored in a JSONField and loaded back.
+    """
+    return json.loads(json.dumps(value))
+
+
+def get_action_inputs(device, device_info, portscan):
+    """
+    Get the values of the device inputs recommended actions depend on (see BaseAction.inputs).
+    :return: a dict of {DEVICE_INPUTS name: value}.
+    """
+    return {
+        'audit_files': _as_stored(device.audit_files),
+        'auto_upgrades': device.auto_upgrades,
+        'cpu': _as_stored(device.cpu),
+        'default_password_users': device.default_password_users,
+        'kernel_deb_package': device.kernel_deb_package_id,
+        'mysql_root_access': device.mysql_root_access,
+        'os_release': _as_stored(device.os_release),
+        'packages': device.package_set_id,
+        'processes': _as_stored(device_info.processes),
+        'reboot_required': device.reboot_required,
+        'scan_info': _as_stored(portscan.scan_info)
+    }
+
+
+def get_fingerprint(value):
+    """
+    :return: (fingerprint, serialized size in bytes) of a JSON field value.
+    """
+    serialized = json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.md5(serialized).hexdigest(), len(serialized)
+
+
+def set_json_field(obj, field_name, value, changed_fields):
+    """
+    Set a JSON field along with its fingerprint, unless the fingerprint hasn't changed.
+    :param changed_fields: a set of field names to be saved, updated in place.
+    :return: the number of bytes not written because the value hasn't changed.
+    """
+    hash_field_name = f'{field_name}_hash'
+    fingerprint, size = get_fingerprint(value)
+    if getattr(obj, hash_field_name) == fingerprint:
+        return size
+    setattr(obj, field_name, value)
+    setattr(obj, hash_field_name, fingerprint)
+    changed_fields.update((field_name, hash_field_name))
+    return 0
+
+
+def _bulk_update_changed(model, objects, fields, changed_fields):
+    """
+    `bulk_update()` the objects with one query per distinct set of changed fields.
+    :param fields: the fields saved for all objects.
+    :param changed_fields: a dict of {device pk: a set of changed field names}.
+    """
+    groups = defaultdict(list)
+    for obj in objects:
+        groups[frozenset(changed_fields[obj.device_id])].append(obj)
+    for group_fields, group in groups.items():
+        if fields or group_fields:
+            model.objects.bulk_update(group, fields + sorted(group_fields))
+
+
+def _get_or_create_for_devices(model, devices):
+    """
+    Bulk version of `get_or_create(device=...)` for models with a one-to-one relation to Device.
+    :return: a dict of {device pk: model instance}.
+    """
+    objects = {obj.device_id: obj for obj in model.objects.filter(device__in=devices)}
+    missing = [model(device=device) for device in devices if device.pk not in objects]
+    if missing:
+        model.objects.bulk_create(missing, ignore_conflicts=True)
+        objects = {obj.device_id: obj for obj in model.objects.filter(device__in=devices)}
+    return objects
+
+
+def apply_pings(pings):
+    """
+    Apply a number of ping payloads to the database using bulk queries where possible.
+    :param pings: a list of (Device, normalized ping data, ping timestamp) tuples, at most one per device.
+    :return: a list of dicts with extra ping response fields, one per ping.
+    """
+    if not pings:
+        return []
+    devices = [device for device, _, _ in pings]
+    results = {device.pk: {} for device in devices}
+    with transaction.atomic():
+        device_infos = _get_or_create_for_devices(DeviceInfo, devices)
+        portscans = _get_or_create_for_devices(PortScan, devices)
+        firewall_states = _get_or_create_for_devices(FirewallState, devices)
+        # First pings and the devices whose actions were evaluated before the action classes changed (e.g. a new
+        # one was added) get all actions evaluated.
+        actions_version = ActionMeta.classes_version()
+        evaluate_all = {device.pk for device in devices
+                        if device.last_ping is None or device.actions_version != actions_version}
+        old_inputs = {device.pk: get_action_inputs(device, device_infos[device.pk], portscans[device.pk])
+                      for device in devices}
+
+        for device, data, ping_time in pings:
+            os_release = data.get('os_release', {})
+            device.last_ping = ping_time
+            device.agent_version = data.get('agent_version')
+            device.audit_files = data.get('audit_files', [])
+            device.auto_upgrades = data.get('auto_upgrades')
+            if 'deb_packages' in data:
+                results[device.pk].update(apply_deb_packages(device, data['deb_packages'], os_release))
+            kernel_deb_package = data.get('kernel_package')
+            if kernel_deb_package:
+                device.kernel_deb_package = device.deb_packages.get(name=kernel_deb_package['name'],
+                                                                    version=kernel_deb_package['version'],
+                                                                    arch=kernel_deb_package['arch'],
+                                                                    os_release_codename=os_release['codename'])
+            else:
+                device.kernel_deb_package = None
+            device.reboot_required = data.get('reboot_required')
+            device.cpu = data.get('cpu', {})
+            device.os_release = os_release
+            device.mysql_root_access = data.get('mysql_root_access')
+            device.default_password_users = data.get('default_password_users')
+            device.update_trust_score = True
+            device.actions_version = actions_version
+
+        now = timezone.now()
+        changed_fields = {model: defaultdict(set) for model in (DeviceInfo, PortScan, FirewallState)}
+        bytes_skipped = 0
+        for device, data, _ in pings:
+            device_info = device_infos[device.pk]
+            device_info_changed = changed_fields[DeviceInfo][device.pk]
+            device_info.device_operating_system_version = data.get('device_operating_system_version')
+            device_info.fqdn = data.get('fqdn')
+            device_info.ipv4_address = data.get('ipv4_address')
+            device_info.device_manufacturer = data.get('device_manufacturer')
+            device_info.device_model = data.get('device_model')
+            device_info.selinux_state = data.get('selinux_status', {})
+            device_info.app_armor_enabled = data.get('app_armor_enabled')
+            bytes_skipped += set_json_field(device_info, 'logins', data.get('logins', {}), device_info_changed)
+            processes = data.get('processes')
+            if processes:
+                # Convert from list to dict.
+                processes = {e['pid']: (e['name'], e['username'], e['cmdline'], e.get('container'))
+                             for e in processes}
+            bytes_skipped += set_json_field(device_info, 'processes', processes or {}, device_info_changed)
+            device_info.default_password = data.get('default_password')
+
+            portscan = portscans[device.pk]
+            portscan_changed = changed_fields[PortScan][device.pk]
+            portscan.scan_date = now  # bulk_update() doesn't handle auto_now.
+            bytes_skipped += set_json_field(portscan, 'scan_info', data.get('scan_info', []), portscan_changed)
+            bytes_skipped += set_json_field(portscan, 'netstat', data.get('netstat', []), portscan_changed)
+
+            bytes_skipped += set_json_field(firewall_states[device.pk], 'rules', data.get('firewall_rules', {}),
+                                            changed_fields[FirewallState][device.pk])
+
+        _bulk_update_changed(DeviceInfo, device_infos.values(), DEVICE_INFO_FIELDS, changed_fields[DeviceInfo])
+        _bulk_update_changed(PortScan, portscans.values(), PORTSCAN_FIELDS, changed_fields[PortScan])
+        _bulk_update_changed(FirewallState, firewall_states.values(), FIREWALL_STATE_FIELDS,
+                             changed_fields[FirewallState])
+        json_bytes_skipped_counter.inc(bytes_skipped)
+        Device.objects.bulk_update(devices, DEVICE_FIELDS)
+
+        # Un-snooze recommended actions which were "Fixed" (i.e. snoozed until next ping)
+        unsnoozed = RecommendedActionStatus.objects.filter(device__in=devices,
+                                                           status=RecommendedAction.Status.SNOOZED_UNTIL_PING)
+        unsnoozed_classes = defaultdict(set)
+        for device_pk, action_class in unsnoozed.values_list('device_id', 'ra__action_class'):
+            unsnoozed_classes[device_pk].add(action_class)
+        unsnoozed.update(status=RecommendedAction.Status.AFFECTED)
+        for device in devices:
+            device.set_meta_tags()
+            if device.pk in evaluate_all:
+                classes = None
+            else:
+                # Only re-evaluate the actions whose inputs have changed, and the "fixed" ones to check that.
+                new_inputs = get_action_inputs(device, device_infos[device.pk], portscans[device.pk])
+                changed = {name for name, value in new_inputs.items() if value != old_inputs[device.pk][name]}
+                classes = [action_class for action_class in ActionMeta.all_classes()
+                           if action_class in ActionMeta.classes_for_inputs(changed) or
+                           action_class.__name__ in unsnoozed_classes[device.pk]]
+            device.generate_recommended_actions(classes=classes)
+
+    if ping_archive.is_enabled():
+        ping_archive.archive_pings(pings)
+    return [results[device.pk] for device in devices]
+
+
+def apply_pings_safely(pings):
+    """
+    Apply pings in one batch. If the batch fails as a whole its pings are retried one by one, so that a single
+    malformed ping is logged and dropped instead of failing the others.
+    :return: a list of dicts with extra ping response fields (None for dropped pings), one per ping.
+    """
+    try:
+        return apply_pings(pings)
+    except Exception:
+        logger.exception('batch failed, applying pings one by one.')
+    results = []
+    for device, data, ping_time in pings:
+        try:
+            device.refresh_from_db()  # Discard the changes made by the failed batch.
+            results += apply_pings([(device, data, ping_time)])
+        except Exception:
+            logger.exception('dropping ping from %s.' % device.device_id)
+            results.append(None)
+    return results
+
+
+def _redis_connection():
+    return redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, password=settings.REDIS_PASSWORD)
+
+
+def enqueue_ping(device_id, data, ping_time=None):
+    """
+    Append a normalized ping payload to the ingestion stream.
+    :return: Redis stream message id.
+    """
+    redis_conn = _redis_connection()
+    return redis_conn.xadd(settings.PING_STREAM, {
+        'device_id': device_id,
+        'last_ping': (ping_time or timezone.now()).isoformat(),
+        'data': json.dumps(data)
+    }, maxlen=settings.PING_STREAM_MAXLEN, approximate=True)
+
+
+def _ensure_consumer_group(redis_conn):
+    try:
+        redis_conn.xgroup_create(settings.PING_STREAM, settings.PING_STREAM_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def _read_batch(redis_conn, consumer):
+    """
+    Read the next batch of messages: 1st reclaim the ones left unacknowledged by dead consumers for too long,
+    then read new ones.
+    :return: a list of (message id, fields dict) tuples.
+    """
+    pending = redis_conn.xpending_range(settings.PING_STREAM, settings.PING_STREAM_GROUP, '-', '+',
+                                        settings.PING_INGEST_BATCH_SIZE)
+    stale_ids = [p['message_id'] for p in pending
+                 if p['time_since_delivered'] >= settings.PING_STREAM_CLAIM_IDLE_MS]
+    if stale_ids:
+        messages = redis_conn.xclaim(settings.PING_STREAM, settings.PING_STREAM_GROUP, consumer,
+                                     settings.PING_STREAM_CLAIM_IDLE_MS, stale_ids)
+        messages = [m for m in messages if m[1]]  # Skip messages trimmed from the stream.
+        if messages:
+            return messages
+    response = redis_conn.xreadgroup(settings.PING_STREAM_GROUP, consumer, {settings.PING_STREAM: '>'},
+                                     count=settings.PING_INGEST_BATCH_SIZE)
+    return response[0][1] if response else []
+
+
+def _decode_messages(messages):
+    """
+    Decode stream messages keeping only the last ping for every device. The package lists and changes of the dropped
+    pings are folded into the kept one.
+    :return: a dict of {device_id: (ping data, ping timestamp)}.
+    """
+    latest = {}
+    for _, fields in messages:
+        device_id = fields[b'device_id'].decode()
+        data = json.loads(fields[b'data'])
+        previous = latest.get(device_id)
+        if previous is not None and 'deb_packages' in previous[0]:
+            data['deb_packages'] = merge_deb_packages(previous[0]['deb_packages'], data.get('deb_packages'))
+        latest[device_id] = (data, dateutil.parser.parse(fields[b'last_ping'].decode()))
+    return latest
+
+
+def consume_pings(max_batches=None):
+    """
+    Drain the ping ingestion stream in batches.
+    :param max_batches: stop after this number of batches (drain the stream completely if None).
+    :return: the number of pings applied.
+    """
+    redis_conn = _redis_connection()
+    _ensure_consumer_group(redis_conn)
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    counter = batches = 0
+    while max_batches is None or batches < max_batches:
+        messages = _read_batch(redis_conn, consumer)
+        if not messages:
+            break
+        batches += 1
+        latest = _decode_messages(messages)
+        devices = Device.objects.filter(device_id__in=latest.keys())
+        pings = [(device, *latest[device.device_id]) for device in devices]
+        counter += sum(result is not None for result in apply_pings_safely(pings))
+        redis_conn.xack(settings.PING_STREAM, settings.PING_STREAM_GROUP, *[message_id for message_id, _ in messages])
+        logger.info('%d messages processed, %d pings applied.' % (len(messages), len(pings)))
+    return counter
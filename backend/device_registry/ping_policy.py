@@ -0,0 +1,109 @@
+"""
+Firewall policy served to agents by the ping GET endpoint.
+
+The policy body only depends on the device's FirewallState, PortScan.block_* fields (or its GlobalPolicy), which
+change rarely. So the body is cached per policy along with a strong ETag calculated from those inputs. The spam
+networks blocklist (see `device_registry.blocklist`) is either appended to `block_networks` or, for agents which can
+fetch it separately, referenced by its version. The agent can skip downloading the response by sending its ETag back
+in the `If-None-Match` header.
+
+Every device has a cached pointer to its policy: either its own one or the GlobalPolicy it uses. Both the pointer and
+the body are invalidated when the corresponding models are saved or deleted (see the receivers below), bulk updates
+bypass it. The cache entries also expire after PING_POLICY_CACHE_TIMEOUT, which bounds the staleness when a
+per-process cache backend is used.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import blocklist
+from .models import FirewallState, GlobalPolicy, PortScan
+
+
+def _pointer_key(device_pk):
+    return f'ping-policy-pointer:{device_pk}'
+
+
+def _policy_key(policy_id):
+    return f'ping-policy:{policy_id}'
+
+
+def _invalidate(keys):
+    cache.delete_many(keys)
+    # Also drop the entries re-cached by concurrent requests before the change is committed.
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def _build_policy(device):
+    """
+    Read the device's policy from DB.
+    :return: (policy id, {'etag': str, 'body': dict})
+    """
+    portscan_object, _ = PortScan.objects.get_or_create(device=device)
+    firewallstate_object, _ = FirewallState.objects.get_or_create(device=device)
+    if firewallstate_object.global_policy:  # Use security settings from the global policy.
+        policy_id = f'global-{firewallstate_object.global_policy_id}'
+        block_networks = firewallstate_object.global_policy.networks
+        block_ports = firewallstate_object.global_policy.ports
+        policy_string = firewallstate_object.global_policy.policy_string
+        ports_field_name = firewallstate_object.global_policy.ports_field_name
+    else:  # User's per-device security settings.
+        policy_id = f'device-{device.pk}'
+        block_networks = portscan_object.block_networks
+        block_ports = portscan_object.block_ports
+        policy_string = firewallstate_object.policy_string
+        ports_field_name = firewallstate_object.ports_field_name
+    inputs = json.dumps([policy_string, ports_field_name, block_ports, block_networks], sort_keys=True)
+    body = {'policy': policy_string, ports_field_name: block_ports, 'block_networks': block_networks}
+    return policy_id, {'etag': hashlib.sha1(inputs.encode()).hexdigest(), 'body': body}
+
+
+def get_policy(device, spam_networks_ref=False):
+    """
+    Get the ping GET response for the device.
+    :param device: Device
+    :param spam_networks_ref: reference the spam networks blocklist by `spam_networks_version` instead of appending
+     it to `block_networks`.
+    :return: (ETag, response dict)
+    """
+    policy_id = cache.get(_pointer_key(device.pk))
+    policy = cache.get(_policy_key(policy_id)) if policy_id else None
+    if policy is None:
+        policy_id, policy = _build_policy(device)
+        cache.set_many({_pointer_key(device.pk): policy_id, _policy_key(policy_id): policy},
+                       settings.PING_POLICY_CACHE_TIMEOUT)
+    spam_networks = blocklist.get_current()
+    response = dict(policy['body'], deb_packages_hash=device.deb_packages_hash)
+    if spam_networks_ref:
+        response['spam_networks_version'] = spam_networks.version
+    else:
+        response['block_networks'] = response['block_networks'] + spam_networks.block_networks
+    etag = hashlib.sha1(f'{policy["etag"]}:{spam_networks.digest}:{spam_networks_ref:d}:'
+                        f'{device.deb_packages_hash}'.encode()).hexdigest()
+    return f'"{etag}"', response
+
+
+@receiver(post_save, sender=GlobalPolicy, dispatch_uid='ping_policy_global_policy_saved')
+@receiver(post_delete, sender=GlobalPolicy, dispatch_uid='ping_policy_global_policy_deleted')
+def invalidate_global_policy(sender, instance, **kwargs):
+    # Devices which used a deleted policy still point to it, so they'll miss the cache and re-read it from DB.
+    _invalidate([_policy_key(f'global-{instance.pk}')])
+
+
+@receiver(post_save, sender=FirewallState, dispatch_uid='ping_policy_firewall_state_saved')
+@receiver(post_delete, sender=FirewallState, dispatch_uid='ping_policy_firewall_state_deleted')
+def invalidate_firewall_state(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'policy', 'global_policy'} & set(update_fields):
+        _invalidate([_pointer_key(instance.device_id), _policy_key(f'device-{instance.device_id}')])
+
+
+@receiver(post_save, sender=PortScan, dispatch_uid='ping_policy_portscan_saved')
+@receiver(post_delete, sender=PortScan, dispatch_uid='ping_policy_portscan_deleted')
+def invalidate_portscan(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'block_ports', 'block_networks'} & set(update_fields):
+        _invalidate([_policy_key(f'device-{instance.device_id}')])
@@ -1,12 +1,15 @@
 from collections import defaultdict
+import hashlib
 from datetime import timedelta
 from enum import IntEnum
+from itertools import groupby
+from operator import itemgetter
 from typing import NamedTuple, List
 from urllib.parse import urljoin
 
 import redis
 from django.conf import settings
-from django.db.models import Q, QuerySet, Max, F
+from django.db.models import Q, QuerySet, F
 from django.urls import reverse
 from django.utils import timezone
 
@@ -176,6 +179,11 @@ def device_link(device, absolute=False):
     return f'[{device.get_name()}]({url})'
 
 
+# Device data received with pings which recommended actions depend on.
+DEVICE_INPUTS = ('audit_files', 'auto_upgrades', 'cpu', 'default_password_users', 'kernel_deb_package',
+                 'mysql_root_access', 'os_release', 'packages', 'processes', 'reboot_required', 'scan_info')
+
+
 class BaseAction:
     """
     Common base action class.
@@ -184,6 +192,9 @@ class BaseAction:
     """
     doc_url = 'https://wott.io/documentation/faq'
     has_param = False
+    # Names of the device inputs (DEVICE_INPUTS) this action depends on. On ping it is re-evaluated only if some of
+    # them have changed. None means it depends on something else and is re-evaluated on every ping.
+    inputs = None
 
     @classmethod
     def severity(cls, param=None):
@@ -371,6 +382,25 @@ class ParamAction(BaseAction):
             raise NotImplementedError
         return cls._get_context(param)
 
+    @classmethod
+    def get_contexts(cls, params) -> dict:
+        """
+        Batch form of get_context(). Calls get_context() for every param, subclasses may override this to compute
+        all contexts at once.
+        :param params: an iterable of params.
+        :return: {param: context}
+        """
+        return {param: cls.get_context(param) for param in params}
+
+    @classmethod
+    def severities(cls, params) -> dict:
+        """
+        Batch form of severity(). Calls severity() for every param, subclasses may override this.
+        :param params: an iterable of params.
+        :return: {param: Severity}
+        """
+        return {param: cls.severity(param) for param in params}
+
     @classmethod
     def affected_devices(cls, qs) -> List[ParamStatusQS]:
         """
@@ -462,12 +492,32 @@ class ActionMeta(type):
     def get_class(meta, id):
         return meta._action_classes.get(id)
 
+    @classmethod
+    def classes_version(meta) -> str:
+        """
+        Get a fingerprint of the registered action classes and their inputs. It changes when an action class is added
+        or removed, or its inputs change.
+        """
+        classes = sorted(meta.all_classes(), key=lambda c: c.__name__)
+        return hashlib.md5(';'.join(f'{c.__name__}:{c.inputs}' for c in classes).encode()).hexdigest()
+
+    @classmethod
+    def classes_for_inputs(meta, changed_inputs) -> List[BaseAction]:
+        """
+        Get a list of registered action classes which depend on any of the changed device inputs, including the ones
+        which don't declare their inputs.
+        :param changed_inputs: a set of DEVICE_INPUTS names.
+        """
+        return [c for c in meta.all_classes() if c.inputs is None or changed_inputs.intersection(c.inputs)]
+
 
 # Below is the code for real actions classes.
 # Don't forget to add metaclass=ActionMeta.
 
 # Firewall disabled action.
 class FirewallDisabledAction(SimpleAction, metaclass=ActionMeta):
+    inputs = None  # The global policy applied to the device may be changed between pings.
+
     @classmethod
     def _affected_devices(cls, qs):
         from .models import FirewallState, GlobalPolicy
@@ -491,6 +541,7 @@ class FirewallDisabledAction(SimpleAction, metaclass=ActionMeta):
 
 # OS reboot required action.
 class RebootRequiredAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('reboot_required',)
     _severity = Severity.MED
 
     @classmethod
@@ -504,6 +555,8 @@ class RebootRequiredAction(SimpleAction, metaclass=ActionMeta):
 
 # Automatic security update disabled action.
 class AutoUpdatesAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('auto_upgrades',)
+
     @classmethod
     def _affected_devices(cls, qs):
         return qs.filter(auto_upgrades=False)
@@ -519,6 +572,8 @@ class AutoUpdatesAction(SimpleAction, metaclass=ActionMeta):
 
 # FTP listening on port 21 action.
 class FtpServerAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('scan_info',)
+
     @classmethod
     def _is_affected(cls, device) -> bool:
         return device.is_ftp_public is True
@@ -530,6 +585,8 @@ class FtpServerAction(SimpleAction, metaclass=ActionMeta):
 
 # MySQL root default password action.
 class MySQLDefaultRootPasswordAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('mysql_root_access',)
+
     @classmethod
     def _affected_devices(cls, qs):
         return qs.filter(mysql_root_access=True)
@@ -544,6 +601,8 @@ class MySQLDefaultRootPasswordAction(SimpleAction, metaclass=ActionMeta):
 
 
 class PubliclyAccessibleServiceAction(ParamAction, metaclass=ActionMeta):
+    inputs = ('processes', 'scan_info')
+
     @classmethod
     def _get_context(cls, param):
         service_info = PUBLIC_SERVICE_PORTS[param]
@@ -562,6 +621,15 @@ class PubliclyAccessibleServiceAction(ParamAction, metaclass=ActionMeta):
 
 
 class CpuVulnerableAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('cpu', 'kernel_deb_package')
+
+    @classmethod
+    def _affected_devices(cls, qs):
+        from .models import Device
+        return qs.filter(cpu__vendor='GenuineIntel', kernel_deb_package__isnull=False).filter(
+            Q(kernel_deb_package__vulnerabilities__name__in=Device.KERNEL_CPU_CVES) |
+            Q(cpu__mitigations_disabled=True)).distinct()
+
     @classmethod
     def _is_affected(cls, device):
         return device.cpu_vulnerable is True
@@ -572,6 +640,7 @@ class CpuVulnerableAction(SimpleAction, metaclass=ActionMeta):
 
 
 class AuditdNotInstalledAction(SimpleAction, metaclass=ActionMeta):
+    inputs = ('os_release', 'packages')
     _severity = Severity.MED
 
     @classmethod
@@ -587,8 +656,8 @@ class AuditdNotInstalledAction(SimpleAction, metaclass=ActionMeta):
     def _affected_devices(cls, qs):
         from .models import DEBIAN_SUITES, UBUNTU_SUITES
         return qs.filter(
-            (Q(os_release__codename__in=DEBIAN_SUITES + UBUNTU_SUITES) & ~Q(deb_packages__name='auditd')) |
-            (Q(os_release__codename='amzn2') & ~Q(deb_packages__name='audit'))
+            (Q(os_release__codename__in=DEBIAN_SUITES + UBUNTU_SUITES) & ~Q(package_set__packages__name='auditd')) |
+            (Q(os_release__codename='amzn2') & ~Q(package_set__packages__name='audit'))
         ).distinct()
 
 
@@ -596,6 +665,8 @@ class AuditdNotInstalledAction(SimpleAction, metaclass=ActionMeta):
 
 # Default username/password used action.
 class DefaultCredentialsAction(ParamAction, metaclass=ActionMeta):
+    inputs = ('default_password_users',)
+
     @classmethod
     def affected_devices(cls, qs) -> List[ParamStatusQS]:
         all_users = defaultdict(list)
@@ -618,6 +689,8 @@ class DefaultCredentialsAction(ParamAction, metaclass=ActionMeta):
 
 
 class InsecureServicesAction(ParamAction, metaclass=ActionMeta):
+    inputs = ('packages',)
+
     @classmethod
     def _get_context(cls, param):
         return {'service': param}
@@ -625,7 +698,7 @@ class InsecureServicesAction(ParamAction, metaclass=ActionMeta):
     @classmethod
     def affected_devices(cls, qs):
         return [ParamStatusQS(name, qs.exclude(deb_packages_hash='').filter(
-                deb_packages__name=name).distinct()) for name, _  in INSECURE_SERVICES]
+                package_set__packages__name=name).distinct()) for name, _  in INSECURE_SERVICES]
 
     @classmethod
     def affected_params(cls, device) -> List[ParamStatus]:
@@ -638,6 +711,8 @@ class InsecureServicesAction(ParamAction, metaclass=ActionMeta):
 
 
 class OpensshIssueAction(ParamAction, metaclass=ActionMeta):
+    inputs = ('audit_files',)
+
     @classmethod
     def _get_context(cls, param):
         safe_value, doc_url, _ = SSHD_CONFIG_PARAMS_INFO[param]
@@ -659,11 +734,13 @@ class OpensshIssueAction(ParamAction, metaclass=ActionMeta):
 
 
 class CVEAction(ParamAction, metaclass=ActionMeta):
+    inputs = ('packages',)
+
     @classmethod
-    def _get_context(cls, param):
-        from .models import DebPackage
-        packages = DebPackage.objects.filter(vulnerabilities__name=param, vulnerabilities__fix_available=True) \
-            .values_list('name', flat=True).distinct().order_by('name')
+    def _make_context(cls, param, packages):
+        """
+        :param packages: a sorted list of names of the packages affected by the CVE.
+        """
         packages_spaced = ' '.join(packages)
         packages_list = '\n'.join(f'* {p}' for p in packages)
         n = len(packages)
@@ -683,13 +760,31 @@ class CVEAction(ParamAction, metaclass=ActionMeta):
                 'cve_name': param,
                 'cve_link': 'http://cve.mitre.org/cgi-bin/cvename.cgi?name='+param}
 
+    @classmethod
+    def _get_context(cls, param):
+        from .models import DebPackage
+        packages = DebPackage.objects.filter(vulnerabilities__name=param, vulnerabilities__fix_available=True) \
+            .values_list('name', flat=True).distinct().order_by('name')
+        return cls._make_context(param, list(packages))
+
+    @classmethod
+    def get_contexts(cls, params):
+        """
+        Get the contexts of many CVEs with a single query.
+        :return: {param: context}; CVEs which affect no packages are omitted.
+        """
+        from .models import DebPackage
+        packages = DebPackage.objects.filter(vulnerabilities__name__in=params, vulnerabilities__fix_available=True) \
+            .values_list('vulnerabilities__name', 'name').distinct().order_by('vulnerabilities__name', 'name')
+        return {param: cls._make_context(param, [name for _, name in group])
+                for param, group in groupby(packages, key=itemgetter(0))}
+
     @classmethod
     def affected_devices(cls, qs) -> List[ParamStatusQS]:
-        from .models import Vulnerability, Device
-        severity_none = Vulnerability.objects.values('name').annotate(max_urgency=Max('urgency')) \
-            .filter(max_urgency=Vulnerability.Urgency.NONE).values('name')
-        vv = Vulnerability.objects.filter(debpackage__device__in=qs, fix_available=True)\
-                                  .annotate(device=F('debpackage__device'))\
+        from .models import CveSummary, Vulnerability, Device
+        severity_none = CveSummary.objects.filter(max_urgency=Vulnerability.Urgency.NONE).values('name')
+        vv = Vulnerability.objects.filter(debpackage__package_sets__devices__in=qs, fix_available=True)\
+                                  .annotate(device=F('debpackage__package_sets__devices'))\
                                   .values('name', 'device').distinct()\
                                   .exclude(name__in=severity_none)\
                                   .order_by('name')
@@ -708,20 +803,25 @@ class CVEAction(ParamAction, metaclass=ActionMeta):
 
     @classmethod
     def affected_params(cls, device):
-        from .models import Vulnerability
-        severity_none = Vulnerability.objects.values('name').annotate(max_urgency=Max('urgency'))\
-            .filter(max_urgency=Vulnerability.Urgency.NONE).values('name')
-        vulns = Vulnerability.objects.filter(debpackage__device=device, fix_available=True)\
+        from .models import CveSummary, Vulnerability
+        severity_none = CveSummary.objects.filter(max_urgency=Vulnerability.Urgency.NONE).values('name')
+        vulns = Vulnerability.objects.filter(debpackage__package_sets__devices=device, fix_available=True)\
                                      .values_list('name', flat=True).distinct()\
                                      .exclude(name__in=severity_none)
         return [ParamStatus(name, True) for name in vulns]
 
     @classmethod
     def severity(cls, param):
-        from .models import Vulnerability
-        severity = Vulnerability.objects.filter(name=param).aggregate(Max('urgency'))['urgency__max']
+        from .models import CveSummary
+        severity = CveSummary.objects.filter(name=param).values_list('max_urgency', flat=True).first()
         return Severity(severity or 1)
 
+    @classmethod
+    def severities(cls, params):
+        from .models import CveSummary
+        severities = dict(CveSummary.objects.filter(name__in=params).values_list('name', 'max_urgency'))
+        return {param: Severity(severities.get(param) or 1) for param in params}
+
 # --- Fleet-wide actions ---
 
 class GithubAction(BaseAction, metaclass=ActionMeta):
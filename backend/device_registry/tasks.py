@@ -1,5 +1,7 @@
 from celery import shared_task
+from django.conf import settings
 
+from . import ping_archive, ping_ingest
 from .celery_tasks import common, github, amazon_cve, debian_cve, ubuntu_cve
 
 # We allow process 50 devices for 10m because currently this operation
@@ -15,13 +17,18 @@ def send_devices_to_trust_score_update():
 
 
 @shared_task(soft_time_limit=60, time_limit=60 + 5)  # Should live 1m max.
-def update_packages_vulnerabilities(batch):
-    return common.update_packages_vulnerabilities(batch)
+def update_packages_vulnerabilities(batch, run_id=None):
+    return common.update_packages_vulnerabilities(batch, run_id)
+
+
+@shared_task(soft_time_limit=60 * 30, time_limit=60 * 30 + 5)  # Should live 30m max.
+def update_cve_ra():
+    return common.update_cve_ra()
 
 
 @shared_task(soft_time_limit=60 * 2.5, time_limit=60 * 2.5 + 5)  # Should live 2.5m max.
 def send_packages_to_vulns_update():
-    return common.send_packages_to_vulns_update(update_packages_vulnerabilities)
+    return common.send_packages_to_vulns_update(update_packages_vulnerabilities, update_cve_ra)
 
 
 @shared_task(soft_time_limit=60 * 20, time_limit=60 * 20 + 5)  # Should live 20m max.
@@ -47,3 +54,18 @@ def file_github_issues(profile_pk=None):
 @shared_task(soft_time_limit=60 * 10, time_limit=60 * 10 + 5)  # Should live 10m max.
 def sample_history():
     return common.sample_history()
+
+
+@shared_task(soft_time_limit=60 * 10, time_limit=60 * 10 + 5)  # Should live 10m max.
+def delete_orphan_package_sets():
+    return common.delete_orphan_package_sets()
+
+
+@shared_task(soft_time_limit=60, time_limit=60 + 5)  # Should live 1m max.
+def ingest_pings():
+    return ping_ingest.consume_pings(max_batches=settings.PING_INGEST_MAX_BATCHES)
+
+
+@shared_task(soft_time_limit=60, time_limit=60 + 5)  # Should live 1m max.
+def export_ping_archive():
+    return ping_archive.export(max_batches=settings.PING_ARCHIVE_MAX_BATCHES)
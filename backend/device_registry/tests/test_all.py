@@ -1,5 +1,6 @@
 import json
 import sys
+import tempfile
 from collections import defaultdict
 from unittest.mock import patch, Mock
 
@@ -8,7 +9,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.http import urlencode
 
 from cryptography import x509
@@ -19,13 +20,16 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.x509.oid import NameOID
 from freezegun import freeze_time
 
-from device_registry import ca_helper
-from device_registry.models import DebPackage, Device, DeviceInfo, FirewallState, PortScan, \
-    GlobalPolicy, PairingKey, Vulnerability, RecommendedAction, HistoryRecord, RecommendedActionStatus
+from device_registry import ca_helper, versions, vulnerability_index
+from device_registry.celery_tasks.common import delete_orphan_package_sets
+from device_registry.models import DebPackage, Device, DeviceInfo, FirewallState, PortScan, PackageSet, \
+    GlobalPolicy, PairingKey, Vulnerability, RecommendedAction, HistoryRecord, RecommendedActionStatus, \
+    VulnerabilityGeneration, CveSummary
 from device_registry.forms import DeviceAttrsForm, PortsForm, ConnectionsForm, FirewallStateGlobalPolicyForm
 from device_registry.forms import GlobalPolicyForm
 from device_registry.recommended_actions import ActionMeta, Severity, SimpleAction
 from device_registry.views import CVEView
+from device_registry.vulnerability_index import VulnerabilityIndex
 from profile_page.models import Profile
 
 
@@ -319,6 +323,82 @@ class DeviceModelTest(TestCase):
         real_average_score = ((self.device0.trust_score + self.device1.trust_score) / 2.0)
         self.assertLessEqual(abs(average_score - real_average_score), 2*sys.float_info.epsilon)
 
+    def test_set_deb_packages(self):
+        # A package saved by an old agent version, without source_name.
+        old_pkg = DebPackage.objects.create(os_release_codename='stretch', name='libssl', version='1.0.0',
+                                            arch='i386', processed=True)
+        other_pkg = DebPackage.objects.create(os_release_codename='buster', name='libssl', version='1.0.0',
+                                              arch='i386', processed=True)
+        packages = [{'name': 'libssl', 'version': '1.0.0', 'source_name': 'openssl', 'source_version': '1.0.0',
+                     'arch': 'i386'},
+                    {'name': 'python3', 'version': '3.7.3', 'source_name': 'python3-defaults',
+                     'source_version': '3.7.3', 'arch': 'all'}]
+        self.device0.set_deb_packages(packages, {'codename': 'stretch'})
+        self.assertQuerysetEqual(self.device0.deb_packages.order_by('name'), ['libssl', 'python3'],
+                                 transform=lambda p: p.name)
+        old_pkg.refresh_from_db()
+        self.assertEqual((old_pkg.source_name, old_pkg.source_version, old_pkg.processed), ('openssl', '1.0.0', False))
+        other_pkg.refresh_from_db()
+        self.assertEqual((other_pkg.source_name, other_pkg.processed), ('', True))
+
+        self.device0.set_deb_packages(packages[1:], {'codename': 'stretch'})
+        self.assertQuerysetEqual(self.device0.deb_packages.all(), ['python3'], transform=lambda p: p.name)
+
+    def test_package_sets(self):
+        packages = [DebPackage.objects.create(os_release_codename='stretch', name=f'package{i}', version='1.0',
+                                              arch='all') for i in range(3)]
+        self.device0.deb_packages.set(packages[:2])
+        self.device1.deb_packages.set(reversed(packages[:2]))
+        # Devices with the same packages share the same set.
+        self.assertEqual(PackageSet.objects.count(), 1)
+        self.assertEqual(self.device0.package_set, self.device1.package_set)
+        self.assertEqual(self.device0.package_set.hash, PackageSet.get_hash([p.pk for p in packages[:2]]))
+
+        # The set is never modified, the device is pointed to another one instead.
+        self.device1.deb_packages.add(packages[2])
+        self.assertNotEqual(self.device0.package_set, self.device1.package_set)
+        self.assertQuerysetEqual(self.device0.deb_packages.order_by('name'), ['package0', 'package1'],
+                                 transform=lambda p: p.name)
+        self.assertQuerysetEqual(self.device1.deb_packages.order_by('name'), ['package0', 'package1', 'package2'],
+                                 transform=lambda p: p.name)
+
+        self.device1.deb_packages.remove(packages[2])
+        self.assertEqual(self.device0.package_set, self.device1.package_set)
+        # The orphan set was used recently.
+        self.assertEqual(delete_orphan_package_sets(), 0)
+        PackageSet.objects.update(last_used=timezone.now() - timezone.timedelta(days=1))
+        self.assertEqual(delete_orphan_package_sets(), 1)
+        self.assertEqual(PackageSet.objects.count(), 1)
+
+        # Reusing an orphan set marks it used.
+        self.device1.deb_packages.add(packages[2])
+        self.device1.deb_packages.remove(packages[2])
+        PackageSet.objects.update(last_used=timezone.now() - timezone.timedelta(days=1))
+        self.device1.deb_packages.add(packages[2])
+        self.assertEqual(delete_orphan_package_sets(), 0)
+
+    def test_package_set_deleted(self):
+        packages = [DebPackage.objects.create(os_release_codename='stretch', name=f'package{i}', version='1.0',
+                                              arch='all') for i in range(2)]
+        package_ids = [p.pk for p in packages]
+        orphan = PackageSet.get_or_create_for(package_ids)
+        get_or_create = PackageSet.objects.get_or_create
+        created_list = []
+
+        def get_and_delete(**kwargs):
+            package_set, created = get_or_create(**kwargs)
+            if not created_list:
+                # The orphan set is deleted right after it's fetched.
+                PackageSet.objects.filter(pk=package_set.pk).delete()
+            created_list.append(created)
+            return package_set, created
+
+        with patch.object(PackageSet.objects, 'get_or_create', side_effect=get_and_delete):
+            package_set = PackageSet.get_or_create_for(package_ids)
+        self.assertListEqual(created_list, [False, True])
+        self.assertNotEqual(package_set.pk, orphan.pk)
+        self.assertSetEqual(set(package_set.packages.values_list('pk', flat=True)), set(package_ids))
+
     def test_heartbleed(self):
         self.assertIsNone(self.device0.heartbleed_vulnerable)
 
@@ -1527,6 +1607,7 @@ class CVEViewTests(TestCase):
         ]
         DebPackage.objects.bulk_create(self.packages)
         Vulnerability.objects.bulk_create(self.vulns)
+        CveSummary.refresh()
         self.device0.deb_packages.set(self.packages)
         self.device_unrelated.deb_packages.set(self.packages)
 
@@ -1548,6 +1629,7 @@ class CVEViewTests(TestCase):
                           other_versions=[], urgency=Vulnerability.Urgency.LOW, fix_available=True)
         ]
         Vulnerability.objects.bulk_create(vulns)
+        CveSummary.refresh()
 
         packages = [
             DebPackage(name='uno_first', version='version_uno', source_name='uno_source', source_version='uno_version',
@@ -1712,6 +1794,7 @@ class CVECountTests(TestCase):
                           other_versions=[], urgency=Vulnerability.Urgency.LOW, fix_available=False)
         ]
         Vulnerability.objects.bulk_create(self.vulns)
+        CveSummary.refresh()
         self.packages[0].vulnerabilities.set(self.vulns)
         self.packages[1].vulnerabilities.set(self.vulns)
 
@@ -1759,3 +1842,106 @@ class CVECountTests(TestCase):
             self.profile.sample_history()
 
         self.assertTupleEqual(self.profile.cve_count_last_week, (1, 2, 3))
+
+
+class VulnerabilityTests(TestCase):
+    def test_is_vulnerable_deb(self):
+        vuln = Vulnerability(os_release_codename='buster', unstable_version='1.2-1', other_versions=['0:1.0-1', '1.1'])
+        self.assertTrue(vuln.is_vulnerable('1.1.5'))
+        self.assertFalse(vuln.is_vulnerable('1.0-1'))  # The same as 0:1.0-1.
+        self.assertFalse(vuln.is_vulnerable('1.1'))
+        self.assertFalse(vuln.is_vulnerable('1.2-1'))
+        self.assertFalse(vuln.is_vulnerable('1:0.1'))
+        vuln = Vulnerability(os_release_codename='buster', unstable_version='', other_versions=['1.1'])
+        self.assertTrue(vuln.is_vulnerable('2.0'))
+        self.assertFalse(vuln.is_vulnerable('1.1'))
+
+    def test_is_vulnerable_rpm(self):
+        vuln = Vulnerability(os_release_codename='amzn2', unstable_version='1.2-1', other_versions=['1.01-1'])
+        self.assertTrue(vuln.is_vulnerable('1.0-1'))
+        self.assertFalse(vuln.is_vulnerable('1.1-1'))  # Compares equal to 1.01-1.
+        self.assertFalse(vuln.is_vulnerable('1.3-1'))
+
+    def test_is_vulnerable_unsupported(self):
+        vuln = Vulnerability(os_release_codename='unknown', unstable_version='1.2-1', other_versions=[])
+        self.assertFalse(vuln.is_vulnerable('1.0-1'))
+
+    def test_version_set(self):
+        for kind, version_list, equal, not_equal in (
+                (versions.DEB, ['1:1.1', '2.0', '3.0~rc1-1'], ['1:1.01-0', '0:2.0-0', '2.', '3.00~rc01-01'],
+                 ['1.1', '1:1.1.0', '2.0-1', '3.0-1', '3.0~rc1']),
+                (versions.RPM, ['1.1-1', '2.0', '3.0~rc1-1'], ['0:1.01-1', '1_1-1', '02.0', '3.0~rc.1-1'],
+                 ['1:1.1-1', '1.1', '2.0-1', '3.0-1', '3.0rc1-1'])):
+            version_set = versions.VersionSet(kind, version_list)
+            for version in equal + not_equal:
+                # Membership is checked by normalized versions only and must agree with compare().
+                self.assertEqual(version in version_set,
+                                 any(versions.compare(kind, version, v) == 0 for v in version_list), (kind, version))
+                self.assertEqual(version in version_set, version in equal, (kind, version))
+
+
+class VulnerabilityIndexTest(TestCase):
+    def setUp(self):
+        vulnerability_index.clear()
+
+    def make_vulns(self, codename, package='foo'):
+        return [Vulnerability(id=i + 1, os_release_codename=codename, name=f'CVE-{i + 1}', package=package,
+                              is_binary=False, unstable_version=unstable_version, other_versions=other_versions,
+                              urgency=Vulnerability.Urgency.LOW, fix_available=True)
+                for i, (unstable_version, other_versions) in enumerate([
+                    ('1.2-1', ['0:1.0-1', '1.1']), ('1.0-1', []), ('', ['1.1']), ('2.0-1', []), ('1.01-1', ['1.5-1'])
+                ])]
+
+    def build(self, codename, vulns):
+        return VulnerabilityIndex.build(codename, 0, [(v.id, v.package, v.unstable_version, v.other_versions)
+                                                      for v in vulns])
+
+    def test_match(self):
+        for codename in ('buster', 'amzn2'):
+            vulns = self.make_vulns(codename)
+            index = self.build(codename, vulns)
+            for version in ('0.9-1', '1.0-1', '1.1', '1.1.5', '1.1-1', '1.2-1', '1.5-1', '1:0.1', '2.0-1', '3.0'):
+                self.assertListEqual(sorted(index.match('foo', version)),
+                                     [v.id for v in vulns if v.is_vulnerable(version)], (codename, version))
+            self.assertListEqual(index.match('bar', '1.0-1'), [])
+
+    def test_match_unsupported(self):
+        self.assertListEqual(self.build('unknown', self.make_vulns('unknown')).match('foo', '1.0-1'), [])
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(VULNERABILITY_INDEX_PATH=tmp_dir):
+            index = self.build('buster', self.make_vulns('buster'))
+            index.save_snapshot()
+            VulnerabilityIndex('buster', 1, index.entries).save_snapshot()
+            # Older generations are removed.
+            self.assertIsNone(VulnerabilityIndex.load_snapshot('buster', 0))
+            loaded = VulnerabilityIndex.load_snapshot('buster', 1)
+            self.assertEqual(loaded.generation, 1)
+            self.assertListEqual(loaded.match('foo', '1.1.5'), index.match('foo', '1.1.5'))
+            # Broken snapshots are ignored.
+            path = VulnerabilityIndex.get_snapshot_path('buster', 1)
+            data = path.read_bytes()
+            for broken in (b'', data[:len(data) // 2]):
+                path.write_bytes(broken)
+                self.assertIsNone(VulnerabilityIndex.load_snapshot('buster', 1))
+
+    def test_get_index(self):
+        vulns = self.make_vulns('buster')
+        vulns[0].fix_available = False
+        for vuln in vulns:
+            vuln.id = None
+        Vulnerability.objects.bulk_create(vulns)
+        generation = VulnerabilityGeneration.get_current()
+        index = vulnerability_index.get_index('buster', generation.number)
+        self.assertEqual(len(index), 4)  # Not fixable vulnerabilities are not indexed.
+        self.assertIs(vulnerability_index.get_index('buster', generation.number), index)
+
+        generation.number += 1
+        generation.save()
+        new_index = vulnerability_index.get_index('buster', generation.number)
+        self.assertIsNot(new_index, index)
+        self.assertEqual(new_index.generation, generation.number)
+        # The old generation can't be loaded anymore.
+        vulnerability_index.clear()
+        with self.assertRaises(vulnerability_index.GenerationChanged):
+            vulnerability_index.get_index('buster', generation.number - 1)
@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from io import StringIO
+import gzip
 import uuid
 from unittest.mock import patch, mock_open
 import json
@@ -9,6 +11,8 @@ from django.utils import timezone
 from django.utils.http import urlencode
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
 from freezegun import freeze_time
 
 from rest_framework.test import APITestCase
@@ -18,9 +22,10 @@ from rest_framework.exceptions import ErrorDetail
 from rest_framework.authtoken.models import Token
 
 from device_registry.models import Credential, Device, DeviceInfo, Tag, FirewallState, PortScan, PairingKey, \
-    RecommendedAction, DebPackage
+    RecommendedAction, RecommendedActionStatus, DebPackage, GatewayKey
+from device_registry import blocklist, heartbeat, ping_ingest
 from device_registry.serializers import DeviceListSerializer
-from device_registry.recommended_actions import ActionMeta, AutoUpdatesAction
+from device_registry.recommended_actions import ActionMeta, AutoUpdatesAction, SimpleAction
 from device_registry.models import GlobalPolicy
 from profile_page.models import Profile
 
@@ -534,6 +539,17 @@ class MtlsTesterViewTest(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertDictEqual(response.json(), {'message': 'Hello device0.d.wott-dev.local'})
 
+    def test_get_cached(self):
+        self.client.get(self.url, **self.headers)
+        # The device is known, so it's not even loaded.
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        # Deleted device is forgotten.
+        self.device0.delete()
+        response = self.client.get(self.url, **self.headers)
+        self.assertEqual(response.status_code, 403)
+
 
 class ActionViewTest(APITestCase):
     def setUp(self):
@@ -708,6 +724,8 @@ class MtlsPingViewTest(APITestCase):
             'HTTP_SSL_CLIENT_SUBJECT_DN': f'CN={device_id}',
             'HTTP_SSL_CLIENT_VERIFY': 'SUCCESS'
         }
+        blocklist.clear_cache()
+        self.spam_networks = blocklist.get_current().block_networks
 
     def test_ping_get(self):
         # Take data from device security settings.
@@ -715,7 +733,7 @@ class MtlsPingViewTest(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertDictEqual(response.data, {
             'policy': self.device.firewallstate.policy_string,
-            'block_ports': [], 'block_networks': settings.SPAM_NETWORKS,
+            'block_ports': [], 'block_networks': self.spam_networks,
             'deb_packages_hash': ''
         })
         # Take data from a global policy.
@@ -725,16 +743,51 @@ class MtlsPingViewTest(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertDictEqual(response.data, {'policy': self.gp.policy_string,
                                              'block_ports': self.gp.ports,
-                                             'block_networks': self.gp.networks + settings.SPAM_NETWORKS,
+                                             'block_networks': self.gp.networks + self.spam_networks,
                                              'deb_packages_hash': ''})
 
+    def test_ping_get_etag(self):
+        response = self.client.get(self.url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.device.refresh_from_db()
+        self.assertIsNotNone(self.device.last_ping)
+
+        # Per-device settings changed.
+        self.device.portscan.block_networks = [['192.168.1.177', False]]
+        self.device.portscan.save(update_fields=['block_networks'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['block_networks'], [['192.168.1.177', False]] + self.spam_networks)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # Global policy applied and then changed.
+        self.device.firewallstate.global_policy = self.gp
+        self.device.firewallstate.save(update_fields=['global_policy'])
+        etag = self.client.get(self.url, **self.headers)['ETag']
+        self.gp.networks = []
+        self.gp.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['block_networks'], self.spam_networks)
+
+        # Deb packages hash changed.
+        etag = response['ETag']
+        Device.objects.filter(pk=self.device.pk).update(deb_packages_hash='abcdef')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deb_packages_hash'], 'abcdef')
+
     def test_pong_data(self):
         # 1st request
         response = self.client.get(self.url, **self.headers)
         self.assertEqual(response.status_code, 200)
         self.assertDictEqual(response.data, {
             'block_ports': [],
-            'block_networks': settings.SPAM_NETWORKS,
+            'block_networks': self.spam_networks,
             'policy': self.device.firewallstate.policy_string,
             'deb_packages_hash': ''
         })
@@ -750,7 +803,7 @@ class MtlsPingViewTest(APITestCase):
         self.assertDictEqual(response.data, {
             'policy': self.device.firewallstate.policy_string,
             'block_ports': [['192.168.1.178', 'tcp', 22, False]],
-            'block_networks': [['192.168.1.177', False]] + settings.SPAM_NETWORKS,
+            'block_networks': [['192.168.1.177', False]] + self.spam_networks,
             'deb_packages_hash': ''
         })
 
@@ -855,7 +908,7 @@ class MtlsPingViewTest(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertDictEqual(response.data, {
             'block_ports': [],
-            'block_networks': settings.SPAM_NETWORKS,
+            'block_networks': self.spam_networks,
             'policy': self.device.firewallstate.policy_string,
             'deb_packages_hash': 'abcdef'
         })
@@ -868,6 +921,283 @@ class MtlsPingViewTest(APITestCase):
                                                       'arch': p.arch,
                                                       'os_release_codename': p.os_release_codename})
 
+    def test_ping_packages_unchanged(self):
+        packages = [{'name': 'PACKAGE', 'version': 'VERSION', 'source_name': 'SOURCE', 'source_version': 'VERSION',
+                     'arch': 'all'}]
+        self.ping_payload['deb_packages'] = {'hash': 'abcdef', 'packages': packages}
+        self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertEqual(self.device.deb_packages.count(), 1)
+
+        with patch.object(Device, 'set_deb_packages') as set_deb_packages:
+            # The same hash with the full package list.
+            self.client.post(self.url, self.ping_payload, **self.headers)
+            # The same hash without the package list.
+            self.ping_payload['deb_packages'] = {'hash': 'abcdef'}
+            self.client.post(self.url, self.ping_payload, **self.headers)
+            # A different hash without the package list: the server doesn't have it, so it's ignored.
+            self.ping_payload['deb_packages'] = {'hash': 'fedcba'}
+            self.client.post(self.url, self.ping_payload, **self.headers)
+            set_deb_packages.assert_not_called()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.deb_packages_hash, 'abcdef')
+        self.assertEqual(self.device.deb_packages.count(), 1)
+
+    def test_ping_packages_delta(self):
+        packages = [{'name': 'PACKAGE1', 'version': 'VERSION', 'source_name': 'SOURCE', 'source_version': 'VERSION',
+                     'arch': 'all'},
+                    {'name': 'PACKAGE2', 'version': 'VERSION', 'source_name': 'SOURCE', 'source_version': 'VERSION',
+                     'arch': 'all'}]
+        self.ping_payload['deb_packages'] = {'hash': 'abcdef', 'packages': packages}
+        self.client.post(self.url, self.ping_payload, **self.headers)
+        DebPackage.objects.update(processed=True)
+
+        added = [{'name': 'PACKAGE3', 'version': 'VERSION', 'source_name': 'SOURCE', 'source_version': 'VERSION',
+                  'arch': 'all'}]
+        self.ping_payload['deb_packages'] = {'hash': 'fedcba', 'base_hash': 'abcdef', 'added': added,
+                                             'removed': [{'name': 'PACKAGE1', 'version': 'VERSION', 'arch': 'all'}]}
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertDictEqual(response.data, {'message': 'pong'})
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.deb_packages_hash, 'fedcba')
+        self.assertQuerysetEqual(self.device.deb_packages.order_by('name'), ['PACKAGE2', 'PACKAGE3'],
+                                 transform=lambda p: p.name)
+        # Only the new package needs to be matched against vulnerabilities.
+        self.assertQuerysetEqual(DebPackage.objects.filter(processed=False), ['PACKAGE3'], transform=lambda p: p.name)
+
+        # Stale base hash: nothing is changed and the full package list is requested.
+        self.ping_payload['deb_packages'] = {'hash': '123456', 'base_hash': 'abcdef', 'added': [], 'removed': added}
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertDictEqual(response.data, {'message': 'pong', 'deb_packages_resync': True})
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.deb_packages_hash, 'fedcba')
+        self.assertEqual(self.device.deb_packages.count(), 2)
+
+    def test_ping_gzip(self):
+        body = gzip.compress(json.dumps(self.ping_payload).encode())
+        response = self.client.post(self.url, body, content_type='application/json', HTTP_CONTENT_ENCODING='gzip',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(DeviceInfo.objects.get(device=self.device).fqdn, 'test-device0')
+
+        response = self.client.post(self.url, body[:-10], content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip', **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, body, content_type='application/json', HTTP_CONTENT_ENCODING='br',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        with override_settings(MTLS_MAX_DECOMPRESSED_SIZE=100):
+            response = self.client.post(self.url, body, content_type='application/json',
+                                        HTTP_CONTENT_ENCODING='gzip', **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ping_unchanged_json_fields(self):
+        self.client.post(self.url, self.ping_payload, **self.headers)
+        portscan = PortScan.objects.get(device=self.device)
+        self.assertEqual(portscan.scan_info_hash, ping_ingest.get_fingerprint(OPEN_PORTS_INFO)[0])
+
+        # Unchanged fields are not written: a change made behind the fingerprint's back survives the ping.
+        PortScan.objects.filter(pk=portscan.pk).update(scan_info=[])
+        skipped = ping_ingest.json_bytes_skipped_counter._value.get()
+        self.client.post(self.url, self.ping_payload, **self.headers)
+        portscan.refresh_from_db()
+        self.assertListEqual(portscan.scan_info, [])
+        self.assertEqual(ping_ingest.json_bytes_skipped_counter._value.get() - skipped,
+                         sum(ping_ingest.get_fingerprint(value)[1] for value in (
+                             {}, {}, OPEN_PORTS_INFO, OPEN_CONNECTIONS_INFO, TEST_RULES)))
+
+        scan_info = OPEN_PORTS_INFO + [{'host': '0.0.0.0', 'port': 80, 'proto': 'tcp', 'state': 'open',
+                                        'ip_version': 4}]
+        self.ping_payload['scan_info'] = scan_info
+        self.client.post(self.url, self.ping_payload, **self.headers)
+        portscan.refresh_from_db()
+        self.assertListEqual(portscan.scan_info, scan_info)
+        self.assertListEqual(portscan.netstat, OPEN_CONNECTIONS_INFO)
+
+    @override_settings(PING_INTERVAL=600, PING_INTERVAL_MIN=60, PING_INTERVAL_MAX=1800, PING_INTERVAL_JITTER=0.1,
+                       PING_TARGET_P95_LATENCY=0.5)
+    def test_ping_next_ping_in(self):
+        heartbeat.clear()
+        self.addCleanup(heartbeat.clear)
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertTrue(540 <= response.data['next_ping_in'] <= 660)
+
+        # New packages: come back soon.
+        self.ping_payload['deb_packages'] = {'hash': 'abcdef', 'packages': [
+            {'name': 'PACKAGE', 'version': 'VERSION', 'source_name': 'SOURCE', 'source_version': 'VERSION',
+             'arch': 'all'}]}
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertTrue(54 <= response.data['next_ping_in'] <= 66)
+
+        # Slow pings: the interval grows with the load, up to the max.
+        heartbeat.clear()
+        for _ in range(100):
+            heartbeat.record_latency(1.0)
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertTrue(1080 <= response.data['next_ping_in'] <= 1320)
+        heartbeat.clear()
+        for _ in range(100):
+            heartbeat.record_latency(10.0)
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertTrue(1620 <= response.data['next_ping_in'] <= 1980)
+
+    def test_ping_changed_inputs(self):
+        def evaluated_classes():
+            with patch.object(Device, 'generate_recommended_actions') as generate_recommended_actions:
+                self.client.post(self.url, self.ping_payload, **self.headers)
+            classes = generate_recommended_actions.call_args[1]['classes']
+            return None if classes is None else {action_class.__name__ for action_class in classes}
+
+        # First ping: everything is evaluated.
+        self.assertIsNone(evaluated_classes())
+
+        # Nothing changed: only the actions which depend on something else than ping data.
+        self.assertSetEqual(evaluated_classes(), {'FirewallDisabledAction'})
+
+        self.ping_payload['auto_upgrades'] = True
+        self.assertSetEqual(evaluated_classes(), {'FirewallDisabledAction', 'AutoUpdatesAction'})
+
+        # A "fixed" action is re-evaluated on the next ping.
+        ra = RecommendedAction.objects.create(action_class='RebootRequiredAction')
+        RecommendedActionStatus.objects.create(device=self.device, ra=ra,
+                                               status=RecommendedAction.Status.SNOOZED_UNTIL_PING)
+        self.assertSetEqual(evaluated_classes(), {'FirewallDisabledAction', 'RebootRequiredAction'})
+
+        # A new action class is deployed: everything is evaluated once.
+        class NewAction(SimpleAction, metaclass=ActionMeta):
+            inputs = ('auto_upgrades',)
+        self.addCleanup(ActionMeta.unregister, NewAction)
+        self.assertIsNone(evaluated_classes())
+        self.assertSetEqual(evaluated_classes(), {'FirewallDisabledAction'})
+
+    @override_settings(PING_WRITE_BEHIND=True)
+    @patch('device_registry.ping_ingest.redis.Redis')
+    def test_ping_write_behind(self, redis_mock):
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.data, {'message': 'pong'})
+        # Nothing is written to the DB by the view itself.
+        self.assertFalse(DeviceInfo.objects.filter(device=self.device).exists())
+        stream, fields = redis_mock.return_value.xadd.call_args[0]
+        self.assertEqual(stream, settings.PING_STREAM)
+        self.assertEqual(fields['device_id'], self.device.device_id)
+        self.assertEqual(json.loads(fields['data'])['scan_info'], OPEN_PORTS_INFO)
+
+    @override_settings(PING_WRITE_BEHIND=True)
+    @patch('device_registry.ping_ingest.redis.Redis')
+    def test_ping_write_behind_invalid(self, redis_mock):
+        self.ping_payload['scan_info'] = '[{"host": "localhost'
+        response = self.client.post(self.url, self.ping_payload, **self.headers)
+        self.assertEqual(response.status_code, 400)
+        redis_mock.return_value.xadd.assert_not_called()
+
+
+class BulkPingViewTest(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user('test')
+        self.device0 = Device.objects.create(device_id='device0.d.wott-dev.local', owner=self.user)
+        self.device1 = Device.objects.create(device_id='device1.d.wott-dev.local', owner=self.user)
+        self.device2 = Device.objects.create(device_id='device2.d.wott-dev.local',
+                                             owner=User.objects.create_user('test2'))
+        self.key = GatewayKey.objects.create(owner=self.user)
+        self.url = reverse('bulk_ping')
+        self.headers = {'HTTP_AUTHORIZATION': f'Gateway {self.key.key}'}
+
+    def ping(self, device, **data):
+        return {'device_id': device.device_id, 'data': dict({'scan_info': OPEN_PORTS_INFO}, **data)}
+
+    def test_post(self):
+        pings = [self.ping(self.device0, fqdn='fqdn0'), self.ping(self.device1, fqdn='fqdn1'),
+                 self.ping(self.device2, fqdn='fqdn2'), self.ping(self.device0, fqdn='fqdn3'),
+                 self.ping(self.device1, scan_info='[')]
+        pings[-1]['device_id'] = 'unknown.d.wott-dev.local'
+        response = self.client.post(self.url, {'pings': pings}, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(response.data['results'], [
+            {'device_id': self.device0.device_id, 'message': 'pong'},
+            {'device_id': self.device1.device_id, 'message': 'pong'},
+            {'device_id': self.device2.device_id, 'error': 'Device not found.'},
+            {'device_id': self.device0.device_id, 'error': 'Duplicate device_id.'},
+            {'device_id': 'unknown.d.wott-dev.local', 'error': 'Device not found.'}
+        ])
+        self.assertEqual(DeviceInfo.objects.get(device=self.device0).fqdn, 'fqdn0')
+        self.assertEqual(DeviceInfo.objects.get(device=self.device1).fqdn, 'fqdn1')
+        self.assertFalse(DeviceInfo.objects.filter(device=self.device2).exists())
+        self.device0.refresh_from_db()
+        self.assertIsNotNone(self.device0.last_ping)
+
+    def test_post_invalid(self):
+        response = self.client.post(self.url, {'pings': [self.ping(self.device0, scan_info='['),
+                                                         self.ping(self.device1)]}, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(response.data['results'], [
+            {'device_id': self.device0.device_id, 'error': {'scan_info': 'Invalid JSON.'}},
+            {'device_id': self.device1.device_id, 'message': 'pong'}
+        ])
+        response = self.client.post(self.url, {'pings': {}}, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(BULK_PING_MAX_SIZE=1):
+            response = self.client.post(self.url, {'pings': [self.ping(self.device0), self.ping(self.device1)]},
+                                        **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_auth(self):
+        pings = {'pings': [self.ping(self.device0)]}
+        response = self.client.post(self.url, pings)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(self.url, pings, HTTP_AUTHORIZATION=f'Gateway {uuid.uuid4()}')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(self.url, pings, HTTP_AUTHORIZATION='Gateway invalid')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(DeviceInfo.objects.filter(device=self.device0).exists())
+
+
+class MtlsSpamNetworksViewTest(APITestCase):
+    def setUp(self):
+        self.url = reverse('mtls-spam-networks')
+        self.device = Device.objects.create(device_id='device0.d.wott-dev.local')
+        self.headers = {
+            'HTTP_SSL_CLIENT_SUBJECT_DN': 'CN=device0.d.wott-dev.local',
+            'HTTP_SSL_CLIENT_VERIFY': 'SUCCESS'
+        }
+        blocklist.clear_cache()
+        self.addCleanup(blocklist.clear_cache)
+
+    def test_compact(self):
+        self.assertListEqual(blocklist.compact(['10.0.1.0/24', '10.0.0.0/24', '10.0.0.128/25', 'invalid',
+                                                '192.168.0.0/24', '2001:db8::/32']),
+                             ['10.0.0.0/23', '192.168.0.0/24'])
+        self.assertListEqual(blocklist.parse('; comment\n1.10.16.0/20 ; SBL256894\n\n1.19.0.0/16 ; SBL434604\n'
+                                             '2001:db8::/32 ; IPv6\n1.2.3.4/24 ; host bits\n'),
+                             ['1.10.16.0/20', '1.19.0.0/16'])
+
+    def test_get(self):
+        # The list bundled with the code.
+        response = self.client.get(self.url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['version'], 0)
+        self.assertListEqual(response.data['networks'], blocklist.compact(n for n, _ in settings.SPAM_NETWORKS))
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 304)
+
+        with patch('builtins.open', mock_open(read_data='10.0.0.0/24 ; A\n10.0.1.0/24 ; B\n')):
+            call_command('reload_spam_networks', stdout=StringIO())
+            # Loading the same list doesn't create a new version.
+            call_command('reload_spam_networks', stdout=StringIO())
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.data, {'version': 1, 'networks': ['10.0.0.0/23']})
+
+        # The ping response references the list by version.
+        response = self.client.get(reverse('mtls-ping'), {'spam_networks': 'version'}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['block_networks'], [])
+        self.assertEqual(response.data['spam_networks_version'], 1)
+        response = self.client.get(reverse('mtls-ping'), **self.headers)
+        self.assertEqual(response.data['block_networks'], [['10.0.0.0/23', False]])
+        self.assertNotIn('spam_networks_version', response.data)
+
 
 class DeviceEnrollView(APITestCase):
     def setUp(self):
@@ -1,10 +1,26 @@
 from collections import defaultdict
-
-from django.test import TestCase
+import datetime
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import zlib
+from urllib.error import HTTPError
+
+import git
+
+from django.conf import settings
+from django.test import TestCase, override_settings
 from unittest import mock
 
-from device_registry.models import GithubIssue
-from device_registry.recommended_actions import ActionMeta, SimpleAction, Severity
+from device_registry import ping_archive, ping_ingest, vulnerability_index
+from device_registry.celery_tasks import amazon_cve, common, debian_cve, ubuntu_cve
+from device_registry.models import GithubIssue, DeviceInfo, PortScan, DebPackage, Vulnerability, \
+    VulnerabilityGeneration, CveSummary, RecommendedAction, DEBIAN_SUITES
+from device_registry.recommended_actions import ActionMeta, SimpleAction, Severity, CVEAction
+from device_registry.vulnerability_index import VulnerabilityIndex
 from profile_page.models import *
 
 TEST_REPO_ID = 1234
@@ -176,4 +192,628 @@ class GithubTest(TestCase):
         self.assertIn('\n- [x] [testdevice1]', text)
 
         issue.refresh_from_db()
-        self.assertFalse(issue.closed)
\ No newline at end of file
+        self.assertFalse(issue.closed)
+
+
+class SyncVulnerabilitiesTest(TestCase):
+    def setUp(self):
+        vulnerability_index.clear()
+
+    @staticmethod
+    def vuln(name, package, codename='stretch', **kwargs):
+        return Vulnerability(**dict(dict(os_release_codename=codename, name=name, package=package, is_binary=False,
+                                         unstable_version='1.0', other_versions=[],
+                                         urgency=Vulnerability.Urgency.LOW, fix_available=True), **kwargs))
+
+    def test_sync(self):
+        Vulnerability.objects.bulk_create([self.vuln('CVE-1', 'unchanged'), self.vuln('CVE-2', 'updated'),
+                                           self.vuln('CVE-3', 'deleted'), self.vuln('CVE-1', 'other', 'bionic')])
+        unchanged_id = Vulnerability.objects.get(package='unchanged').id
+        updated_id = Vulnerability.objects.get(package='updated').id
+        packages = {source: DebPackage.objects.create(name=source, version='1', source_name=source,
+                                                      source_version='1', arch='all', os_release_codename='stretch',
+                                                      processed=True)
+                    for source in ('unchanged', 'updated', 'deleted', 'created')}
+
+        created, updated, deleted = common.sync_vulnerabilities([
+            self.vuln('CVE-1', 'unchanged'), self.vuln('CVE-2', 'updated', unstable_version='2.0'),
+            self.vuln('CVE-4', 'created')], ['stretch'])
+        self.assertTupleEqual((created, updated, deleted), (1, 1, 1))
+        self.assertQuerysetEqual(Vulnerability.objects.order_by('os_release_codename', 'name'),
+                                 [('bionic', 'CVE-1', 'other', '1.0'), ('stretch', 'CVE-1', 'unchanged', '1.0'),
+                                  ('stretch', 'CVE-2', 'updated', '2.0'), ('stretch', 'CVE-4', 'created', '1.0')],
+                                 transform=lambda v: (v.os_release_codename, v.name, v.package, v.unstable_version))
+        # Unchanged and updated vulnerabilities keep their ids.
+        self.assertEqual(Vulnerability.objects.get(package='unchanged').id, unchanged_id)
+        self.assertEqual(Vulnerability.objects.get(package='updated').id, updated_id)
+        # Only the packages affected by the changes are reprocessed.
+        for source, package in packages.items():
+            package.refresh_from_db()
+            self.assertEqual(package.processed, source == 'unchanged')
+
+    def test_sync_cve_summary(self):
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package', urgency=Vulnerability.Urgency.HIGH,
+                                               fix_available=False),
+                                     self.vuln('CVE-2', 'package')], ['stretch'])
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package', 'bionic', pub_date=datetime.date(2020, 1, 1))],
+                                    ['bionic'])
+        self.assertQuerysetEqual(CveSummary.objects.order_by('name'), [
+            ('CVE-1', Vulnerability.Urgency.HIGH, datetime.date(2020, 1, 1), True),
+            ('CVE-2', Vulnerability.Urgency.LOW, None, True)
+        ], transform=lambda s: (s.name, s.max_urgency, s.pub_date, s.fix_available))
+
+        common.sync_vulnerabilities([self.vuln('CVE-2', 'package')], ['stretch'])
+        self.assertQuerysetEqual(CveSummary.objects.order_by('name'), [
+            ('CVE-1', Vulnerability.Urgency.LOW), ('CVE-2', Vulnerability.Urgency.LOW)
+        ], transform=lambda s: (s.name, s.max_urgency))
+        # Deleted vulnerabilities are refreshed at once, not row by row.
+        with mock.patch.object(CveSummary, 'refresh', wraps=CveSummary.refresh) as refresh:
+            common.sync_vulnerabilities([], ['bionic'])
+        refresh.assert_called_once_with({'CVE-1'})
+        self.assertQuerysetEqual(CveSummary.objects.all(), ['CVE-2'], transform=lambda s: s.name)
+
+    def test_sync_generation(self):
+        self.assertEqual(VulnerabilityGeneration.get_current().number, 0)
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package')], ['stretch'])
+        self.assertEqual(VulnerabilityGeneration.get_current().number, 1)
+        # Nothing changed.
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package')], ['stretch'])
+        self.assertEqual(VulnerabilityGeneration.get_current().number, 1)
+
+    def test_update_packages_vulnerabilities_stale(self):
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package')], ['stretch'])
+        package = DebPackage.objects.create(name='package', version='0.9', source_name='package',
+                                            source_version='0.9', arch='all', os_release_codename='stretch')
+
+        match = VulnerabilityIndex.match
+
+        def match_and_import(index, source_name, source_version):
+            # An import finishes while the batch is being matched.
+            common.sync_vulnerabilities([self.vuln('CVE-2', 'package')], ['stretch'])
+            return match(index, source_name, source_version)
+
+        with mock.patch.object(VulnerabilityIndex, 'match', match_and_import):
+            self.assertTupleEqual(common.update_packages_vulnerabilities([package.id]), (0, 0))
+        package.refresh_from_db()
+        self.assertFalse(package.processed)
+        self.assertFalse(package.vulnerabilities.exists())
+
+        # The next run matches against the new data.
+        self.assertTupleEqual(common.update_packages_vulnerabilities([package.id]), (1, 1))
+        package.refresh_from_db()
+        self.assertTrue(package.processed)
+        self.assertQuerysetEqual(package.vulnerabilities.all(), ['CVE-2'], transform=lambda v: v.name)
+        # Already processed.
+        self.assertTupleEqual(common.update_packages_vulnerabilities([package.id]), (0, 0))
+
+    def test_update_packages_vulnerabilities_interrupted(self):
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package')], ['stretch'])
+        package = DebPackage.objects.create(name='package', version='0.9', source_name='package',
+                                            source_version='0.9', arch='all', os_release_codename='stretch')
+        # The worker is killed while saving the results.
+        with mock.patch('device_registry.celery_tasks.common._replace_relations', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                common.update_packages_vulnerabilities([package.id])
+        package.refresh_from_db()
+        self.assertFalse(package.processed)
+
+    def test_update_packages_vulnerabilities_diff(self):
+        common.sync_vulnerabilities([self.vuln('CVE-1', 'package'), self.vuln('CVE-2', 'package'),
+                                     self.vuln('CVE-3', 'package', unstable_version='0.5')], ['stretch'])
+        package = DebPackage.objects.create(name='package', version='0.9', source_name='package',
+                                            source_version='0.9', arch='all', os_release_codename='stretch')
+        Relation = DebPackage.vulnerabilities.through
+        Relation.objects.bulk_create([Relation(debpackage=package, vulnerability=v)
+                                      for v in Vulnerability.objects.filter(name__in=['CVE-1', 'CVE-3'])])
+        kept_id = Relation.objects.get(vulnerability__name='CVE-1').id
+
+        with self.assertLogs('django', 'INFO') as logs:
+            self.assertTupleEqual(common.update_packages_vulnerabilities([package.id]), (1, 2))
+        self.assertIn('INFO:django:finished. relations: 1 inserted, 1 deleted, 1 unchanged', logs.output)
+        self.assertQuerysetEqual(package.vulnerabilities.order_by('name'), ['CVE-1', 'CVE-2'],
+                                 transform=lambda v: v.name)
+        # The unchanged relation is not rewritten.
+        self.assertEqual(Relation.objects.get(vulnerability__name='CVE-1').id, kept_id)
+
+
+class DebianCveTest(TestCase):
+    class Response(io.BytesIO):
+        def __init__(self, data, headers):
+            super().__init__(data)
+            self.headers = headers
+
+    def setUp(self):
+        self.feeds = {}
+        self.etags = {}
+        self.requests = []
+        for suite in DEBIAN_SUITES:
+            self.set_feed(suite)
+
+    def set_feed(self, suite, *vulns, etag=None):
+        self.feeds[suite] = 'VERSION 1\n' + ''.join(f'{name},,\n' for name, _ in vulns) + '\n' + \
+            ''.join(f'{package},{i},SLRF,1.0,\n' for i, (_, package) in enumerate(vulns))
+        self.etags[suite] = etag
+
+    def opener(self, request):
+        suite = request.full_url.rsplit('/', 1)[1]
+        self.requests.append((suite, request.get_header('If-none-match')))
+        etag = self.etags.get(suite)
+        if etag is not None and request.get_header('If-none-match') == etag:
+            raise HTTPError(request.full_url, 304, 'Not Modified', {}, None)
+        return self.Response(zlib.compress(self.feeds[suite].encode()), {'ETag': etag} if etag else {})
+
+    def vulns(self):
+        return list(Vulnerability.objects.order_by('os_release_codename', 'name')
+                    .values_list('os_release_codename', 'name', 'package'))
+
+    def test_fetch(self):
+        self.set_feed('stretch', ('CVE-1', 'foo'), ('CVE-2', 'bar'), etag='"1"')
+        self.set_feed('buster', ('CVE-1', 'foo'))
+        self.assertEqual(debian_cve.fetch_vulnerabilities(self.opener), 3)
+        self.assertListEqual(self.vulns(), [('buster', 'CVE-1', 'foo'), ('stretch', 'CVE-1', 'foo'),
+                                            ('stretch', 'CVE-2', 'bar')])
+        self.assertIn(('stretch', None), self.requests)
+
+        # Not modified (stretch) and unchanged (buster) suites are skipped.
+        self.requests.clear()
+        with mock.patch('device_registry.celery_tasks.debian_cve.sync_vulnerabilities') as sync_mock:
+            self.assertEqual(debian_cve.fetch_vulnerabilities(self.opener), 0)
+        sync_mock.assert_not_called()
+        self.assertIn(('stretch', '"1"'), self.requests)
+
+        # Only the changed suite is updated.
+        self.set_feed('buster', ('CVE-3', 'foo'))
+        self.assertEqual(debian_cve.fetch_vulnerabilities(self.opener), 1)
+        self.assertListEqual(self.vulns(), [('buster', 'CVE-3', 'foo'), ('stretch', 'CVE-1', 'foo'),
+                                            ('stretch', 'CVE-2', 'bar')])
+
+    def test_parse_feed(self):
+        self.set_feed('buster', ('CVE-1', 'foo'), ('CVE-2', 'bar'))
+        digest = hashlib.sha256()
+        stream = io.BytesIO(zlib.compress(self.feeds['buster'].encode()))
+        with mock.patch('device_registry.celery_tasks.debian_cve.CHUNK_SIZE', 7):
+            vulns = list(debian_cve.parse_feed(debian_cve.iter_feed_lines(stream, digest), 'buster'))
+        self.assertListEqual([(v.name, v.package, v.urgency, v.remote, v.fix_available, v.is_binary) for v in vulns],
+                             [('CVE-1', 'foo', Vulnerability.Urgency.LOW, True, True, False),
+                              ('CVE-2', 'bar', Vulnerability.Urgency.LOW, True, True, False)])
+
+
+UPDATEINFO = b"""<?xml version="1.0" ?>
+<updates>
+  <update author="" from="" status="final" type="security" version="2.0">
+    <id>ALAS2-2020-1</id>
+    <severity>low</severity>
+    <references>
+      <reference href="" id="CVE-2020-1" title="" type="cve"/>
+      <reference href="" id="CVE-2020-2" title="" type="cve"/>
+    </references>
+    <pkglist><collection short="amazon-linux-2">
+      <package arch="x86_64" epoch="0" name="foo" release="1.amzn2" version="1.0"/>
+      <package arch="x86_64" epoch="0" name="bar" release="1.amzn2" version="2.0"/>
+    </collection></pkglist>
+  </update>
+  <update author="" from="" status="final" type="security" version="2.0">
+    <id>ALAS2-2020-2</id>
+    <severity>important</severity>
+    <references><reference href="" id="CVE-2020-1" title="" type="cve"/></references>
+    <pkglist><collection short="amazon-linux-2">
+      <package arch="x86_64" epoch="0" name="foo" release="2.amzn2" version="1.0"/>
+    </collection></pkglist>
+  </update>
+</updates>
+"""
+
+
+class AmazonCveTest(TestCase):
+    def test_parse_updateinfo(self):
+        vulnerabilities = amazon_cve.parse_updateinfo(io.BytesIO(UPDATEINFO))
+        self.assertDictEqual({key: (v.urgency, v.unstable_version) for key, v in vulnerabilities.items()}, {
+            ('CVE-2020-1', 'foo'): (Vulnerability.Urgency.HIGH, '0:1.0-2.amzn2'),
+            ('CVE-2020-1', 'bar'): (Vulnerability.Urgency.LOW, '0:2.0-1.amzn2'),
+            ('CVE-2020-2', 'foo'): (Vulnerability.Urgency.LOW, '0:1.0-1.amzn2'),
+            ('CVE-2020-2', 'bar'): (Vulnerability.Urgency.LOW, '0:2.0-1.amzn2')
+        })
+
+
+CVE_FILE = """Candidate: {name}
+PublicDate: 2020-01-01
+Priority: {priority}
+
+Patches_{package}:
+xenial_{package}: released (1.0-1)
+bionic_{package}: needed
+"""
+
+
+class UbuntuCveTest(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.repo_path = os.path.join(tmp_dir.name, 'ubuntu-cve-tracker')
+        self.repo = git.Repo.init(self.repo_path)
+        self.commit({'scripts/cve_lib.py': 'meta_kernels = None\nkernel_srcs = set()\n'
+                                           'kernel_package_abi = kernel_package_version = None\n',
+                     'active/CVE-2020-0001': CVE_FILE.format(name='CVE-2020-0001', package='foo', priority='low'),
+                     'retired/CVE-2019-0001': CVE_FILE.format(name='CVE-2019-0001', package='bar',
+                                                             priority='high')})
+        override = override_settings(UBUNTU_CVE_TRACKER_PATH=self.repo_path,
+                                     UBUNTU_CVE_CACHE_PATH=os.path.join(tmp_dir.name, 'cache'),
+                                     UBUNTU_CVE_PARSE_WORKERS=1)
+        override.enable()
+        self.addCleanup(override.disable)
+        clone_patcher = mock.patch('device_registry.celery_tasks.ubuntu_cve.clone_cve_repo', return_value=self.repo)
+        clone_patcher.start()
+        self.addCleanup(clone_patcher.stop)
+
+    def commit(self, files):
+        for path, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.repo_path, path)), exist_ok=True)
+            with open(os.path.join(self.repo_path, path), 'w') as f:
+                f.write(content)
+        self.repo.index.add(list(files))
+        actor = git.Actor('test', 'test@example.com')
+        self.repo.index.commit('update', author=actor, committer=actor)
+
+    def fetch(self, **kwargs):
+        with mock.patch('device_registry.celery_tasks.ubuntu_cve.parse_cve_file',
+                        wraps=ubuntu_cve.parse_cve_file) as parse_mock:
+            result = ubuntu_cve.fetch_vulnerabilities(**kwargs)
+        return result, sorted(os.path.basename(call[0][0]) for call in parse_mock.call_args_list)
+
+    def test_fetch(self):
+        self.assertTupleEqual(self.fetch(), (4, ['CVE-2019-0001', 'CVE-2020-0001']))
+        self.assertQuerysetEqual(Vulnerability.objects.order_by('name', 'os_release_codename'),
+                                 [('CVE-2019-0001', 'bar', 'bionic', False), ('CVE-2019-0001', 'bar', 'xenial', True),
+                                  ('CVE-2020-0001', 'foo', 'bionic', False), ('CVE-2020-0001', 'foo', 'xenial', True)],
+                                 transform=lambda v: (v.name, v.package, v.os_release_codename, v.fix_available))
+
+        # No new commits.
+        self.assertTupleEqual(self.fetch(), (0, []))
+
+        # Only the changed file is parsed.
+        self.commit({'active/CVE-2020-0001': CVE_FILE.format(name='CVE-2020-0001', package='foo',
+                                                             priority='high')})
+        self.assertTupleEqual(self.fetch(), (4, ['CVE-2020-0001']))
+        self.assertSetEqual(set(Vulnerability.objects.values_list('urgency', flat=True)),
+                            {Vulnerability.Urgency.HIGH})
+
+        # Full import ignores the cache.
+        self.assertTupleEqual(self.fetch(full=True), (4, ['CVE-2019-0001', 'CVE-2020-0001']))
+
+    def test_fetch_workers(self):
+        with override_settings(UBUNTU_CVE_PARSE_WORKERS=2):
+            self.assertEqual(ubuntu_cve.fetch_vulnerabilities(), 4)
+        self.assertQuerysetEqual(Vulnerability.objects.order_by('name', 'os_release_codename'),
+                                 [('CVE-2019-0001', 'bar', 'bionic'), ('CVE-2019-0001', 'bar', 'xenial'),
+                                  ('CVE-2020-0001', 'foo', 'bionic'), ('CVE-2020-0001', 'foo', 'xenial')],
+                                 transform=lambda v: (v.name, v.package, v.os_release_codename))
+
+
+class RedisStub:
+    """
+    A dict-backed stand-in for the part of redis.Redis used by the packages vulnerabilities dispatcher.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value = self.data.get(key)
+        return str(value).encode() if value is not None else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def hgetall(self, key):
+        return {k.encode(): str(v).encode() for k, v in self.data.get(key, {}).items()}
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def hincrby(self, key, field, n):
+        fields = self.data.setdefault(key, {})
+        fields[field] = int(fields.get(field, 0)) + n
+
+    def expire(self, key, seconds):
+        pass
+
+    def lock(self, *args, **kwargs):
+        return mock.MagicMock()
+
+
+@mock.patch('device_registry.celery_tasks.common.group')
+class SendPackagesToVulnsUpdateTest(TestCase):
+    def setUp(self):
+        self.redis = RedisStub()
+        patcher = mock.patch('device_registry.celery_tasks.common._redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.task = mock.Mock()
+        self.task.s.side_effect = lambda batch, run_id: (batch, run_id)
+        self.ra_task = mock.Mock()
+        self.packages = [DebPackage.objects.create(name=name, version='1', source_name=source_name,
+                                                   source_version='1', arch='all', os_release_codename=codename)
+                         for name, source_name, codename in [
+                             ('a', 'c', 'stretch'), ('b', 'a', 'stretch'), ('c', 'b', 'buster'),
+                             ('linux-image-4.15.0-1-generic', 'linux', 'bionic'), ('e', 'a', 'jessie')]]
+
+    def sent_batches(self, group_mock):
+        return [[batch for batch, _ in call[0][0]] for call in group_mock.call_args_list]
+
+    @mock.patch('device_registry.celery_tasks.common.VULNS_UPDATE_BATCH_SIZE', 2)
+    @mock.patch('device_registry.celery_tasks.common.VULNS_UPDATE_GROUP_SIZE', 1)
+    def test_dispatch(self, group_mock):
+        a, b, c, kernel, e = [p.id for p in self.packages]
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 4)
+        # Ordered by (codename, source_name), kernel packages skipped.
+        self.assertListEqual(self.sent_batches(group_mock), [[[c, e]], [[b, a]]])
+        progress = common.get_vulns_update_progress()
+        self.assertDictContainsSubset({'total': 4, 'done': 0, 'failed': 0, 'dispatched': True,
+                                       'position': ('stretch', 'c', a)}, progress)
+
+        # The run is in progress.
+        group_mock.reset_mock()
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 0)
+        group_mock.assert_not_called()
+        self.ra_task.delay.assert_not_called()
+
+        common._record_vulns_update_progress(progress['run_id'], 'done', 2)
+        with mock.patch('device_registry.celery_tasks.common._update_packages_vulnerabilities',
+                        side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                common.update_packages_vulnerabilities([b, a], progress['run_id'])
+        self.assertDictContainsSubset({'done': 2, 'failed': 2}, common.get_vulns_update_progress())
+
+        # The run is finished, the failed packages are sent again by the next run.
+        DebPackage.objects.filter(id__in=[c, e]).update(processed=True)
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 2)
+        self.ra_task.delay.assert_called_once_with()
+        self.assertListEqual(self.sent_batches(group_mock), [[[b, a]]])
+        self.assertNotEqual(common.get_vulns_update_progress()['run_id'], progress['run_id'])
+
+    @mock.patch('device_registry.celery_tasks.common.VULNS_UPDATE_BATCH_SIZE', 1)
+    @mock.patch('device_registry.celery_tasks.common.VULNS_UPDATE_GROUP_SIZE', 2)
+    @mock.patch('device_registry.celery_tasks.common.VULNS_UPDATE_DISPATCH_TIME', 0)
+    def test_dispatch_continued(self, group_mock):
+        a, b, c, kernel, e = [p.id for p in self.packages]
+        # Out of time after the first group.
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 2)
+        self.assertFalse(common.get_vulns_update_progress()['dispatched'])
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 2)
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 0)
+        self.assertListEqual(self.sent_batches(group_mock), [[[c], [e]], [[b], [a]]])
+        self.assertDictContainsSubset({'total': 4, 'dispatched': True}, common.get_vulns_update_progress())
+
+    def test_dispatch_stalled(self, group_mock):
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 4)
+        run_id = common.get_vulns_update_progress()['run_id']
+        # A batch was lost, the run has made no progress since.
+        self.redis.data[f'{common.VULNS_UPDATE_KEY}:{run_id}']['updated'] = \
+            int(time.time()) - common.VULNS_UPDATE_STALL_TIME
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 4)
+        self.ra_task.delay.assert_called_once_with()
+        self.assertNotEqual(common.get_vulns_update_progress()['run_id'], run_id)
+
+    def test_nothing_to_do(self, group_mock):
+        DebPackage.objects.update(processed=True)
+        self.assertEqual(common.send_packages_to_vulns_update(self.task, self.ra_task), 0)
+        self.assertIsNone(common.get_vulns_update_progress())
+
+
+class UpdateCveRaTest(TestCase):
+    def setUp(self):
+        packages = DebPackage.objects.bulk_create([
+            DebPackage(name=name, version='1', source_name=name, source_version='1', arch='amd64',
+                       os_release_codename='buster') for name in ('a', 'b', 'c')])
+        vulns = Vulnerability.objects.bulk_create([
+            Vulnerability(name=name, package=package, is_binary=False, other_versions=[], urgency=urgency,
+                          fix_available=True, os_release_codename='buster')
+            for name, package, urgency in (('CVE-1', 'a', Vulnerability.Urgency.LOW),
+                                           ('CVE-1', 'b', Vulnerability.Urgency.HIGH),
+                                           ('CVE-2', 'c', Vulnerability.Urgency.MEDIUM))])
+        packages[0].vulnerabilities.add(vulns[0])
+        packages[1].vulnerabilities.add(vulns[1])
+        packages[2].vulnerabilities.add(vulns[2])
+        CveSummary.refresh()
+        for param in ('CVE-1', 'CVE-2', 'CVE-3'):
+            RecommendedAction.objects.create(action_class='CVEAction', action_param=param,
+                                             action_context={'cve_name': param}, action_severity=Severity.LO.value)
+
+    def test_batch(self):
+        params = ['CVE-1', 'CVE-2']
+        self.assertDictEqual(CVEAction.get_contexts(params),
+                             {param: CVEAction.get_context(param) for param in params})
+        self.assertDictEqual(CVEAction.severities(params + ['CVE-3']),
+                             {'CVE-1': Severity.HI, 'CVE-2': Severity.MED, 'CVE-3': Severity.LO})
+
+    @mock.patch('device_registry.models.RecommendedActionStatus.update_all_devices')
+    def test_update(self, update_all_devices_mock):
+        with mock.patch.object(RecommendedAction.objects, 'bulk_update',
+                               wraps=RecommendedAction.objects.bulk_update) as bulk_update_mock:
+            common.update_cve_ra()
+        self.assertSetEqual({ra.action_param for ra in bulk_update_mock.call_args[0][0]}, {'CVE-1', 'CVE-2'})
+        ra = RecommendedAction.objects.get(action_param='CVE-1')
+        self.assertDictEqual(ra.action_context, CVEAction.get_context('CVE-1'))
+        self.assertEqual(ra.action_severity, Severity.HI.value)
+        # CVE-3 doesn't affect any packages, its context is kept.
+        self.assertDictEqual(RecommendedAction.objects.get(action_param='CVE-3').action_context, {'cve_name': 'CVE-3'})
+
+        # Nothing has changed since.
+        with mock.patch.object(RecommendedAction.objects, 'bulk_update') as bulk_update_mock:
+            common.update_cve_ra()
+        self.assertListEqual(bulk_update_mock.call_args[0][0], [])
+
+
+@mock.patch('device_registry.ping_ingest.redis.Redis')
+class PingIngestTest(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_id='device.d.wott-dev.local')
+
+    @staticmethod
+    def message(message_id, device_id, **data):
+        return message_id, {b'device_id': device_id.encode(), b'last_ping': timezone.now().isoformat().encode(),
+                            b'data': json.dumps(data).encode()}
+
+    def test_consume(self, redis_mock):
+        redis_conn = redis_mock.return_value
+        redis_conn.xpending_range.return_value = []
+        redis_conn.xreadgroup.side_effect = [
+            [[b'pings', [self.message(b'1-0', self.device.device_id, fqdn='old', scan_info=[]),
+                         self.message(b'2-0', self.device.device_id, fqdn='new', scan_info=[]),
+                         self.message(b'3-0', 'deleted.d.wott-dev.local', fqdn='deleted')]]],
+            []
+        ]
+        self.assertEqual(ping_ingest.consume_pings(), 1)
+        # Only the last ping of the device is applied.
+        self.assertEqual(DeviceInfo.objects.get(device=self.device).fqdn, 'new')
+        self.assertTrue(PortScan.objects.filter(device=self.device).exists())
+        self.device.refresh_from_db()
+        self.assertIsNotNone(self.device.last_ping)
+        self.assertTrue(self.device.update_trust_score)
+        redis_conn.xack.assert_called_once_with(settings.PING_STREAM, settings.PING_STREAM_GROUP,
+                                                b'1-0', b'2-0', b'3-0')
+
+    def test_consume_package_deltas(self, redis_mock):
+        def package(name):
+            return {'name': name, 'version': '1', 'source_name': name, 'source_version': '1', 'arch': 'all'}
+
+        def removed(name):
+            return {'name': name, 'version': '1', 'arch': 'all'}
+
+        redis_conn = redis_mock.return_value
+        redis_conn.xpending_range.return_value = []
+        os_release = {'codename': 'stretch'}
+        redis_conn.xreadgroup.side_effect = [
+            [[b'pings', [
+                self.message(b'1-0', self.device.device_id, os_release=os_release,
+                             deb_packages={'hash': 'h1', 'packages': [package('a'), package('b')]}),
+                self.message(b'2-0', self.device.device_id, os_release=os_release,
+                             deb_packages={'hash': 'h2', 'base_hash': 'h1', 'added': [package('c')],
+                                           'removed': [removed('a')]}),
+                self.message(b'3-0', self.device.device_id, os_release=os_release)]]],
+            [[b'pings', [
+                self.message(b'4-0', self.device.device_id, os_release=os_release,
+                             deb_packages={'hash': 'h3', 'base_hash': 'h2', 'added': [package('d')],
+                                           'removed': [removed('b')]}),
+                self.message(b'5-0', self.device.device_id, os_release=os_release,
+                             deb_packages={'hash': 'h4', 'base_hash': 'h3', 'added': [package('b')],
+                                           'removed': [removed('d'), removed('c')]}),
+                self.message(b'6-0', self.device.device_id, os_release=os_release, deb_packages={'hash': 'h4'})]]],
+            []
+        ]
+        # The package changes of all the pings are applied.
+        self.assertEqual(ping_ingest.consume_pings(max_batches=1), 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.deb_packages_hash, 'h2')
+        self.assertQuerysetEqual(self.device.deb_packages.order_by('name'), ['b', 'c'], transform=lambda p: p.name)
+        self.assertEqual(ping_ingest.consume_pings(max_batches=1), 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.deb_packages_hash, 'h4')
+        self.assertQuerysetEqual(self.device.deb_packages.order_by('name'), ['b'], transform=lambda p: p.name)
+
+    def test_consume_bad_ping(self, redis_mock):
+        device1 = Device.objects.create(device_id='device1.d.wott-dev.local')
+        redis_conn = redis_mock.return_value
+        redis_conn.xpending_range.return_value = []
+        redis_conn.xreadgroup.side_effect = [
+            [[b'pings', [self.message(b'1-0', self.device.device_id, fqdn='good'),
+                         self.message(b'2-0', device1.device_id, fqdn='bad',
+                                      kernel_package={'name': 'linux', 'version': '1', 'arch': 'all'},
+                                      os_release={'codename': 'stretch'})]]],
+            []
+        ]
+        # The bad ping is dropped, the good one is still applied.
+        self.assertEqual(ping_ingest.consume_pings(), 1)
+        self.assertEqual(DeviceInfo.objects.get(device=self.device).fqdn, 'good')
+        self.assertFalse(DeviceInfo.objects.filter(device=device1).exists())
+        redis_conn.xack.assert_called_once()
+
+
+@mock.patch('device_registry.ping_archive.redis.Redis')
+class PingArchiveTest(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_id='device.d.wott-dev.local')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    @override_settings(PING_ARCHIVE_MAXLEN=3, PING_ARCHIVE_BATCH_SIZE=2)
+    @mock.patch('device_registry.tasks.export_ping_archive.delay')
+    def test_archive(self, export_mock, redis_mock):
+        pipe = redis_mock.return_value.pipeline.return_value
+        ping_time = timezone.now()
+        pings = [(self.device, {'logins': {'': {'failed': 1, 'success': 0}}}, ping_time),
+                 (self.device, {'logins': {}}, ping_time)]
+
+        pipe.execute.return_value = [2, True]
+        self.assertEqual(ping_archive.archive_pings(pings), 0)
+        records = [json.loads(record) for record in pipe.rpush.call_args[0][1:]]
+        self.assertListEqual(records, [
+            {'logins': [{'username': '', 'failed': 1, 'success': 0}], 'device_id': self.device.device_id,
+             'last_ping': ping_time.isoformat()},
+            {'logins': [], 'device_id': self.device.device_id, 'last_ping': ping_time.isoformat()}
+        ])
+        pipe.ltrim.assert_called_once_with(settings.PING_ARCHIVE_QUEUE, 0, 2)
+        # A full batch is buffered: it's exported immediately.
+        export_mock.assert_called_once_with()
+
+        # The buffer is full: one ping is dropped.
+        export_mock.reset_mock()
+        pipe.execute.return_value = [4, True]
+        self.assertEqual(ping_archive.archive_pings(pings), 1)
+        export_mock.assert_not_called()
+
+    @override_settings(PING_ARCHIVE_BATCH_SIZE=2)
+    def test_export(self, redis_mock):
+        records = [{'device_id': self.device.device_id, 'last_ping': timezone.now().isoformat(), 'fqdn': str(i)}
+                   for i in range(3)]
+        redis_conn = redis_mock.return_value
+        redis_conn.lrange.side_effect = [[json.dumps(r).encode() for r in records[:2]],
+                                         [json.dumps(records[2]).encode()],
+                                         []]
+        self.assertEqual(ping_archive.export(ping_archive.FileSink(self.path)), 3)
+        with open(self.path) as f:
+            self.assertListEqual([json.loads(line) for line in f], records)
+        # Exported batches are removed from the buffer.
+        self.assertListEqual(redis_conn.ltrim.call_args_list, [mock.call(settings.PING_ARCHIVE_QUEUE, 2, -1),
+                                                               mock.call(settings.PING_ARCHIVE_QUEUE, 1, -1)])
+
+    def test_export_failed(self, redis_mock):
+        redis_conn = redis_mock.return_value
+        redis_conn.lrange.return_value = [b'{"fqdn": "1"}', b'{"fqdn": "2"}']
+        sink = mock.Mock(spec=ping_archive.ArchiveSink)
+        sink.put_multi.side_effect = ValueError
+        self.assertEqual(ping_archive.export(sink), 0)
+        # The batch is left in the buffer.
+        redis_conn.ltrim.assert_not_called()
+
+        # The worker is killed while exporting: the batch is still left in the buffer.
+        sink.put_multi.side_effect = SystemExit
+        with self.assertRaises(SystemExit):
+            ping_archive.export(sink)
+        redis_conn.ltrim.assert_not_called()
+
+    def test_export_running(self, redis_mock):
+        redis_conn = redis_mock.return_value
+        redis_conn.lock.return_value.__enter__.side_effect = ping_archive.redis.exceptions.LockError
+        self.assertEqual(ping_archive.export(mock.Mock(spec=ping_archive.ArchiveSink)), 0)
+        redis_conn.lock.assert_called_once_with(ping_archive.EXPORT_LOCK, timeout=ping_archive.EXPORT_LOCK_TIMEOUT,
+                                                blocking=False)
+        redis_conn.lrange.assert_not_called()
+
+    def test_datastore_sink(self, redis_mock):
+        client = mock.Mock()
+        records = [{'device_id': self.device.device_id, 'last_ping': timezone.now().isoformat(), 'fqdn': str(i)}
+                   for i in range(ping_archive.DatastoreSink.MAX_BATCH_SIZE + 1)]
+        ping_archive.DatastoreSink(client).put_multi(records)
+        self.assertEqual(client.put_multi.call_count, 2)
+        entity = client.put_multi.call_args[0][0][0]
+        self.assertEqual(entity['device_id'], self.device.device_id)
+        self.assertEqual(entity['fqdn'], str(ping_archive.DatastoreSink.MAX_BATCH_SIZE))
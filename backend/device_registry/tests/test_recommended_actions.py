@@ -609,6 +609,28 @@ class CpuVulnerableActionTest(TestsMixin, TestCase):
         self.device.cpu = {'vendor': 'GenuineIntel'}
         self.device.save()
 
+    def test_affected_devices(self):
+        self.enable_action()
+        kernel = self.device.kernel_deb_package
+        fixed_kernel = DebPackage.objects.create(os_release_codename='buster', name='linux', version='5.0.1',
+                                                 source_name='linux', source_version='5.0.1',
+                                                 arch=DebPackage.Arch.i386)
+        for i, (cpu, kernel_deb_package) in enumerate([
+                ({'vendor': 'AuthenticAMD'}, kernel),
+                ({'vendor': 'GenuineIntel'}, None),
+                ({'vendor': 'GenuineIntel'}, fixed_kernel),
+                ({'vendor': 'GenuineIntel', 'mitigations_disabled': True}, fixed_kernel),
+                ({'vendor': 'GenuineIntel', 'mitigations_disabled': False}, fixed_kernel),
+                ({}, kernel)]):
+            Device.objects.create(device_id=f'device{i + 1}.d.wott-dev.local', owner=self.user, cpu=cpu,
+                                  kernel_deb_package=kernel_deb_package)
+        devices = Device.objects.all()
+        affected = {device.device_id for device in CpuVulnerableAction._affected_devices(devices)}
+        self.assertSetEqual(affected, {'device0.d.wott-dev.local', 'device4.d.wott-dev.local'})
+        # The same as checking the devices one by one.
+        self.assertSetEqual(affected,
+                            {device.device_id for device in devices if CpuVulnerableAction._is_affected(device)})
+
 
 class RebootRequiredActionTest(TestsMixin, TestCase):
     action_class = RebootRequiredAction
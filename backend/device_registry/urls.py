@@ -24,6 +24,7 @@ if settings.IS_API:
              name='sign_expired_cert'),
         path('api/{}/claim-device'.format(api_version), api_views.ClaimByLink.as_view(), name='claim_by_link'),
         path('api/{}/enroll-device'.format(api_version), api_views.DeviceEnrollView.as_view(), name='enroll_by_key'),
+        path('api/{}/bulk-ping'.format(api_version), api_views.BulkPingView.as_view(), name='bulk_ping'),
     ]
 
 # Only load if mTLS
@@ -37,6 +38,8 @@ if settings.IS_MTLS_API:
              api_views.MtlsRenewCertView.as_view(),
              name='mtls-sign-device-cert-test'),
         path('api/{}/ping'.format(api_version), api_views.MtlsPingView.as_view(), name='mtls-ping'),
+        path('api/{}/spam-networks'.format(api_version), api_views.MtlsSpamNetworksView.as_view(),
+             name='mtls-spam-networks'),
         path('api/{}/hello'.format(api_version), api_views.MtlsTesterView.as_view(), name='mtls-tester'),
         path('api/{}/action/<int:action_id>/<str:action_name>'.format(api_version), api_views.ActionView.as_view(),
              name='action'),
@@ -0,0 +1,132 @@
+"""
+Memoized package version comparison.
+
+Matching packages against vulnerabilities compares the same few versions over and over, so parsed rpm versions,
+normalized versions and pairwise comparison results are kept in LRU caches.
+"""
+import re
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import apt_pkg
+import rpm
+
+DEB = 'deb'
+RPM = 'rpm'
+
+CACHE_SIZE = 100000
+
+_DEB_FRAGMENT_RE = re.compile(r'(\D*)(\d*)')
+_RPM_SEGMENT_RE = re.compile(r'~|\^|[0-9]+|[a-zA-Z]+')
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_rpm_version(verstring) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Adapted from python2 version. Produces a tuple which can be used in rpm.labelCompare().
+    https://github.com/rpm-software-management/yum/blob/master/rpmUtils/miscutils.py#L391
+    :param verstring: A full version string [epoch:]<version>[.release]
+    :return: (epoch, version, release), any of those may be None
+    """
+    if verstring in [None, '']:
+        return (None, None, None)
+    i = verstring.find(':')
+    if i != -1:
+        try:
+            epoch = str(int(verstring[:i]))
+        except ValueError:
+            # look, garbage in the epoch field, how fun, kill it
+            epoch = '0'  # this is our fallback, deal
+    else:
+        epoch = '0'
+    j = verstring.find('-')
+    if j != -1:
+        if verstring[i + 1:j] == '':
+            version = None
+        else:
+            version = verstring[i + 1:j]
+        release = verstring[j + 1:]
+    else:
+        if verstring[i + 1:] == '':
+            version = None
+        else:
+            version = verstring[i + 1:]
+        release = None
+    return epoch, version, release
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compare(kind, a, b):
+    """
+    Compare two versions.
+    :param kind: DEB or RPM.
+    :return: a negative number if a < b, 0 if a == b, a positive number if a > b.
+    """
+    if kind == DEB:
+        return apt_pkg.version_compare(a, b)
+    return rpm.labelCompare(parse_rpm_version(a), parse_rpm_version(b))
+
+
+def _deb_fragment_key(fragment):
+    """
+    Alternating (non-digits, number) parts of a deb version fragment. Numbers are compared by value and a missing
+    number is the same as 0, e.g. "1.01" == "1.1" and "1." == "1.0".
+    """
+    if not fragment:
+        return None
+    key = [(text, int(digits or 0)) for text, digits in _DEB_FRAGMENT_RE.findall(fragment) if text or digits]
+    while key and key[-1] == ('', 0):
+        key.pop()
+    return tuple(key)
+
+
+def _rpm_label_key(label):
+    # Separators are ignored by rpmvercmp(), numbers are compared by value.
+    if label is None:
+        return None
+    return tuple(int(segment) if segment.isdigit() else segment for segment in _RPM_SEGMENT_RE.findall(label))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize(kind, version):
+    """
+    Convert a version to a hashable form which is equal for two versions if and only if compare() finds them
+    equal (e.g. "1:1.01-0" and "1:1.1" for deb). Deb versions are expected to be valid, i.e. not start with "-" or
+    ":".
+    """
+    if kind == DEB:
+        epoch, has_epoch, rest = version.partition(':')
+        if not has_epoch:
+            epoch, rest = '0', version
+        upstream, has_revision, revision = rest[1:].rpartition('-')
+        if has_revision:
+            upstream = rest[0] + upstream
+        else:
+            # No revision is the same as revision 0.
+            upstream, revision = rest, '0'
+        return _deb_fragment_key(epoch.lstrip('0') or '0'), _deb_fragment_key(upstream), \
+            _deb_fragment_key(revision)
+    return tuple(_rpm_label_key(label) for label in parse_rpm_version(version))
+
+
+class VersionSet:
+    """
+    An immutable set of versions with constant time membership check by their normalized forms.
+    """
+
+    def __init__(self, kind, versions):
+        self.kind = kind
+        self.versions = tuple(v for v in versions if v)
+        self.normalized = frozenset(normalize(kind, v) for v in self.versions)
+
+    def __contains__(self, version):
+        return normalize(self.kind, version) in self.normalized
+
+    def __len__(self):
+        return len(self.versions)
+
+
+def clear_cache():
+    parse_rpm_version.cache_clear()
+    compare.cache_clear()
+    normalize.cache_clear()
@@ -8,7 +8,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
 from django.db import transaction
-from django.db.models import Case, When, Count, Window, Value, F, Q, IntegerField, Max
+from django.db.models import Case, When, Count, Window, Value, F, Q, IntegerField
 from django.db.models.functions import Round, Coalesce
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import get_object_or_404
@@ -22,7 +22,7 @@ from .api_views import DeviceListFilterMixin
 from .forms import ClaimDeviceForm, DeviceAttrsForm, PortsForm, ConnectionsForm, DeviceMetadataForm
 from .forms import FirewallStateGlobalPolicyForm, GlobalPolicyForm
 from .models import Device, PortScan, FirewallState, get_bootstrap_color, PairingKey, Vulnerability
-from .models import GlobalPolicy, RecommendedActionStatus
+from .models import GlobalPolicy, RecommendedActionStatus, CveSummary
 from .recommended_actions import ActionMeta, FirewallDisabledAction, EnrollAction, GithubAction
 
 
@@ -698,34 +698,27 @@ class CVEView(LoginRequiredMixin, LoginTrackMixin, TemplateView):
         device_pk = kwargs.get('device_pk')
         if device_pk is not None:
             device = get_object_or_404(Device, pk=device_pk, owner=user)
-            vuln_query = Q(debpackage__device__pk=device_pk)
+            vuln_query = Q(debpackage__package_sets__devices__pk=device_pk)
         else:
             device = None
-            vuln_query = Q(debpackage__device__owner=user)
+            vuln_query = Q(debpackage__package_sets__devices__owner=user)
 
         # We gather Vulnerabilities from different sources: Debian Security Tracker (DST) and Ubuntu Security Tracker
         # (UST). DST and UST often don't agree on severity for the same CVE. Also UST has CVE publication date
         # (pub_date) while DST has not. But we need to compile the resulting CVE list regardless of those differences.
         # This is why the code below is so complicated.
 
-        # Select all CVEs which affect all user's devices and for every CVE find its publication date by looking through
-        # all CVEs with this name and finding maximal pub_date. By using Max() we avoid NULLs, as they compare as less
-        # than any other non-NULL value.
-        vuln_names = Vulnerability.objects.filter(vuln_query)\
-                                          .values('name').distinct()
-        vuln_pub_dates_qs = Vulnerability.objects.filter(name__in=vuln_names) \
-                                                 .values('name').distinct().annotate(pubdate=Max('pub_date'))
-        # Build a lookup dictionary for CVE publication dates.
-        vuln_pub_dates = {v['name']: v['pubdate'] for v in vuln_pub_dates_qs}
-
-        # Group CVEs selected above by their maximal urgency. We could put this into the huge request below,
-        # but it would work slower.
-        vuln_urgencies = Vulnerability.objects.filter(name__in=vuln_names)\
-                                              .values('name').distinct()\
-                                              .annotate(max_urgency=Max('urgency'))
+        # Select all CVEs which affect all user's devices and for every CVE find its publication date and maximal
+        # urgency among all CVEs with this name (precomputed in CveSummary).
+        vuln_names = Vulnerability.objects.filter(vuln_query).values('name')
+        vuln_summaries = CveSummary.objects.filter(name__in=vuln_names).values_list('name', 'max_urgency', 'pub_date')
+        # Build a lookup dictionary for CVE publication dates and group CVEs by their maximal urgency. We could put
+        # this into the huge request below, but it would work slower.
+        vuln_pub_dates = {}
         vulns_by_urgency = defaultdict(list)
-        for vuln_urgency in vuln_urgencies:
-            vulns_by_urgency[vuln_urgency['max_urgency']].append(vuln_urgency['name'])
+        for name, max_urgency, pub_date in vuln_summaries:
+            vuln_pub_dates[name] = pub_date
+            vulns_by_urgency[max_urgency].append(name)
 
         # For every Vulnerability (cve) on every user's DebPackage (pkg) installed on every user's device (dev) select
         # the following data:
@@ -751,13 +744,15 @@ class CVEView(LoginRequiredMixin, LoginTrackMixin, TemplateView):
               *[When(name__in=vulns_by_urgency[u], then=Value(u)) for u in Vulnerability.Urgency],
               output_field=IntegerField()
             )) \
-            .values('name', 'max_urgency', 'debpackage__pk', 'debpackage__device__pk', 'debpackage__name',
-                    'debpackage__device__name',  'debpackage__device__deviceinfo__fqdn')\
+            .values('name', 'max_urgency', 'debpackage__pk', 'debpackage__name',
+                    device_pk=F('debpackage__package_sets__devices__pk'),
+                    device_name=F('debpackage__package_sets__devices__name'),
+                    device_fqdn=F('debpackage__package_sets__devices__deviceinfo__fqdn'))\
             .annotate(devcnt=Window(expression=Count('debpackage__name'),
                                     partition_by=['name', 'debpackage__name']),
                       cvecnt=Window(expression=Count('debpackage__name'),
                                     partition_by=['name'])) \
-            .order_by('-max_urgency', '-cvecnt', 'name', '-devcnt', 'debpackage__name', 'debpackage__device__pk')
+            .order_by('-max_urgency', '-cvecnt', 'name', '-devcnt', 'debpackage__name', 'device_pk')
 
         table_rows = []
         current_row = None
@@ -766,14 +761,13 @@ class CVEView(LoginRequiredMixin, LoginTrackMixin, TemplateView):
             cve_name, package_name, urgency, devices_count,\
                 device_pk, device_name, device_fqdn = (device_package_cve[k] for k in [
                                                             'name', 'debpackage__name', 'max_urgency', 'devcnt',
-                                                            'debpackage__device__pk', 'debpackage__device__name',
-                                                            'debpackage__device__deviceinfo__fqdn'])
+                                                            'device_pk', 'device_name', 'device_fqdn'])
             # In devices_packages_cves the rows are ordered by cve_name and package_name. This means that they will be
             # grouped together by cve_name and the rows with the same cve_name will be grouped together by package_name.
             # Hence we have current_row.cve_name and current_package.name to detect when the cve_name or package_name
             # changes which means we need a new TableRow or a new AffectedPackage.
             if not current_row or current_row.cve_name != cve_name:
-                current_row = self.TableRow(cve_name, urgency, [], '', vuln_pub_dates[cve_name])
+                current_row = self.TableRow(cve_name, urgency, [], '', vuln_pub_dates.get(cve_name))
                 table_rows.append(current_row)
                 current_package = None
             if not current_package or current_package.name != package_name:
@@ -0,0 +1,192 @@
+"""
+In-memory vulnerability index for bulk package matching.
+
+A VulnerabilityIndex holds one distro suite's fixable vulnerabilities keyed by source package name. For every source
+package the fixed versions are kept sorted, so the vulnerabilities a package version is still affected by are found
+with a binary search instead of comparing the version with every vulnerability. Matching doesn't query the database.
+
+Indexes are built for a VulnerabilityGeneration and kept in the process until the generation changes. With
+settings.VULNERABILITY_INDEX_PATH set they are also snapshotted to files there, so worker processes on the same host
+load a snapshot built by one of them instead of querying the database. Every process still keeps its own copy.
+"""
+import logging
+import os
+import pickle
+from collections import defaultdict, namedtuple
+from functools import cmp_to_key
+from pathlib import Path
+
+from django.conf import settings
+
+from device_registry import versions
+from device_registry.models import Vulnerability, VulnerabilityGeneration
+
+logger = logging.getLogger('django')
+
+# fixed_versions: the versions vulnerabilities were fixed in, sorted;
+# fixed_ids: the ids of these vulnerabilities in the same order;
+# unfixed_ids: the ids of vulnerabilities without a fixed version;
+# not_affected: {vulnerability id: the versions not affected by it}.
+Entry = namedtuple('Entry', 'fixed_versions fixed_ids unfixed_ids not_affected')
+
+_indexes = {}
+
+
+class VulnerabilityIndex:
+    def __init__(self, codename, generation, entries):
+        """
+        :param entries: {source package name: Entry}
+        """
+        self.codename = codename
+        self.kind = Vulnerability.get_version_kind(codename)
+        self.generation = generation
+        self.entries = entries
+        self._not_affected_sets = {}
+
+    @classmethod
+    def build(cls, codename, generation, vulnerabilities):
+        """
+        :param vulnerabilities: an iterable of (id, package, unstable_version, other_versions) of fixable
+         vulnerabilities.
+        """
+        kind = Vulnerability.get_version_kind(codename)
+        by_package = defaultdict(list)
+        for vuln in vulnerabilities:
+            by_package[vuln[1]].append(vuln)
+        version_key = cmp_to_key(lambda a, b: versions.compare(kind, a, b))
+        entries = {}
+        for package, vulns in by_package.items():
+            fixed = sorted(((unstable_version, vuln_id) for vuln_id, _, unstable_version, _ in vulns
+                            if unstable_version), key=lambda item: version_key(item[0]))
+            entries[package] = Entry(
+                fixed_versions=tuple(version for version, _ in fixed),
+                fixed_ids=tuple(vuln_id for _, vuln_id in fixed),
+                unfixed_ids=tuple(vuln_id for vuln_id, _, unstable_version, _ in vulns if not unstable_version),
+                not_affected={vuln_id: tuple(other_versions) for vuln_id, _, _, other_versions in vulns
+                              if other_versions})
+        return cls(codename, generation, entries)
+
+    @classmethod
+    def load(cls, codename):
+        """
+        Build the index from the database.
+        :return: the index or None if the data changed while it was being loaded.
+        """
+        generation = VulnerabilityGeneration.get_current().number
+        vulnerabilities = Vulnerability.objects.filter(os_release_codename=codename, fix_available=True) \
+            .values_list('id', 'package', 'unstable_version', 'other_versions')
+        index = cls.build(codename, generation, vulnerabilities.iterator())
+        if VulnerabilityGeneration.get_current().number != generation:
+            return None
+        return index
+
+    def _first_fixed_after(self, fixed_versions, version):
+        lo, hi = 0, len(fixed_versions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if versions.compare(self.kind, version, fixed_versions[mid]) >= 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def match(self, source_name, source_version):
+        """
+        Find the vulnerabilities a source package version is affected by. Same as Vulnerability.is_vulnerable()
+        for every fixable vulnerability of the package.
+        :return: a list of vulnerability ids.
+        """
+        entry = self.entries.get(source_name)
+        if entry is None or self.kind is None:
+            return []
+        start = self._first_fixed_after(entry.fixed_versions, source_version)
+        result = []
+        for vuln_id in entry.fixed_ids[start:] + entry.unfixed_ids:
+            if vuln_id in entry.not_affected:
+                not_affected = self._not_affected_sets.get(vuln_id)
+                if not_affected is None:
+                    not_affected = versions.VersionSet(self.kind, entry.not_affected[vuln_id])
+                    self._not_affected_sets[vuln_id] = not_affected
+                if source_version in not_affected:
+                    continue
+            result.append(vuln_id)
+        return result
+
+    def __len__(self):
+        return sum(len(entry.fixed_ids) + len(entry.unfixed_ids) for entry in self.entries.values())
+
+    @staticmethod
+    def get_snapshot_path(codename, generation):
+        return Path(settings.VULNERABILITY_INDEX_PATH) / f'{codename}-{generation}.pickle'
+
+    def save_snapshot(self):
+        path = self.get_snapshot_path(self.codename, self.generation)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump((self.codename, self.generation, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(path)
+        # Remove the snapshots of older generations.
+        for old_path in path.parent.glob(f'{self.codename}-*.pickle'):
+            if old_path != path:
+                try:
+                    old_path.unlink()
+                except OSError:
+                    pass
+
+    @classmethod
+    def load_snapshot(cls, codename, generation):
+        """
+        :return: the index or None if there's no snapshot.
+        """
+        try:
+            with cls.get_snapshot_path(codename, generation).open('rb') as f:
+                return cls(*pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+
+class GenerationChanged(Exception):
+    pass
+
+
+def get_index(codename, generation):
+    """
+    Get the index of a suite for the given vulnerabilities generation: from the process cache, a snapshot or the
+    database (in that order).
+    :raise GenerationChanged: if the generation is not current anymore.
+    """
+    index = _indexes.get(codename)
+    if index is not None and index.generation == generation:
+        return index
+    if settings.VULNERABILITY_INDEX_PATH:
+        index = VulnerabilityIndex.load_snapshot(codename, generation)
+    else:
+        index = None
+    if index is None:
+        index = VulnerabilityIndex.load(codename)
+        if index is None or index.generation != generation:
+            raise GenerationChanged()
+        logger.info('built "%s" index of %d vulnerabilities.', codename, len(index))
+        if settings.VULNERABILITY_INDEX_PATH:
+            index.save_snapshot()
+    _indexes[codename] = index
+    return index
+
+
+def match_packages(packages, generation):
+    """
+    Match a stream of packages against the vulnerabilities of their suites.
+    :param packages: an iterable of DebPackage objects (or anything with source_name, source_version and
+     os_release_codename attributes).
+    :param generation: the vulnerabilities generation to match against.
+    :return: a generator of (package, vulnerability ids).
+    :raise GenerationChanged: if the generation is not current anymore.
+    """
+    for package in packages:
+        index = get_index(package.os_release_codename, generation)
+        yield package, index.match(package.source_name, package.source_version)
+
+
+def clear():
+    _indexes.clear()
@@ -4,7 +4,7 @@ import logging
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models import Q, Avg, Max, Window, Count, Sum
+from django.db.models import Q, Avg, Max, Count, Sum
 from django.db.models.functions import Coalesce
 from django.db.models.signals import pre_save
 from django.core.exceptions import ObjectDoesNotExist
@@ -16,7 +16,7 @@ from mixpanel import Mixpanel, MixpanelException
 from phonenumber_field.modelfields import PhoneNumberField
 
 from device_registry.models import RecommendedAction, RecommendedActionStatus, \
-    Device, HistoryRecord, Vulnerability, PairingKey
+    Device, HistoryRecord, Vulnerability, PairingKey, CveSummary
 from device_registry.celery_tasks import github
 
 logger = logging.getLogger(__name__)
@@ -220,13 +220,10 @@ class Profile(models.Model):
         # For every CVE name detected on all user's devices, find its maximal urgency among the whole CVE database.
         # This will include CVEs with the same name from different sources (Denian and Ubuntu trackers currently).
         # Then count the number of distinct CVE names grouped by urgency.
-        vuln_names = Vulnerability.objects.filter(debpackage__device__owner=self.user, fix_available=True) \
-            .values('name').distinct()
-        urgency_counts = Vulnerability.objects.filter(name__in=vuln_names) \
-            .values('name').distinct() \
-            .annotate(max_urgency=Max('urgency')) \
-            .annotate(urg_cnt=Window(expression=Count('name'), partition_by='max_urgency')).order_by() \
-            .values('max_urgency', 'urg_cnt')
+        vuln_names = Vulnerability.objects.filter(debpackage__package_sets__devices__owner=self.user,
+                                                  fix_available=True).values('name')
+        urgency_counts = CveSummary.objects.filter(name__in=vuln_names) \
+            .values('max_urgency').annotate(urg_cnt=Count('id')).order_by()
         counts_by_urgency = {s['max_urgency']: s['urg_cnt'] for s in urgency_counts}
         return (counts_by_urgency.get(urgency, 0) for urgency in [Vulnerability.Urgency.HIGH,
                                                                   Vulnerability.Urgency.MEDIUM,